@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import asyncio
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import partial
+from threading import Thread
+from typing import Any, Callable, Optional
+
+from BiliUser import BiliUser
+from Common import get_pool
+from HeartBeatSession import HeartBeatSession
+from WebHeartBeat import WebHeartBeat
+
+
+class AsyncHeartBeat(WebHeartBeat):
+    """A heartbeat manager which runs every heartbeat worker as a coroutine.
+
+    All (uid, room) pairs share one event loop running in a single thread, so
+    no thread is bound to a room. Blocking HTTP requests are handed to a small
+    executor and the number of requests in flight is bounded by a semaphore.
+    It keeps the public interface of WebHeartBeat.
+
+    === Private Attributes ===
+    _loop:
+        the event loop which runs all heartbeat coroutines.
+    _loop_thread:
+        the thread which runs <_loop> forever.
+    _io_executor:
+        a bounded ThreadPoolExecutor instance used to send HTTP requests.
+    _inflight:
+        a semaphore which limits the number of HTTP requests in flight.
+    _tasks:
+        a dictionary which key is (uid, room_id) and value is the set of running
+        heartbeat tasks of that pair.
+    """
+    _loop: asyncio.AbstractEventLoop
+    _loop_thread: Thread
+    _io_executor: ThreadPoolExecutor
+    _inflight: asyncio.Semaphore
+    _tasks: dict[tuple[int, int], set[asyncio.Task]]
+
+    def __init__(self, *args: tuple[int], max_workers: int = 16, max_inflight: int = 64) -> None:
+        super().__init__(*args)
+        self._loop = asyncio.new_event_loop()
+        self._io_executor = ThreadPoolExecutor(max_workers=max_workers,
+                                               thread_name_prefix="AsyncHeartBeat")
+        self._inflight = asyncio.Semaphore(max_inflight)
+        self._tasks = {}
+        self._loop_thread = Thread(target=self._loop.run_forever,
+                                   name="AsyncHeartBeat", daemon=True)
+        self._loop_thread.start()
+
+    def _start_heartbeat(self, user: BiliUser, room_id: int, session: HeartBeatSession) -> None:
+        self._loop.call_soon_threadsafe(self._spawn, user, room_id, session)
+
+    def _spawn(self, user: BiliUser, room_id: int, session: HeartBeatSession) -> None:
+        """Create the three heartbeat tasks of <user> in <room_id>.
+        This method must be called inside <self._loop>.
+        """
+        key = (user.uid, room_id)
+        tasks = self._tasks.setdefault(key, set())
+        for worker, name in ((self._web_heartbeat_task, "webHeartBeat"),
+                             (self._X_heartbeat_task, "X heartbeat"),
+                             (self._heartbeat_task, "heartBeat")):
+            task = self._loop.create_task(worker(user, room_id, session))
+            task.add_done_callback(partial(self._on_task_done, key))
+            tasks.add(task)
+            print(f"[{user.uid}][{room_id}]", f"{name} start")
+
+    def _on_task_done(self, key: tuple[int, int], task: asyncio.Task) -> None:
+        tasks = self._tasks.get(key)
+        if tasks is None:
+            return
+        tasks.discard(task)
+        if not tasks:
+            del self._tasks[key]
+
+    async def _call(self, func: Callable, user: BiliUser, *args,
+                    endpoint: Optional[str] = "heartbeat") -> Any:
+        """Run blocking <func> in <self._io_executor> without blocking the event loop.
+        The token of <endpoint> is taken on the event loop and the requests of <func>
+        skip the rate limiter, so executor threads are not held by the limiter.
+        If <endpoint> is None, <func> rarely sends a request and waits on the limiter
+        itself when it does.
+        """
+        pool = get_pool()
+        if endpoint is None:
+            call = partial(func, user, *args)
+        else:
+            if pool.limiter is not None:
+                await pool.limiter.acquire_async(endpoint, user.uid)
+            call = partial(self._prepaid, func, user, *args)
+        async with self._inflight:
+            return await self._loop.run_in_executor(self._io_executor, call)
+
+    @staticmethod
+    def _prepaid(func: Callable, *args) -> Any:
+        with get_pool().prepaid():
+            return func(*args)
+
+    async def _web_heartbeat_task(self, user: BiliUser, room_id: int, session: HeartBeatSession) -> None:
+        while self._is_running(user, room_id, session):
+            await asyncio.sleep(session.web_interval)
+            try:
+                session.web_interval = await self._call(self._send_web_heartbeat, user, room_id,
+                                                        session.web_interval)
+            except Exception:
+                self._close_room(user.uid, room_id)
+                print(traceback.format_exc())
+        self._end(session, "webHeartBeat")
+
+    async def _heartbeat_task(self, user: BiliUser, room_id: int, session: HeartBeatSession) -> None:
+        while self._is_running(user, room_id, session):
+            try:
+                await self._call(self._send_heartbeat, user, room_id)
+            except Exception:
+                self._close_room(user.uid, room_id)
+                print(traceback.format_exc())
+            await asyncio.sleep(40)
+        self._end(session, "heartBeat")
+
+    async def _X_heartbeat_task(self, user: BiliUser, room_id: int, session: HeartBeatSession) -> None:
+        if not session.handshaken and self._is_running(user, room_id, session):
+            try:
+                base_info = await self._call(self._get_room_info, user, room_id, endpoint=None)
+                await self._call(self._handshake, user, room_id, session, base_info)
+            except Exception:
+                self._close_room(user.uid, room_id)
+                print(traceback.format_exc())
+        await asyncio.sleep(self._X_delay(session))
+        while self._is_running(user, room_id, session):
+            try:
+                base_info = await self._call(self._get_room_info, user, room_id, endpoint=None)
+                session.interval, session.secret_key, session.secret_rule = await self._call(
+                    self._send_X_heartbeat, user, room_id, base_info, session)
+            except Exception:
+                self._close_room(user.uid, room_id)
+                print(traceback.format_exc())
+            else:
+                session.ets = int(time.time())
+                session.seq += 1
+                await asyncio.sleep(session.interval)
+        self._end(session, "X heartbeat")
+
+    def active(self) -> int:
+        """Return the number of running heartbeat tasks.
+        """
+        return sum(len(tasks) for tasks in list(self._tasks.values()))
+
+    def collect(self) -> list[tuple[str, dict[str, Any], float]]:
+        return super().collect() + [("heartbeat_tasks", {"kind": type(self).__name__}, self.active())]
+
+    def close(self, timeout: Optional[float] = None) -> bool:
+        """Cancel every heartbeat task, stop the event loop and wait at most
+        <timeout> seconds for requests in flight. Return whether they all finished.
+        """
+        async def _cancel_all() -> None:
+            tasks = [task for group in self._tasks.values() for task in group]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self._loop.is_closed():
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def _remaining() -> Optional[float]:
+            return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        try:
+            asyncio.run_coroutine_threadsafe(_cancel_all(), self._loop).result(_remaining())
+        except FutureTimeoutError:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join(_remaining())
+        if not self._loop_thread.is_alive():
+            self._loop.close()
+        # Requests already handed to the executor are left to finish, not cut.
+        waiter = Thread(target=self._io_executor.shutdown, kwargs={"wait": True}, daemon=True)
+        waiter.start()
+        waiter.join(_remaining())
+        return not waiter.is_alive() and self._loop.is_closed()
+
+    def _drain(self, deadline: float) -> bool:
+        drained = super()._drain(deadline)
+        return self.close(max(0.0, deadline - time.monotonic())) and drained
+
+
+if __name__ == '__main__':
+    w = AsyncHeartBeat()
+    w.add_user(178856569)
+    w.set_cookies_by_uid(178856569,
+                         sessdata="",
+                         csrf="",
+                         uid_ckmd5="",
+                         sid="",
+                         refresh_token="")
+    w.add_heartbeat(178856569, 30321760)
+    try:
+        w._loop_thread.join()
+    except KeyboardInterrupt:
+        w.shutdown()
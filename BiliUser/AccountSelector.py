@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import heapq
+import time
+from itertools import count
+from threading import Lock
+from typing import Any, Container, Optional
+
+from .BiliCookie import BiliCookie
+
+
+class AccountHealth:
+    """Health record of one account.
+
+    === Public Attributes ===
+    uid: the uid of the account.
+    cookie: the BiliCookie of the account, or None if only its uid is known.
+    last_success: unix time of the last successful use or check, or 0.
+    last_used: monotonic time the account was last selected, or 0.
+    errors: number of successive failures.
+    expires: unix time at which the cookie expires, or None if unknown.
+    version: incremented on every change, stale index entries are skipped.
+    cooling_until: monotonic time the cool-down after too many failures ends, or 0.
+    """
+    __slots__ = ("uid", "cookie", "last_success", "last_used", "errors", "expires", "version",
+                 "cooling_until")
+
+    uid: int
+    cookie: Optional[BiliCookie]
+    last_success: float
+    last_used: float
+    errors: int
+    expires: Optional[float]
+    version: int
+    cooling_until: float
+
+    def __init__(self, uid: int, cookie: Optional[BiliCookie] = None,
+                 expires: Optional[float] = None) -> None:
+        self.uid = uid
+        self.cookie = cookie
+        self.last_success = 0.0
+        self.last_used = 0.0
+        self.errors = 0
+        self.expires = expires
+        self.version = 0
+        self.cooling_until = 0.0
+
+    def alive(self, now: float, max_errors: int) -> bool:
+        if self.cookie is not None:
+            if not self.cookie.is_checking:
+                return False
+            self.expires = self.cookie.expires
+        if self.expires is not None and self.expires <= now:
+            return False
+        return self.errors < max_errors
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "uid": self.uid,
+            "last_success": self.last_success,
+            "errors": self.errors,
+            "expires": self.expires,
+        }
+
+
+class AccountSelector:
+    """Pick accounts by health instead of at random.
+
+    Accounts are kept in a heap ordered by (errors, last selected time), so the
+    healthiest least recently used account is selected in O(log n). Accounts
+    whose cookie is no longer checked are dropped. Accounts whose SESSDATA
+    expired are skipped until they are added again. Accounts which failed
+    <max_errors> times in a row are skipped for <cooldown> seconds, then get one
+    more try, unless they are reported healthy or added again before.
+
+    === Public Attributes ===
+    max_errors: number of successive failures after which an account is skipped.
+    cooldown: seconds an account which failed <max_errors> times is skipped.
+
+    === Private Attributes ===
+    _table: a dictionary which key is uid and value is its AccountHealth.
+    _heap: heap of (errors, last_used, sequence, version, uid), may hold stale entries.
+    _cooling: heap of (monotonic time the cool-down ends, uid) of failed accounts.
+    _seq: counter breaking ties in <_heap>.
+    _lock: lock guarding the state above.
+    """
+    max_errors: int
+    cooldown: float
+
+    _table: dict[int, AccountHealth]
+    _heap: list[tuple[int, float, int, int, int]]
+    _cooling: list[tuple[float, int]]
+    _seq: count
+    _lock: Lock
+
+    def __init__(self, max_errors: int = 3, cooldown: float = 600) -> None:
+        self.max_errors = max_errors
+        self.cooldown = cooldown
+        self._table = {}
+        self._heap = []
+        self._cooling = []
+        self._seq = count()
+        self._lock = Lock()
+
+    def _index(self, health: AccountHealth) -> None:
+        health.version += 1
+        heapq.heappush(self._heap, (health.errors, health.last_used, next(self._seq),
+                                    health.version, health.uid))
+        if len(self._heap) > 2 * len(self._table) + 64:
+            self._heap = [(h.errors, h.last_used, next(self._seq), h.version, h.uid)
+                          for h in self._table.values()]
+            heapq.heapify(self._heap)
+
+    def add(self, uid: int, cookie: Optional[BiliCookie] = None,
+            expires: Optional[float] = None) -> None:
+        """Add account <uid>, or replace its cookie and expiry if already known.
+        """
+        with self._lock:
+            if (health := self._table.get(uid)) is not None:
+                health.cookie = cookie
+                health.expires = expires if cookie is None else cookie.expires
+                health.errors = 0
+            else:
+                health = self._table[uid] = AccountHealth(
+                    uid, cookie, expires if cookie is None else cookie.expires)
+            self._index(health)
+
+    def remove(self, uid: int) -> None:
+        with self._lock:
+            self._table.pop(uid, None)
+
+    def report(self, uid: int, success: bool) -> None:
+        """Record the outcome of using or checking account <uid>.
+        """
+        with self._lock:
+            self._recover()
+            if (health := self._table.get(uid)) is None:
+                return
+            if success:
+                health.last_success = time.time()
+                health.errors = 0
+            else:
+                health.errors += 1
+                if health.errors == self.max_errors:
+                    health.cooling_until = time.monotonic() + self.cooldown
+                    heapq.heappush(self._cooling, (health.cooling_until, uid))
+            self._index(health)
+
+    def _recover(self) -> None:
+        """Give every account whose cool-down is over one more try.
+        """
+        now = time.monotonic()
+        while self._cooling and self._cooling[0][0] <= now:
+            until, uid = heapq.heappop(self._cooling)
+            if (health := self._table.get(uid)) is not None and health.cooling_until == until and \
+                    health.errors >= self.max_errors:
+                health.errors = self.max_errors - 1
+                self._index(health)
+
+    def select(self, exclude: Container[int] = ()) -> Optional[int]:
+        """Return the uid of the healthiest least recently used account which is
+        not in <exclude>, or None if there is none.
+        """
+        now = time.time()
+        with self._lock:
+            self._recover()
+            skipped = []
+            uid = None
+            while self._heap:
+                entry = heapq.heappop(self._heap)
+                health = self._table.get(entry[4])
+                if health is None or health.version != entry[3]:
+                    continue
+                if not health.alive(now, self.max_errors):
+                    # Left out of the index until a report or add brings it back.
+                    if health.cookie is not None and not health.cookie.is_checking:
+                        del self._table[health.uid]
+                    continue
+                if health.uid in exclude:
+                    skipped.append(entry)
+                    continue
+                uid = health.uid
+                health.last_used = time.monotonic()
+                self._index(health)
+                break
+            for entry in skipped:
+                heapq.heappush(self._heap, entry)
+            return uid
+
+    def is_healthy(self, uid: int) -> bool:
+        with self._lock:
+            self._recover()
+            health = self._table.get(uid)
+            return health is not None and health.alive(time.time(), self.max_errors)
+
+    def table(self) -> list[dict[str, Any]]:
+        """Return the health record of every account.
+        """
+        with self._lock:
+            return [health.to_dict() for health in self._table.values()]
+
+    def __contains__(self, uid: int) -> bool:
+        return uid in self._table
+
+    def __len__(self) -> int:
+        return len(self._table)
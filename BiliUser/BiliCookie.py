@@ -2,66 +2,146 @@ from __future__ import annotations
 
 import binascii
 import json
-import time
-from random import randint
-from threading import Thread
+import re
+from functools import lru_cache
+from html import unescape
+from threading import Lock
+from urllib.parse import unquote
+from typing import Any, Optional, TYPE_CHECKING
 
-import lxml.html as html
-import requests
-from Crypto.Cipher import PKCS1_OAEP
-from Crypto.PublicKey import RSA
-from Crypto.Hash import SHA256
+from Common import get_pool
 
 from .CookieUpdateException import CookieUpdateException
 
+if TYPE_CHECKING:
+    from Crypto.Cipher import PKCS1_OAEP
+    from requests import Response
 
-class BiliCookie(Thread):
+
+_PUBLIC_KEY = """\
+-----BEGIN PUBLIC KEY-----
+MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQDLgd2OAkcGVtoE3ThUREbio0Eg
+Uc/prcajMKXvkCKFCWhJYJcLkcM2DKKcSeFpD/j6Boy538YXnR6VhcuUJOhH2x71
+nzPjfdTcqMz7djHum0qSZA0AyCBDABUqCrfNgCiJ00Ra7GmRj+YCK1NJEuewlb40
+JNrRuoEUXpabUzGB8QIDAQAB
+-----END PUBLIC KEY-----"""
+
+
+_REFRESH_CSRF_PATTERN = re.compile(rb"<div\s[^>]*?\bid=[\"']?1-name[\"']?[^>]*>([^<]+)<", re.IGNORECASE)
+
+
+def sessdata_expires(sessdata: str) -> Optional[int]:
+    """Return the unix time at which <sessdata> expires, or None if unknown.
+    SESSDATA is "<token>,<expires>,<checksum>", URL encoded.
+    """
+    parts = unquote(sessdata).split(",")
+    if len(parts) < 2 or not parts[1].isdigit():
+        return None
+    return int(parts[1])
+
+
+@lru_cache(maxsize=None)
+def _oaep_cipher() -> PKCS1_OAEP.PKCS1OAEP_Cipher:
+    """Return the process-wide OAEP cipher of the correspond path public key.
+    The key is parsed only once, and the cipher keeps no state between calls.
+    """
+    from Crypto.Cipher import PKCS1_OAEP
+    from Crypto.Hash import SHA256
+    from Crypto.PublicKey import RSA
+
+    return PKCS1_OAEP.new(RSA.importKey(_PUBLIC_KEY), SHA256)
+
+
+class CookieSnapshot:
+    """An immutable set of cookies of one account.
+
+    A BiliCookie swaps its snapshot as a whole when cookies change, so readers
+    on other threads always see one consistent set without taking a lock, and
+    can compare <version> to know whether anything derived from it is stale.
+
+    === Public Attributes ===
+    version: incremented every time the cookies of the account change.
+    sessdata: SESSDATA option.
+    csrf: csrf or bili_jct option.
+    uid_ckmd5: ckmd5 representation of uid.
+    sid: sid option.
+    refresh_token: token used to refresh cookie.
+    cookie_string: the cookie header built from the options above.
+    """
+    __slots__ = ("version", "sessdata", "csrf", "uid_ckmd5", "sid", "refresh_token", "cookie_string")
+
+    version: int
+    sessdata: str
+    csrf: str
+    uid_ckmd5: str
+    sid: str
+    refresh_token: str
+    cookie_string: str
+
+    def __init__(self, uid: int, version: int, sessdata: str, csrf: str,
+                 uid_ckmd5: str, sid: str, refresh_token: str) -> None:
+        for name, value in (("version", version), ("sessdata", sessdata), ("csrf", csrf),
+                            ("uid_ckmd5", uid_ckmd5), ("sid", sid), ("refresh_token", refresh_token)):
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, "cookie_string", "; ".join([f"SESSDATA={sessdata}",
+                                                             f"bili_jct={csrf}",
+                                                             f"DedeUserID={uid}",
+                                                             f"DedeUserID__ckMd5={uid_ckmd5}",
+                                                             f"sid={sid}", ]))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("CookieSnapshot is immutable")
+
+
+class BiliCookie:
     """A class representation of bilibili cookies.
 
     https://github.com/SocialSisterYi/bilibili-API-collect/blob/master/docs/login/cookie_refresh.md
 
     === Public Attributes ===
-    is_checking: boolean that represents status of thread.
+    name: name used in logs.
+    is_checking: boolean that represents whether cookie is still kept alive.
     ua: default Chrome user agent.
     uid: the uid of user
-    uid_ckmd5: ckmd5 representation of uid
 
     === Private Attributes ===
-    _sessdata: SESSDATA option.
-    _csrf: csrf or bili_jct option.
-    _sid: sid option.
-    _refresh_token: token used to refresh cookie.
+    _snapshot: the current CookieSnapshot, replaced as a whole on change.
+    _swap_lock: lock serializing writers of <_snapshot>.
     _error_times: number of errors occured until next success run.
     """
+    name: str
     is_checking: bool
     ua: str = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
     uid: int
-    uid_ckmd5: str
 
-    _sessdata: str
-    _csrf: str
-    _sid: str
-    _refresh_token: str
+    _snapshot: CookieSnapshot
+    _swap_lock: Lock
     _error_times: int
 
     def __init__(self, uid: int) -> None:
-        super().__init__(name=f"BiliCookie_{uid}", daemon=True)
+        self.name = f"BiliCookie_{uid}"
         self.is_checking = True
         self.uid = uid
-        self.uid_ckmd5 = self._sessdata = self._csrf = self._sid = self._refresh_token = str()
+        self._snapshot = CookieSnapshot(uid, 0, "", "", "", "", "")
+        self._swap_lock = Lock()
         self._error_times = 0
 
     def __str__(self) -> str:
-        content = {
+        return json.dumps(self.to_dict(), ensure_ascii=False, separators=(",", ":"))
+
+    def to_dict(self) -> dict[str, Any]:
+        """Return the cookies in the format of an entry of cookies.json.
+        """
+        snapshot = self._snapshot
+        return {
             "UID": self.uid,
-            "SESSDATA": self._sessdata,
-            "bili_jct": self._csrf,
+            "SESSDATA": snapshot.sessdata,
+            "bili_jct": snapshot.csrf,
             "DedeUserID": self.uid,
-            "DedeUserID__ckMd5": self.uid_ckmd5,
-            "sid": self._sid,
-            "refresh_token": self._refresh_token
+            "DedeUserID__ckMd5": snapshot.uid_ckmd5,
+            "sid": snapshot.sid,
+            "refresh_token": snapshot.refresh_token
         }
-        return json.dumps(content, ensure_ascii=False, separators=(",", ":"))
 
     def set_cookies(self,
                     sessdata: str,
@@ -69,24 +149,37 @@ class BiliCookie(Thread):
                     uid_ckmd5: str,
                     sid: str,
                     refresh_token: str) -> None:
-        self.uid_ckmd5 = uid_ckmd5
-        self._sessdata, self._csrf, self._sid, self._refresh_token = sessdata, csrf, sid, refresh_token
+        with self._swap_lock:
+            self._snapshot = CookieSnapshot(self.uid, self._snapshot.version + 1,
+                                            sessdata, csrf, uid_ckmd5, sid, refresh_token)
+
+    @property
+    def snapshot(self) -> CookieSnapshot:
+        return self._snapshot
+
+    @property
+    def version(self) -> int:
+        return self._snapshot.version
 
     @property
     def cookie_string(self) -> str:
-        return "; ".join([f"SESSDATA={self._sessdata}",
-                          f"bili_jct={self._csrf}",
-                          f"DedeUserID={self.uid}",
-                          f"DedeUserID__ckMd5={self.uid_ckmd5}",
-                          f"sid={self._sid}", ])
+        return self._snapshot.cookie_string
+
+    @property
+    def uid_ckmd5(self) -> str:
+        return self._snapshot.uid_ckmd5
 
     @property
     def sessdata(self) -> str:
-        return self._sessdata
+        return self._snapshot.sessdata
 
     @property
     def csrf(self) -> str:
-        return self._csrf
+        return self._snapshot.csrf
+
+    @property
+    def expires(self) -> Optional[int]:
+        return sessdata_expires(self._snapshot.sessdata)
 
     def _check_expires(self) -> tuple[bool, int]:
         url = "https://passport.bilibili.com/x/passport-login/web/cookie/info"
@@ -97,22 +190,15 @@ class BiliCookie(Thread):
             "user-agent": self.ua,
         }
         params = {"csrf": self.csrf}
-        response = requests.get(url, headers=headers, params=params).json()
+        response = get_pool().get_json(url, headers=headers, params=params, account=self.uid)
         if response["code"] != 0:
             raise CookieUpdateException(
                 f"Failed to check cookie status, {response}")
         return response["data"]["refresh"], response["data"]["timestamp"]
 
-    def _get_correspond_path(self, ts: int) -> str:
-        pub_key = RSA.importKey("""\
------BEGIN PUBLIC KEY-----
-MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQDLgd2OAkcGVtoE3ThUREbio0Eg
-Uc/prcajMKXvkCKFCWhJYJcLkcM2DKKcSeFpD/j6Boy538YXnR6VhcuUJOhH2x71
-nzPjfdTcqMz7djHum0qSZA0AyCBDABUqCrfNgCiJ00Ra7GmRj+YCK1NJEuewlb40
-JNrRuoEUXpabUzGB8QIDAQAB
------END PUBLIC KEY-----""".strip())
-        cipher = PKCS1_OAEP.new(pub_key, SHA256)
-        encrypted = cipher.encrypt(f"refresh_{ts}".encode(encoding="utf-8"))
+    @staticmethod
+    def _get_correspond_path(ts: int) -> str:
+        encrypted = _oaep_cipher().encrypt(f"refresh_{ts}".encode(encoding="utf-8"))
         return binascii.b2a_hex(encrypted).decode(encoding="utf-8")
 
     def _get_refresh_csrf(self, path: str) -> str:
@@ -123,40 +209,65 @@ JNrRuoEUXpabUzGB8QIDAQAB
             "referer": "https://www.bilibili.com/",
             "user-agent": self.ua,
         }
-        response = requests.get(url, headers=headers).text
-        refresh_csrf = html.fromstring(response).xpath(
-            "//div[@id='1-name']/text()")
+        with get_pool().get(url, headers=headers, account=self.uid, stream=True) as response:
+            refresh_csrf, body = self._extract_refresh_csrf(response)
+            encoding = response.encoding or "utf-8"
+        if refresh_csrf is not None:
+            return refresh_csrf
+        # The page layout changed, fall back to a full DOM parse.
+        import lxml.html
+
+        response = body.decode(encoding, errors="replace")
+        refresh_csrf = lxml.html.fromstring(response).xpath(
+            "//div[@id='1-name']/text()") if response.strip() else []
         if not refresh_csrf:
             raise CookieUpdateException(
                 f"Failed to obtain <refresh_csrf>, {response}")
         return refresh_csrf[0]
 
+    @staticmethod
+    def _extract_refresh_csrf(response: Response) -> tuple[Optional[str], bytes]:
+        """Read <response> in chunks and stop as soon as the text of div#1-name is complete.
+        Return the text and the bytes read so far, or None and the whole body if not found.
+        """
+        buffer = bytearray()
+        for chunk in response.iter_content(chunk_size=4096):
+            # The div may span two chunks, search again from a bit before this chunk.
+            start = max(0, len(buffer) - 256)
+            buffer += chunk
+            if (match := _REFRESH_CSRF_PATTERN.search(buffer, start)) is not None:
+                return unescape(match.group(1).decode(encoding="utf-8")), bytes(buffer)
+        return None, bytes(buffer)
+
     def _refresh_cookie(self, refresh_csrf: str) -> None:
         url = "https://passport.bilibili.com/x/passport-login/web/cookie/refresh"
+        snapshot = self._snapshot
         headers = {
-            "cookie": self.cookie_string,
+            "cookie": snapshot.cookie_string,
             "origin": "https://www.bilibili.com",
             "referer": "https://www.bilibili.com/",
             "user-agent": self.ua,
         }
         data = {
-            "csrf": self.csrf,
+            "csrf": snapshot.csrf,
             "refresh_csrf": refresh_csrf,
             "source": "main_web",
-            "refresh_token": self._refresh_token,
+            "refresh_token": snapshot.refresh_token,
         }
-        response = requests.post(url, headers=headers, data=data)
+        response = get_pool().post(url, headers=headers, data=data, account=self.uid)
         if (response_json := response.json())["code"] != 0:
             raise CookieUpdateException(
                 f"Failed to refresh cookie, {response_json}")
-        self._sid = response.cookies.get("sid")
-        self.uid_ckmd5 = response.cookies.get("DedeUserID__ckMd5")
-        self._sessdata = response.cookies.get("SESSDATA")
-        self._csrf = response.cookies.get("bili_jct")
-        self._confirm_refresh()
-        self._refresh_token = response_json["data"]["refresh_token"]
-
-    def _confirm_refresh(self) -> None:
+        self.set_cookies(sessdata=response.cookies.get("SESSDATA"),
+                         csrf=response.cookies.get("bili_jct"),
+                         uid_ckmd5=response.cookies.get("DedeUserID__ckMd5"),
+                         sid=response.cookies.get("sid"),
+                         refresh_token=response_json["data"]["refresh_token"])
+        self._confirm_refresh(snapshot.refresh_token)
+
+    def _confirm_refresh(self, refresh_token: str) -> None:
+        """Deactivate the cookies of <refresh_token>, which is the token before refresh.
+        """
         url = "https://passport.bilibili.com/x/passport-login/web/confirm/refresh"
         headers = {
             "cookie": self.cookie_string,
@@ -166,9 +277,9 @@ JNrRuoEUXpabUzGB8QIDAQAB
         }
         data = {
             "csrf": self.csrf,
-            "refresh_token": self._refresh_token,
+            "refresh_token": refresh_token,
         }
-        response = requests.post(url, headers=headers, data=data)
+        response = get_pool().post(url, headers=headers, data=data, account=self.uid)
         if (response.json())["code"] != 0:
             raise CookieUpdateException(
                 f"Failed to deactivate old cookie, {response.json()}")
@@ -178,20 +289,24 @@ JNrRuoEUXpabUzGB8QIDAQAB
         refresh_csrf = self._get_refresh_csrf(path)
         self._refresh_cookie(refresh_csrf)
 
-    def _update(self) -> None:
-        """Keep cookie alive
+    def _update(self) -> bool:
+        """Keep cookie alive.
+        Return whether cookie needed refresh.
         """
         expires, ts = self._check_expires()
         if not expires:
-            return
+            return False
         self._refresh(ts)
         print(f"[{self.name}] refresh success.")
+        return True
 
     def stop_update(self) -> None:
         self.is_checking = False
 
-    def run(self) -> None:
-        if not self.sessdata or not self.csrf or not self._refresh_token:
+    def init_refresh(self) -> None:
+        """Refresh cookie once regardless of its expiry, which also validates it.
+        """
+        if not self.sessdata or not self.csrf or not self._snapshot.refresh_token:
             self.stop_update()
             raise CookieUpdateException("Cookie cannot be empty")
         try:
@@ -201,21 +316,24 @@ JNrRuoEUXpabUzGB8QIDAQAB
         except CookieUpdateException as e:
             self.stop_update()
             raise e
-        
-        s_t = randint(40, 70)
-        while self.is_checking:
-            if self._error_times > 10:
-                self.stop_update()
-                break
-            try:
-                self._update()
-            except:
-                import traceback
-
-                traceback.print_exc()
-                print(f"[{self.name}] refresh failed.")
-                self._error_times += 1
-            else:
-                self._error_times = 0
-            finally:
-                time.sleep(s_t)
+
+    def keep_alive(self) -> Optional[bool]:
+        """Check and refresh cookie once.
+        Return whether cookie needed refresh, or None if the check failed.
+        Cookie stops updating after more than 10 successive failures.
+        """
+        if self._error_times > 10:
+            self.stop_update()
+        if not self.is_checking:
+            return None
+        try:
+            refreshed = self._update()
+        except:
+            import traceback
+
+            traceback.print_exc()
+            print(f"[{self.name}] refresh failed.")
+            self._error_times += 1
+            return None
+        self._error_times = 0
+        return refreshed
@@ -1,8 +1,7 @@
 from __future__ import annotations
 
-import requests
-
 from .BiliCookie import BiliCookie
+from .CookieRefresher import get_refresher
 
 
 class BiliUser:
@@ -21,7 +20,7 @@ class BiliUser:
     
     def set_cookies(self, *args, **kwargs) -> None:
         self.cookie.set_cookies(*args, **kwargs)
-        self.cookie.start()
+        get_refresher().add(self.cookie)
     
     def stop(self) -> None:
-        self.cookie.stop_update()
+        get_refresher().remove(self.uid)
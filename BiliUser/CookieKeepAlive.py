@@ -1,23 +1,33 @@
 from __future__ import annotations
 
-import json
 import time
+from threading import Event, Thread
+from typing import Optional
 
-from random import choice
-from threading import Thread
-
+from Common import Timer, get_pool, get_wheel
+from .AccountSelector import AccountSelector
 from .BiliCookie import BiliCookie
+from .CookieRefresher import get_refresher
+from .CookieStore import CookieStore
 
 
 class CookieKeepAlive(Thread):
     _cookies: dict[int, BiliCookie]
     _uids: set[int]
+    _finished: Event
+    _store: CookieStore
+    _selector: AccountSelector
+    _timer: Optional[Timer]
 
     def __init__(self) -> None:
         super().__init__(name="CookieKeepAlive", daemon=True)
         self._cookies = {}
         self._uids = set()
         self._closed = False
+        self._finished = Event()
+        self._store = CookieStore(self._get_json_path())
+        self._selector = AccountSelector()
+        self._timer = None
     
     @staticmethod
     def _get_json_path() ->  str:
@@ -28,28 +38,23 @@ class CookieKeepAlive(Thread):
             return "cookies.json"
 
     def load_cookie(self) -> set[int]:
-        """Load cookies from saved file.
+        """Load new cookies from cookie store.
         """
         new_uid = set()
-        try:
-            with open(self._get_json_path(), "r", encoding="utf-8") as f:
-                content = f.read()
-            content = json.loads(content)
-        except FileNotFoundError:
-            content = {}
-        for uid in content:
-            uint = content[uid]["UID"]
+        content = self._store.load()
+        for uint in content:
             if uint in self._uids:
                 continue
             self._cookies[uint] = BiliCookie(uint)
             self._cookies[uint].set_cookies(
-                sessdata=content[uid]["SESSDATA"],
-                csrf=content[uid]["bili_jct"],
-                uid_ckmd5=content[uid]["DedeUserID__ckMd5"],
-                sid=content[uid]["sid"],
-                refresh_token=content[uid]["refresh_token"]
+                sessdata=content[uint]["SESSDATA"],
+                csrf=content[uint]["bili_jct"],
+                uid_ckmd5=content[uint]["DedeUserID__ckMd5"],
+                sid=content[uint]["sid"],
+                refresh_token=content[uint]["refresh_token"]
             )
             self._uids.add(uint)
+            self._selector.add(uint, self._cookies[uint])
             new_uid.add(uint)
         if (new_len := len(new_uid)) > 0:
             print(f"[CookieKeepAlive] loads {new_len} new users.")
@@ -57,15 +62,9 @@ class CookieKeepAlive(Thread):
         return new_uid
 
     def save_cookie(self) -> None:
-        """Save current cookies into files.
+        """Save changed cookies into cookie store.
         """
-        content = {}
-        for uid in self._cookies:
-            content[str(uid)] = json.loads(str(self._cookies[uid]))
-        content = json.dumps(content, ensure_ascii=False,
-                             separators=(",", ":"))
-        with open("cookies.json", "w", encoding="utf-8") as f:
-            f.write(content)
+        self._store.save(list(self._cookies.values()))
 
     def clean_dead(self) -> None:
         dead_uid = set()
@@ -76,27 +75,78 @@ class CookieKeepAlive(Thread):
                 self._uids.remove(uid)
         for u in dead_uid:
             del self._cookies[u]
+            self._selector.remove(u)
+
+    def random_cookie(self) -> Optional[str]:
+        """Return the cookie of the healthiest least recently used account,
+        or None if no account is alive.
+        """
+        if (uid := self._selector.select()) is None:
+            return None
+        return self._cookies[uid].cookie_string
+
+    def _on_checked(self, cookie: BiliCookie, result: Optional[bool]) -> None:
+        if cookie.uid in self._selector:
+            self._selector.report(cookie.uid, result is not None)
 
-    def random_cookie(self) -> str:
-        index = choice(list(self._cookies.keys()))
-        return self._cookies[index].cookie_string
+    def health(self) -> list[dict]:
+        return self._selector.table()
 
     def status(self) -> int:
         return len(self._uids)
 
     def run(self) -> None:
+        get_refresher().add_listener(self._on_checked)
         self.load_cookie()
         for uid in self._cookies:
-            self._cookies[uid].start()
-        while len(self._uids) != 0 and not self._closed:
-            self.save_cookie()
-            time.sleep(60)
-            new_uid = self.load_cookie()
-            for uid in new_uid:
-                self._cookies[uid].start()
-            self.clean_dead()
+            get_refresher().add(self._cookies[uid])
+        if len(self._uids) == 0:
+            return
+        self.save_cookie()
+        self._timer = get_wheel().call_every(60, self._keep_alive, name=self.name)
+        self._finished.wait()
+
+    def _keep_alive(self) -> bool:
+        """Pick up new users, drop dead ones and save cookies.
+        This method runs on the timer wheel every 60s until no user is alive.
+        """
+        if self._closed:
+            return False
+        new_uid = self.load_cookie()
+        for uid in new_uid:
+            get_refresher().add(self._cookies[uid])
+        self.clean_dead()
+        if len(self._uids) == 0:
+            self._finished.set()
+            return False
+        self.save_cookie()
+        return True
 
     def close(self) -> None:
         self._closed = True
+        self._finished.set()
+        get_refresher().remove_listener(self._on_checked)
         for uid in self._cookies:
-            self._cookies[uid].stop_update()
+            get_refresher().remove(uid)
+
+    def shutdown(self, timeout: float = 10) -> bool:
+        """Stop keeping cookies alive, wait at most <timeout> seconds for refreshes
+        in flight and save cookies. Return whether every refresh finished in time.
+        """
+        deadline = time.monotonic() + timeout
+        self._closed = True
+        drained = True
+        if self._timer is not None:
+            self._timer.cancel()
+            drained = get_wheel().wait([self._timer], timeout)
+        get_refresher().remove_listener(self._on_checked)
+        for uid in list(self._cookies):
+            get_refresher().remove(uid)
+        if (limiter := get_pool().limiter) is not None:
+            limiter.wake()
+        drained = get_refresher().drain(max(0.0, deadline - time.monotonic())) and drained
+        # Cookies refreshed by now are saved, the others are saved by the next start.
+        self.save_cookie()
+        self._store.close()
+        self._finished.set()
+        return drained
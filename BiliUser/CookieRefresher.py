@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import heapq
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_all
+from itertools import count
+from random import randint
+from threading import Condition, Lock, Thread
+from typing import Any, Callable, Optional
+
+from Common import get_metrics
+from .BiliCookie import BiliCookie
+
+
+class CookieRefresher:
+    """Keep every BiliCookie alive from one scheduler and a small worker pool.
+
+    Cookies wait in a priority queue ordered by their next check time. The
+    interval of a cookie doubles each time cookie/info reports that no refresh
+    is needed, up to <max_interval>, and falls back to a random base interval
+    after a refresh or a failure.
+
+    === Public Attributes ===
+    max_interval: longest interval between two checks of a cookie.
+
+    === Private Attributes ===
+    _cookies: a dictionary which key is uid and value is its BiliCookie.
+    _intervals: a dictionary which key is uid and value is its current interval.
+    _queue: heap of (next check time, sequence, uid).
+    _seq: counter breaking ties in <_queue>.
+    _cond: condition guarding the state above and waking the scheduler.
+    _executor: the bounded worker pool running checks.
+    _inflight: checks being run by <_executor>.
+    _closed: whether this refresher has been closed.
+    _scheduler: the thread popping due cookies from <_queue>.
+    _listeners: callables notified with (cookie, result) after every check.
+    _checked: a dictionary which key is uid and value is unix time of its last
+        successful check.
+    _refreshed: a dictionary which key is uid and value is unix time of its last refresh.
+    _workers: number of workers of <_executor>.
+    """
+    max_interval: float
+
+    _cookies: dict[int, BiliCookie]
+    _intervals: dict[int, float]
+    _queue: list[tuple[float, int, int]]
+    _seq: count
+    _cond: Condition
+    _executor: ThreadPoolExecutor
+    _inflight: set[Future]
+    _closed: bool
+    _scheduler: Thread
+    _listeners: list[Callable[[BiliCookie, Optional[bool]], None]]
+    _checked: dict[int, float]
+    _refreshed: dict[int, float]
+    _workers: int
+
+    def __init__(self, workers: int = 4, max_interval: float = 2 * 60 * 60) -> None:
+        self.max_interval = max_interval
+        self._cookies = {}
+        self._intervals = {}
+        self._queue = []
+        self._seq = count()
+        self._cond = Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="CookieRefresher")
+        self._inflight = set()
+        self._closed = False
+        self._listeners = []
+        self._checked = {}
+        self._refreshed = {}
+        self._workers = workers
+        self._scheduler = Thread(target=self._run, name="CookieRefresher", daemon=True)
+        self._scheduler.start()
+
+    @staticmethod
+    def _base_interval() -> float:
+        return randint(40, 70)
+
+    def add(self, cookie: BiliCookie) -> None:
+        """Start keeping <cookie> alive, beginning with an init refresh.
+        If its uid is already kept alive, <cookie> replaces the tracked one and
+        keeps its schedule.
+        """
+        with self._cond:
+            tracked = cookie.uid in self._cookies
+            self._cookies[cookie.uid] = cookie
+            if tracked:
+                return
+            self._intervals[cookie.uid] = self._base_interval()
+            self._submit(self._init, cookie)
+
+    def remove(self, uid: int) -> None:
+        self._checked.pop(uid, None)
+        self._refreshed.pop(uid, None)
+        with self._cond:
+            if (cookie := self._cookies.pop(uid, None)) is not None:
+                cookie.stop_update()
+            self._intervals.pop(uid, None)
+
+    def add_listener(self, listener: Callable[[BiliCookie, Optional[bool]], None]) -> None:
+        """Call <listener> with (cookie, result) after every check of a cookie.
+        <result> is whether the cookie needed refresh, or None if the check failed.
+        """
+        with self._cond:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[BiliCookie, Optional[bool]], None]) -> None:
+        with self._cond:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def _notify(self, cookie: BiliCookie, result: Optional[bool]) -> None:
+        get_metrics().inc("cookie_checks_total",
+                          result={None: "failed", False: "valid", True: "refreshed"}[result])
+        if result is not None:
+            self._checked[cookie.uid] = time.time()
+        if result is True:
+            self._refreshed[cookie.uid] = time.time()
+        for listener in list(self._listeners):
+            try:
+                listener(cookie, result)
+            except:
+                print(traceback.format_exc())
+
+    def _push(self, uid: int, delay: float) -> None:
+        with self._cond:
+            if uid not in self._cookies or self._closed:
+                return
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._seq), uid))
+            self._cond.notify()
+
+    def _init(self, cookie: BiliCookie) -> None:
+        try:
+            cookie.init_refresh()
+        except:
+            print(traceback.format_exc())
+            self._notify(cookie, None)
+            self.remove(cookie.uid)
+            return
+        self._notify(cookie, True)
+        with self._cond:
+            interval = self._intervals.get(cookie.uid)
+        if interval is None:
+            return
+        self._push(cookie.uid, interval)
+
+    def _check(self, cookie: BiliCookie) -> None:
+        refreshed = cookie.keep_alive()
+        self._notify(cookie, refreshed)
+        if not cookie.is_checking:
+            self.remove(cookie.uid)
+            return
+        with self._cond:
+            if cookie.uid not in self._intervals:
+                return
+            if refreshed is False:
+                interval = min(self.max_interval, self._intervals[cookie.uid] * 2)
+            else:
+                interval = self._base_interval()
+            self._intervals[cookie.uid] = interval
+        self._push(cookie.uid, interval)
+
+    def _submit(self, func: Callable[[BiliCookie], None], cookie: BiliCookie) -> None:
+        future = self._executor.submit(func, cookie)
+        self._inflight.add(future)
+        future.add_done_callback(self._inflight.discard)
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """Wait at most <timeout> seconds for running checks, so no refresh is cut
+        in the middle. Return whether every check finished.
+        """
+        with self._cond:
+            inflight = list(self._inflight)
+        _, pending = wait_all(inflight, timeout)
+        return not pending
+
+    def _run(self) -> None:
+        with self._cond:
+            while not self._closed:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                due, _, uid = self._queue[0]
+                if (wait := due - time.monotonic()) > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._queue)
+                if (cookie := self._cookies.get(uid)) is not None:
+                    self._submit(self._check, cookie)
+
+    def next_check(self, uid: int) -> Optional[float]:
+        """Return seconds until the next check of <uid>, or None if it is not queued.
+        """
+        with self._cond:
+            due = [item[0] for item in self._queue if item[2] == uid]
+        return min(due) - time.monotonic() if due else None
+
+    def __len__(self) -> int:
+        return len(self._cookies)
+
+    def collect(self) -> list[tuple[str, dict[str, Any], float]]:
+        """Return gauges of the seconds since every cookie was last checked and
+        refreshed, and of queued and running checks.
+        """
+        now = time.time()
+        with self._cond:
+            uids = list(self._cookies)
+            queued = len(self._queue)
+            inflight = len(self._inflight)
+        gauges = [("cookie_refresh_queue", {}, queued),
+                  ("workers_busy", {"pool": "CookieRefresher"}, inflight),
+                  ("workers_max", {"pool": "CookieRefresher"}, self._workers)]
+        for uid in uids:
+            if (checked := self._checked.get(uid)) is not None:
+                gauges.append(("cookie_check_age_seconds", {"uid": uid}, now - checked))
+            if (refreshed := self._refreshed.get(uid)) is not None:
+                gauges.append(("cookie_refresh_age_seconds", {"uid": uid}, now - refreshed))
+        return gauges
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            for cookie in self._cookies.values():
+                cookie.stop_update()
+            self._cond.notify_all()
+        self._executor.shutdown(wait=False)
+
+
+_refresher: Optional[CookieRefresher] = None
+_refresher_lock = Lock()
+
+
+def get_refresher() -> CookieRefresher:
+    """Return the process-wide CookieRefresher instance, starting it on first use.
+    """
+    global _refresher
+    if _refresher is None:
+        with _refresher_lock:
+            if _refresher is None:
+                _refresher = CookieRefresher()
+                get_metrics().register("CookieRefresher", _refresher.collect)
+    return _refresher
@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import time
+from threading import Lock
+from typing import Any, Iterable, Optional
+
+from .BiliCookie import BiliCookie
+
+
+class CookieStore:
+    """Persistent storage of cookies backed by SQLite.
+
+    Only accounts whose cookies changed since the last save are written, each
+    save being one transaction. cookies.json is kept as the file users paste
+    new accounts into and as the export read by RecCookieUpdater; it is
+    replaced atomically and only re-parsed when its mtime or size changes.
+
+    === Public Attributes ===
+    json_path: path of cookies.json.
+    db_path: path of the SQLite database.
+
+    === Private Attributes ===
+    _conn: connection to the SQLite database.
+    _lock: lock guarding <_conn> and <_saved>.
+    _saved: a dictionary which key is uid and value is its last saved entry as JSON.
+    _json_stamp: (mtime_ns, size) of cookies.json when it was last read or written.
+    """
+    json_path: str
+    db_path: str
+
+    _conn: sqlite3.Connection
+    _lock: Lock
+    _saved: dict[int, str]
+    _json_stamp: Optional[tuple[int, int]]
+
+    def __init__(self, json_path: str, db_path: Optional[str] = None) -> None:
+        self.json_path = json_path
+        self.db_path = db_path or os.path.splitext(json_path)[0] + ".db"
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cookies ("
+                           "uid INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)")
+        self._conn.commit()
+        self._lock = Lock()
+        self._saved = {}
+        self._json_stamp = None
+
+    @staticmethod
+    def _dumps(entry: dict[str, Any]) -> str:
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+
+    def _stamp(self) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(self.json_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read_json(self) -> dict[int, dict[str, Any]]:
+        try:
+            with open(self.json_path, "r", encoding="utf-8") as f:
+                content = json.loads(f.read())
+        except FileNotFoundError:
+            return {}
+        return {entry["UID"]: entry for entry in content.values()}
+
+    def load(self) -> dict[int, dict[str, Any]]:
+        """Return entries which are new or changed since the last load or save.
+        The first call returns every stored account. cookies.json is only parsed
+        when it has been modified by someone else.
+        """
+        changed = {}
+        with self._lock:
+            if not self._saved:
+                for uid, data, updated in self._conn.execute(
+                        "SELECT uid, data, updated FROM cookies"):
+                    self._saved[uid] = data
+                    changed[uid] = (updated, json.loads(data))
+            stamp = self._stamp()
+            if stamp is not None and stamp != self._json_stamp:
+                mtime = stamp[0] / 1e9
+                for uid, entry in self._read_json().items():
+                    if uid in changed and changed[uid][0] >= mtime:
+                        continue
+                    if self._saved.get(uid) != self._dumps(entry):
+                        changed[uid] = (mtime, entry)
+            self._json_stamp = stamp
+        return {uid: entry for uid, (_, entry) in changed.items()}
+
+    def save(self, cookies: Iterable[BiliCookie]) -> int:
+        """Persist <cookies> as the complete set of alive accounts.
+        Only changed accounts are written, accounts missing from <cookies> are
+        removed. Return the number of written or removed accounts.
+        """
+        current = {cookie.uid: self._dumps(cookie.to_dict()) for cookie in cookies}
+        with self._lock:
+            dirty = [(uid, data) for uid, data in current.items() if self._saved.get(uid) != data]
+            removed = [uid for uid in self._saved if uid not in current]
+            if not dirty and not removed:
+                return 0
+            now = time.time()
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO cookies (uid, data, updated) VALUES (?, ?, ?) "
+                    "ON CONFLICT(uid) DO UPDATE SET data=excluded.data, updated=excluded.updated",
+                    [(uid, data, now) for uid, data in dirty])
+                self._conn.executemany("DELETE FROM cookies WHERE uid=?",
+                                       [(uid,) for uid in removed])
+            for uid in removed:
+                del self._saved[uid]
+            self._saved.update(dirty)
+            self._write_json()
+        return len(dirty) + len(removed)
+
+    def _write_json(self) -> None:
+        """Atomically replace cookies.json with the saved entries.
+        Entries are already serialized, so unchanged accounts are not encoded again.
+        """
+        content = "{" + ",".join(f"\"{uid}\":{data}" for uid, data in self._saved.items()) + "}"
+        tmp_path = self.json_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.json_path)
+        self._json_stamp = self._stamp()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -1,3 +1,6 @@
 from .BiliUser import BiliUser
 from .BiliCookie import BiliCookie
 from .CookieKeepAlive import CookieKeepAlive
+from .CookieRefresher import CookieRefresher, get_refresher
+from .CookieStore import CookieStore
+from .AccountSelector import AccountSelector
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import traceback
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any, Callable, Iterator, Optional
+
+
+class BrowserPool:
+    """Keep one warm browser instance and lend it to one caller at a time.
+
+    The browser is started on first use and reused afterwards, so each use is
+    a page navigation instead of a process launch. It is health checked before
+    every use, cleared of cookies and storage after every use, and recycled
+    after <max_uses> uses or after any failure.
+
+    === Public Attributes ===
+    max_uses: number of uses before the browser is restarted.
+    clear_origins: origins whose storage is cleared after every use.
+
+    === Private Attributes ===
+    _factory: callable starting a new browser.
+    _driver: the warm browser, or None if none is running.
+    _uses: number of uses of <_driver>.
+    _lock: lock allowing only one use at a time.
+    """
+    max_uses: int
+    clear_origins: tuple[str, ...]
+
+    _factory: Callable[[], Any]
+    _driver: Optional[Any]
+    _uses: int
+    _lock: Lock
+
+    def __init__(self, factory: Callable[[], Any], max_uses: int = 24,
+                 clear_origins: tuple[str, ...] = ("https://www.bilibili.com",)) -> None:
+        self.max_uses = max_uses
+        self.clear_origins = clear_origins
+        self._factory = factory
+        self._driver = None
+        self._uses = 0
+        self._lock = Lock()
+
+    @contextmanager
+    def acquire(self) -> Iterator[Any]:
+        """Lend the warm browser, starting or restarting it when needed.
+        """
+        with self._lock:
+            driver = self._ensure()
+            try:
+                yield driver
+            except:
+                self._discard()
+                raise
+            else:
+                self._uses += 1
+                if self._uses >= self.max_uses or not self._clear(driver):
+                    self._discard()
+
+    def _ensure(self) -> Any:
+        if self._driver is not None and not self._healthy(self._driver):
+            print("[BrowserPool] browser is unhealthy, restarting.")
+            self._discard()
+        if self._driver is None:
+            self._driver = self._factory()
+            self._uses = 0
+        return self._driver
+
+    @staticmethod
+    def _healthy(driver: Any) -> bool:
+        try:
+            driver.execute_cdp_cmd("Browser.getVersion", {})
+            return bool(driver.window_handles)
+        except:
+            return False
+
+    def _clear(self, driver: Any) -> bool:
+        """Remove cookies and storage left by the previous account.
+        Return whether the browser is still usable.
+        """
+        try:
+            driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+            for origin in self.clear_origins:
+                driver.execute_cdp_cmd("Storage.clearDataForOrigin",
+                                       {"origin": origin, "storageTypes": "all"})
+            driver.get("about:blank")
+        except:
+            print(traceback.format_exc())
+            return False
+        return True
+
+    def _discard(self) -> None:
+        if self._driver is None:
+            return
+        try:
+            self._driver.quit()
+        except:
+            print(traceback.format_exc())
+        self._driver = None
+        self._uses = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._discard()
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import heapq
+import math
+import time
+from threading import Lock
+from typing import Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+
+
+class ExpiryIndex(Generic[K]):
+    """An index of keys which expire after a TTL, swept in bulk.
+
+    Deadlines are rounded up to <resolution> seconds and keys are grouped in
+    one set per rounded deadline, so setting or discarding a key is O(1) and a
+    sweep only touches buckets which are due. Keys never expire early, and at
+    most <resolution> seconds late.
+
+    === Public Attributes ===
+    resolution: width of a bucket in seconds.
+
+    === Private Attributes ===
+    _deadlines: a dictionary which key is a key and value is its bucket.
+    _buckets: a dictionary which key is bucket and value is the set of keys in it.
+    _order: heap of buckets, may hold buckets which became empty.
+    _lock: lock guarding the state above.
+    """
+    resolution: float
+
+    _deadlines: dict[K, int]
+    _buckets: dict[int, set[K]]
+    _order: list[int]
+    _lock: Lock
+
+    def __init__(self, resolution: float = 30) -> None:
+        self.resolution = resolution
+        self._deadlines = {}
+        self._buckets = {}
+        self._order = []
+        self._lock = Lock()
+
+    def _unlink(self, key: K) -> None:
+        if (bucket := self._deadlines.pop(key, None)) is None:
+            return
+        keys = self._buckets[bucket]
+        keys.discard(key)
+        if not keys:
+            del self._buckets[bucket]
+
+    def set(self, key: K, ttl: float) -> None:
+        """Let <key> expire <ttl> seconds from now, replacing its previous TTL.
+        """
+        bucket = math.ceil((time.monotonic() + ttl) / self.resolution)
+        with self._lock:
+            self._unlink(key)
+            self._deadlines[key] = bucket
+            if bucket not in self._buckets:
+                self._buckets[bucket] = set()
+                heapq.heappush(self._order, bucket)
+            self._buckets[bucket].add(key)
+
+    def discard(self, key: K) -> None:
+        with self._lock:
+            self._unlink(key)
+
+    def pop_expired(self, now: Optional[float] = None) -> list[K]:
+        """Remove and return every key whose TTL has passed.
+        """
+        current = math.floor((time.monotonic() if now is None else now) / self.resolution)
+        expired = []
+        with self._lock:
+            while self._order and self._order[0] <= current:
+                bucket = heapq.heappop(self._order)
+                for key in self._buckets.pop(bucket, ()):
+                    del self._deadlines[key]
+                    expired.append(key)
+        return expired
+
+    def expires_in(self, key: K) -> Optional[float]:
+        """Return seconds until <key> expires, or None if it is not indexed.
+        """
+        with self._lock:
+            bucket = self._deadlines.get(key)
+        return None if bucket is None else bucket * self.resolution - time.monotonic()
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._deadlines
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
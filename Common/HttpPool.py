@@ -0,0 +1,289 @@
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from threading import BoundedSemaphore, Lock, local
+from typing import Any, Iterator, Optional, TYPE_CHECKING, Union
+from urllib.parse import urlsplit
+
+from .Metrics import get_metrics
+from .RateLimiter import RateLimiter, get_limiter
+
+if TYPE_CHECKING:
+    from http.cookiejar import CookiePolicy
+
+    import requests
+
+
+@lru_cache(maxsize=None)
+def _reject_cookies() -> CookiePolicy:
+    """Return a cookie policy that never stores nor sends cookies from the session jar.
+    Pooled sessions are shared by every account, so cookies must only come from
+    explicit headers. http.cookiejar is imported here as it is slow to import.
+    """
+    from http.cookiejar import CookiePolicy
+
+    class _RejectCookies(CookiePolicy):
+        netscape = True
+        rfc2965 = hide_cookie2 = False
+
+        def set_ok(self, cookie, request) -> bool:
+            return False
+
+        def return_ok(self, cookie, request) -> bool:
+            return False
+
+        def domain_return_ok(self, domain, request) -> bool:
+            return False
+
+        def path_return_ok(self, path, request) -> bool:
+            return False
+
+    return _RejectCookies()
+
+
+class HttpPool:
+    """A pool of keep-alive sessions, one per host.
+
+    Each host (scheme + netloc) owns a requests.Session whose adapter keeps up
+    to <pool_size> idle connections alive, so heartbeats, danmaku and cookie
+    checks reuse TCP+TLS connections instead of handshaking every time.
+
+    === Public Attributes ===
+    pool_size:
+        default number of keep-alive connections kept for each host.
+    max_concurrency:
+        default number of requests allowed in flight to each host.
+    timeout:
+        default (connect, read) timeout of every request.
+    host_limits:
+        a dictionary which key is host and value is (pool_size, max_concurrency)
+        overriding the defaults for that host.
+    limiter:
+        RateLimiter instance every request waits on, or None for no limit.
+
+    === Private Attributes ===
+    _sessions: a dictionary which key is host and value is its session.
+    _slots: a dictionary which key is host and value is its concurrency semaphore.
+    _stats: a dictionary which key is host and value is
+        [requests, errors, seconds, requests in flight].
+    _lock: lock guarding creation of sessions and <_stats>.
+    _local: state of the calling thread, <_local.prepaid> is True inside <self.prepaid>.
+    _request_error: requests.RequestException, resolved with the first session.
+    """
+    pool_size: int
+    max_concurrency: int
+    timeout: tuple[float, float]
+    host_limits: dict[str, tuple[int, int]]
+    limiter: Optional[RateLimiter]
+
+    _sessions: dict[str, requests.Session]
+    _slots: dict[str, BoundedSemaphore]
+    _stats: dict[str, list]
+    _lock: Lock
+    _local: local
+    _request_error: Union[type[Exception], tuple]
+
+    def __init__(self,
+                 pool_size: int = 32,
+                 max_concurrency: int = 32,
+                 timeout: tuple[float, float] = (5, 15),
+                 host_limits: Optional[dict[str, tuple[int, int]]] = None,
+                 limiter: Optional[RateLimiter] = None) -> None:
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.host_limits = host_limits or {}
+        self.limiter = limiter
+        self._sessions = {}
+        self._slots = {}
+        self._stats = {}
+        self._lock = Lock()
+        self._local = local()
+        # Nothing is sent before the first session exists, so nothing to catch yet.
+        self._request_error = ()
+
+    @staticmethod
+    def _host(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def session(self, url: str) -> requests.Session:
+        """Return the keep-alive session for the host of <url>.
+        requests is imported here, on first use, to keep startup fast.
+        """
+        host = self._host(url)
+        session = self._sessions.get(host)
+        if session is not None:
+            return session
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        with self._lock:
+            if host not in self._sessions:
+                pool_size, max_concurrency = self.host_limits.get(
+                    host, (self.pool_size, self.max_concurrency))
+                session = requests.Session()
+                session.cookies.set_policy(_reject_cookies())
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=pool_size,
+                                      pool_block=False)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._request_error = requests.RequestException
+                self._slots[host] = BoundedSemaphore(max_concurrency)
+                self._stats[host] = [0, 0, 0.0, 0]
+                self._sessions[host] = session
+            return self._sessions[host]
+
+    @contextmanager
+    def prepaid(self) -> Iterator[None]:
+        """Send requests of the calling thread inside this block without waiting on
+        <self.limiter>, for callers which took their token beforehand.
+        """
+        previous = getattr(self._local, "prepaid", False)
+        self._local.prepaid = True
+        try:
+            yield
+        finally:
+            self._local.prepaid = previous
+
+    def request(self, method: str, url: str, account: Optional[int] = None,
+                acquire: bool = True, **kwargs) -> requests.Response:
+        """Send a request through the pooled session of its host.
+        <account> is the uid the request is sent for, used by <self.limiter>.
+        If <acquire> is False, or inside <self.prepaid>, the request does not wait
+        on <self.limiter> since its caller took the token already.
+        Accepts the same keyword arguments as <requests.request>.
+        Latency and status of every request are counted per endpoint in metrics.
+        """
+        session = self.session(url)
+        host = self._host(url)
+        kwargs.setdefault("timeout", self.timeout)
+        stats = self._stats[host]
+        endpoint = get_metrics().endpoint(url)
+        if acquire and self.limiter is not None and not getattr(self._local, "prepaid", False):
+            self.limiter.acquire(self.limiter.classify(url), account)
+        with self._slots[host]:
+            with self._lock:
+                stats[3] += 1
+            start = time.perf_counter()
+            status = "error"
+            try:
+                response = session.request(method, url, **kwargs)
+                status = response.status_code
+                if self.limiter is not None and response.status_code in RateLimiter.THROTTLE_CODES:
+                    self.limiter.report(self.limiter.classify(url), response.status_code, account)
+                return response
+            except self._request_error:
+                with self._lock:
+                    stats[1] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    stats[0] += 1
+                    stats[2] += elapsed
+                    stats[3] -= 1
+                get_metrics().observe("http_request_seconds", elapsed, endpoint=endpoint)
+                get_metrics().inc("http_requests_total", endpoint=endpoint, status=status)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def request_json(self, method: str, url: str, account: Optional[int] = None,
+                     **kwargs) -> dict[str, Any]:
+        """Send a request and return its JSON body.
+        The <code> of the body is reported to <self.limiter> so it can back off.
+        """
+        response = self.request(method, url, account=account, **kwargs).json()
+        if isinstance(response, dict) and "code" in response:
+            if self.limiter is not None:
+                self.limiter.report(self.limiter.classify(url), response["code"], account)
+            if response["code"] != 0:
+                get_metrics().inc("api_errors_total", endpoint=get_metrics().endpoint(url),
+                                  code=response["code"])
+        return response
+
+    def get_json(self, url: str, **kwargs) -> dict[str, Any]:
+        return self.request_json("GET", url, **kwargs)
+
+    def post_json(self, url: str, **kwargs) -> dict[str, Any]:
+        return self.request_json("POST", url, **kwargs)
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """Return request count, error count, opened connections, reuse rate and
+        mean latency of every host.
+        """
+        result = {}
+        for host, session in list(self._sessions.items()):
+            sent, errors, seconds, _ = self._stats[host]
+            connections = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        connections += pool.num_connections
+            result[host] = {
+                "requests": sent,
+                "errors": errors,
+                "connections": connections,
+                "reuse_rate": 1 - connections / sent if sent else 0.0,
+                "avg_latency": seconds / sent if sent else 0.0,
+            }
+        return result
+
+    def collect(self) -> list[tuple[str, dict[str, Any], float]]:
+        """Return gauges of requests in flight and of the concurrency of every host.
+        """
+        gauges = []
+        with self._lock:
+            for host, stats in self._stats.items():
+                pool_size, max_concurrency = self.host_limits.get(
+                    host, (self.pool_size, self.max_concurrency))
+                gauges.append(("http_in_flight", {"host": host}, stats[3]))
+                gauges.append(("http_max_concurrency", {"host": host}, max_concurrency))
+        return gauges
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+_pool: Optional[HttpPool] = None
+_pool_lock = Lock()
+
+
+def get_pool() -> HttpPool:
+    """Return the process-wide HttpPool instance, creating it on first use.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = HttpPool(host_limits={
+                    "https://api.live.bilibili.com": (64, 32),
+                    "https://live-trace.bilibili.com": (64, 32),
+                    "https://passport.bilibili.com": (16, 8),
+                    "https://www.bilibili.com": (16, 8),
+                }, limiter=get_limiter())
+                get_metrics().register("HttpPool", _pool.collect)
+    return _pool
+
+
+def set_pool(pool: HttpPool) -> None:
+    """Replace the process-wide HttpPool instance, e.g. to change its limits.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool is not pool:
+            _pool.close()
+        _pool = pool
+        get_metrics().register("HttpPool", pool.collect)
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import bisect
+import inspect
+import threading
+import traceback
+from threading import Lock, Thread
+from weakref import WeakMethod
+from typing import Any, Callable, Iterable, Optional, TYPE_CHECKING
+from urllib.parse import urlsplit
+
+if TYPE_CHECKING:
+    from werkzeug.serving import BaseWSGIServer
+
+Labels = tuple[tuple[str, str], ...]
+Collector = Callable[[], Iterable[tuple[str, dict[str, Any], float]]]
+
+
+class _Histogram:
+    """Observations counted into cumulative latency buckets.
+
+    === Public Attributes ===
+    counts: number of observations in each bucket, the last one is +Inf.
+    total: sum of every observation.
+    count: number of observations.
+    """
+    __slots__ = ("counts", "total", "count")
+
+    counts: list[int]
+    total: float
+    count: int
+
+    def __init__(self, buckets: int) -> None:
+        self.counts = [0] * (buckets + 1)
+        self.total = 0.0
+        self.count = 0
+
+
+class Metrics:
+    """Counters, latency histograms and gauges of the whole process.
+
+    Counters and histograms are updated on the hot path under one lock, which
+    is a dictionary lookup and an addition. Gauges are not stored: every
+    component registers a collector returning its current values, called only
+    when metrics are read, so idle components cost nothing.
+
+    === Public Attributes ===
+    buckets: upper bounds in seconds of the latency histogram buckets.
+
+    === Private Attributes ===
+    _counters: a dictionary which key is (name, labels) and value is its count.
+    _histograms: a dictionary which key is (name, labels) and value is its histogram.
+    _collectors: a dictionary which key is the name of a component and value is
+        (a reference to its gauge collector, labels added to its gauges).
+    _lock: lock guarding the state above.
+    """
+    buckets: tuple[float, ...]
+
+    _counters: dict[tuple[str, Labels], float]
+    _histograms: dict[tuple[str, Labels], _Histogram]
+    _collectors: dict[str, tuple[Callable[[], Optional[Collector]], dict[str, Any]]]
+    _lock: Lock
+
+    # Path of every bilibili endpoint and its name in metrics.
+    ENDPOINTS = {
+        "/xlive/rdata-interface/v1/heartbeat/webHeartBeat": "webHeartBeat",
+        "/xlive/data-interface/v1/x25Kn/E": "E",
+        "/xlive/data-interface/v1/x25Kn/X": "X",
+        "/relation/v1/Feed/heartBeat": "feed_heartbeat",
+        "/room/v1/Room/get_info": "get_info",
+        "/msg/send": "msg_send",
+        "/xlive/virtual-interface/v1/app/detail": "fishing_list",
+        "/x/passport-login/web/cookie/info": "cookie_info",
+        "/x/passport-login/web/cookie/refresh": "cookie_refresh",
+        "/x/passport-login/web/confirm/refresh": "confirm_refresh",
+        "/x/web-interface/nav": "nav",
+        "/x/frontend/finger/spi": "spi",
+    }
+
+    def __init__(self, buckets: tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)) -> None:
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = {}
+        self._lock = Lock()
+
+    @classmethod
+    def endpoint(cls, url: str) -> str:
+        """Return the name of the endpoint of <url>, "other" if it is unknown,
+        so labels never grow with room ids or query strings.
+        """
+        path = urlsplit(url).path
+        if (name := cls.ENDPOINTS.get(path)) is not None:
+            return name
+        if path.startswith("/correspond/"):
+            return "correspond"
+        return "other"
+
+    @staticmethod
+    def _labels(labels: dict[str, Any]) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """Count <seconds> into the histogram <name>.
+        """
+        key = (name, self._labels(labels))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(len(self.buckets))
+            histogram.counts[index] += 1
+            histogram.total += seconds
+            histogram.count += 1
+
+    def register(self, component: str, collector: Collector, **labels) -> None:
+        """Read gauges of <component> from <collector>, replacing its previous one.
+        <collector> returns (name, labels, value) of every gauge, <labels> are added
+        to each of them. A bound method is held weakly, so registering does not
+        keep its instance alive, and it is dropped once the instance is freed.
+        """
+        if inspect.ismethod(collector):
+            ref = WeakMethod(collector)
+        else:
+            ref = lambda: collector
+        with self._lock:
+            self._collectors[component] = (ref, labels)
+
+    def unregister(self, component: str) -> None:
+        with self._lock:
+            self._collectors.pop(component, None)
+
+    def _gauges(self) -> list[tuple[str, Labels, float]]:
+        with self._lock:
+            collectors = list(self._collectors.items())
+        gauges = [("process_threads", (), threading.active_count())]
+        for component, (ref, extra) in collectors:
+            if (collector := ref()) is None:
+                with self._lock:
+                    if self._collectors.get(component, (None,))[0] is ref:
+                        del self._collectors[component]
+                continue
+            try:
+                for name, labels, value in collector():
+                    gauges.append((name, self._labels({**labels, **extra}), value))
+            except:
+                print(f"[Metrics] collector {component} failed.")
+                print(traceback.format_exc())
+        return gauges
+
+    def snapshot(self) -> dict[str, list[dict[str, Any]]]:
+        """Return every counter, histogram and gauge as plain dictionaries.
+        """
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = [(key, list(h.counts), h.total, h.count)
+                          for key, h in self._histograms.items()]
+        bounds = [*map(str, self.buckets), "+Inf"]
+        result = {"counters": [], "histograms": [], "gauges": []}
+        for (name, labels), value in counters:
+            result["counters"].append({"name": name, "labels": dict(labels), "value": value})
+        for (name, labels), counts, total, count in histograms:
+            cumulative, buckets = 0, {}
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                buckets[bound] = cumulative
+            result["histograms"].append({"name": name, "labels": dict(labels), "count": count,
+                                         "sum": total, "buckets": buckets})
+        for name, labels, value in self._gauges():
+            result["gauges"].append({"name": name, "labels": dict(labels), "value": value})
+        return result
+
+    @staticmethod
+    def _format(name: str, labels: dict[str, str]) -> str:
+        if not labels:
+            return name
+        content = ",".join('{}="{}"'.format(key, value.replace("\\", "\\\\").replace('"', '\\"'))
+                           for key, value in labels.items())
+        return f"{name}{{{content}}}"
+
+    def render(self) -> str:
+        """Return every metric in Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines, typed = [], set()
+
+        def _type(name: str, kind: str) -> None:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for counter in sorted(snapshot["counters"], key=lambda x: x["name"]):
+            _type(counter["name"], "counter")
+            lines.append(f"{self._format(counter['name'], counter['labels'])} {counter['value']}")
+        for histogram in sorted(snapshot["histograms"], key=lambda x: x["name"]):
+            name, labels = histogram["name"], histogram["labels"]
+            _type(name, "histogram")
+            for bound, count in histogram["buckets"].items():
+                lines.append(f"{self._format(name + '_bucket', dict(labels, le=bound))} {count}")
+            lines.append(f"{self._format(name + '_sum', labels)} {histogram['sum']}")
+            lines.append(f"{self._format(name + '_count', labels)} {histogram['count']}")
+        for gauge in sorted(snapshot["gauges"], key=lambda x: x["name"]):
+            _type(gauge["name"], "gauge")
+            lines.append(f"{self._format(gauge['name'], gauge['labels'])} {gauge['value']}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host: str = "127.0.0.1", port: int = 9105) -> BaseWSGIServer:
+        """Serve metrics at http://<host>:<port>/metrics in Prometheus text format
+        and at /metrics.json as a snapshot, from a daemon thread.
+        Return the server, call its shutdown() to stop it.
+        flask is imported here, so it is only needed when metrics are served.
+        """
+        from flask import Flask, Response, jsonify
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class _QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs) -> None:
+                pass
+
+        app = Flask("Metrics")
+
+        @app.route("/metrics")
+        def _metrics() -> Response:
+            return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+        @app.route("/metrics.json")
+        def _snapshot() -> Response:
+            return jsonify(self.snapshot())
+
+        server = make_server(host, port, app, threaded=True, request_handler=_QuietHandler)
+        Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+        print(f"[Metrics] serving on http://{host}:{server.server_port}/metrics")
+        return server
+
+
+_metrics: Optional[Metrics] = None
+_metrics_lock = Lock()
+
+
+def get_metrics() -> Metrics:
+    """Return the process-wide Metrics instance, creating it on first use.
+    """
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = Metrics()
+    return _metrics
@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+import time
+from threading import Condition, Lock
+from typing import Optional
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    """A token bucket refilled at <rate> tokens per second up to <capacity>.
+
+    Tokens are reserved ahead of time, so a caller learns how long it has to
+    wait and can sleep either in a thread or in a coroutine. The rate backs off
+    multiplicatively when the server throttles and recovers additively.
+
+    === Public Attributes ===
+    base_rate: configured refill rate.
+    rate: current refill rate after backoff.
+    capacity: max number of tokens stored for bursts.
+
+    === Private Attributes ===
+    _tokens: number of tokens, negative when reserved ahead.
+    _updated: monotonic time of last refill.
+    _blocked_until: monotonic time until which no token is handed out.
+    _backoff: seconds to block on next throttle.
+    _lock: lock guarding the bucket state.
+    """
+    __slots__ = ("base_rate", "rate", "capacity",
+                 "_tokens", "_updated", "_blocked_until", "_backoff", "_lock")
+
+    base_rate: float
+    rate: float
+    capacity: float
+
+    _tokens: float
+    _updated: float
+    _blocked_until: float
+    _backoff: float
+    _lock: Lock
+
+    MIN_BACKOFF = 1.0
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.base_rate = self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._backoff = self.MIN_BACKOFF
+        self._lock = Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, tokens: float = 1) -> float:
+        """Take <tokens> and return seconds to wait before using them.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._blocked_until - now)
+
+    def ready_in(self, tokens: float = 1) -> float:
+        """Return seconds until <tokens> are available, without taking them.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            missing = tokens - self._tokens
+            wait = missing / self.rate if missing > 0 else 0.0
+            return max(wait, self._blocked_until - now)
+
+    def throttle(self) -> None:
+        """Halve the rate and block the bucket for an exponentially growing time.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.rate = max(self.base_rate * 0.05, self.rate / 2)
+            self._blocked_until = max(self._blocked_until, now + self._backoff)
+            self._backoff = min(self.MAX_BACKOFF, self._backoff * 2)
+
+    def recover(self) -> None:
+        with self._lock:
+            if self.rate < self.base_rate:
+                self.rate = min(self.base_rate, self.rate + self.base_rate * 0.1)
+            self._backoff = max(self.MIN_BACKOFF, self._backoff / 2)
+
+
+class RateLimiter:
+    """Shared limiter of outbound requests with token buckets per endpoint class
+    and per account.
+
+    A request waits for a token of its endpoint class and of its account. When
+    Bilibili answers with a throttling code the bucket of that endpoint class,
+    and of that account if known, backs off.
+
+    === Public Attributes ===
+    budgets:
+        a dictionary which key is endpoint class and value is (rate, capacity).
+    account_budget:
+        (rate, capacity) of the bucket of every account, or None for no limit.
+
+    === Private Attributes ===
+    _buckets: a dictionary which key is endpoint class and value is its bucket.
+    _accounts: a dictionary which key is uid and value is its bucket.
+    _lock: lock guarding <_accounts>.
+    _wakeup: condition waiting threads sleep on, notified by <self.wake>.
+    _generation: number of calls of <self.wake>.
+    """
+    budgets: dict[str, tuple[float, float]]
+    account_budget: Optional[tuple[float, float]]
+
+    _buckets: dict[str, TokenBucket]
+    _accounts: dict[int, TokenBucket]
+    _lock: Lock
+    _wakeup: Condition
+    _generation: int
+
+    THROTTLE_CODES = frozenset({-412, -509, -799, 412, 429})
+
+    def __init__(self,
+                 budgets: Optional[dict[str, tuple[float, float]]] = None,
+                 account_budget: Optional[tuple[float, float]] = (2, 10)) -> None:
+        self.budgets = budgets if budgets is not None else {
+            "heartbeat": (50, 100),
+            "danmaku": (2, 5),
+            "passport": (5, 10),
+            "room_info": (10, 20),
+        }
+        self.account_budget = account_budget
+        self._buckets = {name: TokenBucket(*budget) for name, budget in self.budgets.items()}
+        self._accounts = {}
+        self._lock = Lock()
+        self._wakeup = Condition()
+        self._generation = 0
+
+    @staticmethod
+    def classify(url: str) -> str:
+        """Return endpoint class of <url>.
+        """
+        parts = urlsplit(url)
+        if parts.netloc == "live-trace.bilibili.com" or parts.path.endswith("/Feed/heartBeat"):
+            return "heartbeat"
+        if parts.path == "/msg/send":
+            return "danmaku"
+        if parts.netloc == "passport.bilibili.com" or parts.path.startswith("/correspond/"):
+            return "passport"
+        if parts.path.endswith("/Room/get_info") or parts.path.startswith("/xlive/virtual-interface/"):
+            return "room_info"
+        return "other"
+
+    def _account(self, account: Optional[int]) -> Optional[TokenBucket]:
+        if account is None or self.account_budget is None:
+            return None
+        bucket = self._accounts.get(account)
+        if bucket is None:
+            with self._lock:
+                bucket = self._accounts.setdefault(account, TokenBucket(*self.account_budget))
+        return bucket
+
+    def _reserve(self, endpoint: str, account: Optional[int]) -> float:
+        wait = 0.0
+        if (bucket := self._buckets.get(endpoint)) is not None:
+            wait = bucket.reserve()
+        if (bucket := self._account(account)) is not None:
+            wait = max(wait, bucket.reserve())
+        return wait
+
+    def acquire(self, endpoint: str, account: Optional[int] = None) -> None:
+        """Block the calling thread until a request to <endpoint> is allowed,
+        or until <self.wake> is called.
+        """
+        generation = self._generation
+        if (wait := self._reserve(endpoint, account)) > 0:
+            with self._wakeup:
+                self._wakeup.wait_for(lambda: self._generation != generation, wait)
+
+    def wake(self) -> None:
+        """Let every thread blocked in <self.acquire> send its request now, so a
+        shutdown is not held by a throttled bucket. Later requests wait as usual.
+        """
+        with self._wakeup:
+            self._generation += 1
+            self._wakeup.notify_all()
+
+    def try_acquire(self, endpoint: str, account: Optional[int] = None) -> float:
+        """Take a token for a request to <endpoint> and return 0 if one is available
+        now, otherwise take nothing and return seconds until one is. For callers which
+        must not block, e.g. timer wheel callbacks, so they run again later instead.
+        """
+        if (wait := self.ready_in(endpoint, account)) > 0:
+            return wait
+        self._reserve(endpoint, account)
+        return 0.0
+
+    async def acquire_async(self, endpoint: str, account: Optional[int] = None) -> None:
+        """Suspend the calling coroutine until a request to <endpoint> is allowed.
+        """
+        if (wait := self._reserve(endpoint, account)) > 0:
+            import asyncio
+
+            await asyncio.sleep(wait)
+
+    def ready_in(self, endpoint: str, account: Optional[int] = None) -> float:
+        """Return seconds until a request to <endpoint> would be allowed, without
+        taking a token.
+        """
+        wait = 0.0
+        if (bucket := self._buckets.get(endpoint)) is not None:
+            wait = bucket.ready_in()
+        if (bucket := self._account(account)) is not None:
+            wait = max(wait, bucket.ready_in())
+        return wait
+
+    def report(self, endpoint: str, code: int, account: Optional[int] = None) -> None:
+        """Adapt the budgets of <endpoint> and <account> to the response <code>.
+        """
+        buckets = [self._buckets.get(endpoint), self._account(account)]
+        for bucket in buckets:
+            if bucket is None:
+                continue
+            if code in self.THROTTLE_CODES:
+                bucket.throttle()
+            elif code == 0:
+                bucket.recover()
+        if code in self.THROTTLE_CODES:
+            print(f"[RateLimiter] {endpoint} throttled with code {code}, backing off.")
+
+    def status(self) -> dict[str, float]:
+        """Return the current rate of every endpoint class.
+        """
+        return {name: bucket.rate for name, bucket in self._buckets.items()}
+
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = Lock()
+
+
+def get_limiter() -> RateLimiter:
+    """Return the process-wide RateLimiter instance, creating it on first use.
+    """
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter()
+    return _limiter
+
+
+def set_limiter(limiter: RateLimiter) -> None:
+    global _limiter
+    with _limiter_lock:
+        _limiter = limiter
@@ -0,0 +1,258 @@
+from __future__ import annotations
+
+import math
+import random
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Condition, Event, Lock, Thread
+from typing import Any, Callable, Iterable, Optional
+
+from .Metrics import get_metrics
+
+
+class Timer:
+    """A handle of a task registered in TimerWheel.
+
+    === Public Attributes ===
+    name: name of this task, used in logs.
+    interval: delay between two runs, or None for a one-shot task.
+    jitter: upper bound of the random delay added to every run.
+    cancelled: whether this task has been cancelled.
+
+    === Private Attributes ===
+    _id: unique id of this task inside its wheel.
+    _wheel: the wheel this task belongs to.
+    _func: the callback of this task.
+    _args: positional arguments passed to <_func>.
+    _slot: index of the slot this task currently waits in, or None.
+    _rounds: number of full wheel turns left before this task is due.
+    _running: whether the callback of this task is being executed.
+    _failures: number of consecutive runs whose callback raised.
+    """
+    __slots__ = ("name", "interval", "jitter", "cancelled",
+                 "_id", "_wheel", "_func", "_args", "_slot", "_rounds", "_running", "_failures")
+
+    name: str
+    interval: Optional[float]
+    jitter: float
+    cancelled: bool
+
+    _id: int
+    _wheel: TimerWheel
+    _func: Callable
+    _args: tuple
+    _slot: Optional[int]
+    _rounds: int
+    _running: bool
+    _failures: int
+
+    def __init__(self, wheel: TimerWheel, timer_id: int, func: Callable, args: tuple,
+                 interval: Optional[float], jitter: float, name: str) -> None:
+        self.name = name
+        self.interval = interval
+        self.jitter = jitter
+        self.cancelled = False
+        self._id = timer_id
+        self._wheel = wheel
+        self._func = func
+        self._args = args
+        self._slot = None
+        self._rounds = 0
+        self._running = False
+        self._failures = 0
+
+    def cancel(self) -> None:
+        self._wheel.cancel(self)
+
+
+class TimerWheel:
+    """A hashed timer wheel which drives every periodic task of the process.
+
+    Time is cut into ticks of <tick> seconds and tasks are hashed into one of
+    <slots> buckets by their due tick, so registering and cancelling a task are
+    both O(1). A single driver thread advances the wheel and hands due tasks to
+    a small fixed pool of workers.
+
+    A periodic task is registered again after each run. If its callback returns
+    False it stops, and if it returns a number that number is used as the delay
+    until its next run. If its callback raises, the delay doubles after every
+    consecutive failure and it is cancelled after <MAX_FAILURES> of them.
+
+    === Public Attributes ===
+    tick: length of one tick in seconds.
+    slots: number of buckets of the wheel.
+    workers: number of workers running callbacks.
+
+    === Private Attributes ===
+    _buckets: list of buckets, each a dictionary which key is timer id.
+    _cursor: index of the bucket processed by the next tick.
+    _ids: counter used to generate timer ids.
+    _lock: lock guarding <_buckets> and <_cursor>.
+    _idle: condition on <_lock> notified when a callback finishes.
+    _busy: number of callbacks being run.
+    _executor: the worker pool running due callbacks.
+    _stopped: event set when the wheel is stopped.
+    _driver: the thread advancing the wheel.
+    """
+    tick: float
+    slots: int
+    workers: int
+
+    _buckets: list[dict[int, Timer]]
+    _cursor: int
+    _ids: count
+    _lock: Lock
+    _idle: Condition
+    _busy: int
+    _executor: ThreadPoolExecutor
+    _stopped: Event
+    _driver: Thread
+
+    MAX_FAILURES = 5
+
+    def __init__(self, tick: float = 0.5, slots: int = 512, workers: int = 8) -> None:
+        self.tick = tick
+        self.slots = slots
+        self.workers = workers
+        self._buckets = [{} for _ in range(slots)]
+        self._cursor = 0
+        self._ids = count()
+        self._lock = Lock()
+        self._idle = Condition(self._lock)
+        self._busy = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="TimerWheel")
+        self._stopped = Event()
+        self._driver = Thread(target=self._run, name="TimerWheel", daemon=True)
+        self._driver.start()
+
+    def call_later(self, delay: float, func: Callable, *args,
+                   jitter: float = 0, name: str = "") -> Timer:
+        """Run <func> once after <delay> seconds.
+        """
+        timer = Timer(self, next(self._ids), func, args, None, jitter, name or func.__name__)
+        self._insert(timer, delay)
+        return timer
+
+    def call_every(self, interval: float, func: Callable, *args,
+                   delay: Optional[float] = None, jitter: float = 0, name: str = "") -> Timer:
+        """Run <func> every <interval> seconds, first after <delay> seconds.
+        A random delay in [0, <jitter>) is added to every run to spread load.
+        """
+        timer = Timer(self, next(self._ids), func, args, interval, jitter, name or func.__name__)
+        self._insert(timer, interval if delay is None else delay)
+        return timer
+
+    def cancel(self, timer: Timer) -> None:
+        with self._lock:
+            timer.cancelled = True
+            if timer._slot is not None:
+                self._buckets[timer._slot].pop(timer._id, None)
+                timer._slot = None
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self._buckets)
+
+    def _insert(self, timer: Timer, delay: float) -> None:
+        if timer.jitter > 0:
+            delay += random.uniform(0, timer.jitter)
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self._lock:
+            if timer.cancelled:
+                return
+            # The bucket at <_cursor> is the next one to fire, i.e. one tick ahead.
+            timer._slot = (self._cursor + ticks - 1) % self.slots
+            timer._rounds = (ticks - 1) // self.slots
+            self._buckets[timer._slot][timer._id] = timer
+
+    def _advance(self) -> list[Timer]:
+        due = []
+        with self._lock:
+            bucket = self._buckets[self._cursor]
+            for timer_id, timer in list(bucket.items()):
+                if timer._rounds > 0:
+                    timer._rounds -= 1
+                    continue
+                del bucket[timer_id]
+                timer._slot = None
+                due.append(timer)
+            self._cursor = (self._cursor + 1) % self.slots
+        return due
+
+    def _run(self) -> None:
+        next_tick = time.monotonic() + self.tick
+        while not self._stopped.wait(max(0.0, next_tick - time.monotonic())):
+            # Catch up on every tick missed while the driver was late.
+            while next_tick <= time.monotonic():
+                for timer in self._advance():
+                    self._executor.submit(self._execute, timer)
+                next_tick += self.tick
+
+    def _execute(self, timer: Timer) -> None:
+        with self._lock:
+            if timer.cancelled:
+                return
+            timer._running = True
+            self._busy += 1
+        try:
+            result: Any = timer._func(*timer._args)
+        except:
+            timer._failures += 1
+            print(f"[TimerWheel] task {timer.name} failed {timer._failures} times in a row.")
+            print(traceback.format_exc())
+            if timer._failures >= self.MAX_FAILURES:
+                print(f"[TimerWheel] task {timer.name} cancelled.")
+                result = False
+            else:
+                result = None if timer.interval is None else timer.interval * 2 ** (timer._failures - 1)
+        else:
+            timer._failures = 0
+        finally:
+            with self._idle:
+                timer._running = False
+                self._busy -= 1
+                self._idle.notify_all()
+        if timer.interval is None or result is False:
+            timer.cancelled = True
+            return
+        delay = timer.interval if result is None or result is True else result
+        self._insert(timer, delay)
+
+    def wait(self, timers: Iterable[Timer], timeout: Optional[float] = None) -> bool:
+        """Block until no callback of <timers> is running, at most <timeout> seconds.
+        Cancel the timers first so they are not started again.
+        Return whether every callback finished.
+        """
+        timers = list(timers)
+        with self._idle:
+            return self._idle.wait_for(lambda: not any(timer._running for timer in timers), timeout)
+
+    def collect(self) -> list[tuple[str, dict[str, Any], float]]:
+        """Return gauges of scheduled timers and of busy workers.
+        """
+        return [("timer_wheel_timers", {}, len(self)),
+                ("workers_busy", {"pool": "TimerWheel"}, self._busy),
+                ("workers_max", {"pool": "TimerWheel"}, self.workers)]
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._driver.join()
+        self._executor.shutdown(wait=False)
+
+
+_wheel: Optional[TimerWheel] = None
+_wheel_lock = Lock()
+
+
+def get_wheel() -> TimerWheel:
+    """Return the process-wide TimerWheel instance, starting it on first use.
+    """
+    global _wheel
+    if _wheel is None:
+        with _wheel_lock:
+            if _wheel is None:
+                _wheel = TimerWheel()
+                get_metrics().register("TimerWheel", _wheel.collect)
+    return _wheel
@@ -0,0 +1,5 @@
+from .Metrics import Metrics, get_metrics
+from .RateLimiter import RateLimiter, TokenBucket, get_limiter, set_limiter
+from .HttpPool import HttpPool, get_pool, set_pool
+from .TimerWheel import Timer, TimerWheel, get_wheel
+from .ExpiryIndex import ExpiryIndex
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import heapq
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_all
+from collections import Counter
+from itertools import count
+from threading import Condition, Thread
+from typing import Any, Callable, Optional
+
+from Common import get_metrics
+
+
+class DanmakuDispatcher:
+    """Send danmaku of every user from one queue and a small worker pool.
+
+    Danmaku wait in a priority queue ordered by due time. A danmaku is only
+    sent once its user has not sent for <user_spacing> seconds and its room
+    has not received one for <room_spacing> seconds, otherwise it is queued
+    again for the moment both allow it. Failed sends are retried with
+    exponential backoff up to <max_retries> times. Account and endpoint rate
+    limits are left to the shared RateLimiter of the http pool.
+
+    === Public Attributes ===
+    user_spacing: min seconds between two danmaku of one user.
+    room_spacing: min seconds between two danmaku to one room.
+    max_retries: number of retries of a failed danmaku before dropping it.
+    retry_delay: delay before the first retry, doubled on each retry.
+
+    === Private Attributes ===
+    _send: callable sending one danmaku, called with (uid, room_id, content).
+    _queue: heap of (due time, sequence, uid, room_id, content, attempt).
+    _seq: counter breaking ties in <_queue>.
+    _user_next: a dictionary which key is uid and value is when it may send again.
+    _room_next: a dictionary which key is room_id and value is when it may receive again.
+    _cond: condition guarding the state above and waking the scheduler.
+    _executor: the bounded worker pool sending danmaku.
+    _inflight: danmaku being sent by <_executor>.
+    _closed: whether this dispatcher has been closed.
+    _scheduler: the thread popping due danmaku from <_queue>.
+    _workers: number of workers of <_executor>.
+    """
+    user_spacing: float
+    room_spacing: float
+    max_retries: int
+    retry_delay: float
+
+    _send: Callable[[int, int, str], None]
+    _queue: list[tuple[float, int, int, int, str, int]]
+    _seq: count
+    _user_next: dict[int, float]
+    _room_next: dict[int, float]
+    _cond: Condition
+    _executor: ThreadPoolExecutor
+    _inflight: set[Future]
+    _closed: bool
+    _scheduler: Thread
+    _workers: int
+
+    def __init__(self, send: Callable[[int, int, str], None], workers: int = 4,
+                 user_spacing: float = 3, room_spacing: float = 1,
+                 max_retries: int = 3, retry_delay: float = 5) -> None:
+        self.user_spacing = user_spacing
+        self.room_spacing = room_spacing
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._send = send
+        self._queue = []
+        self._seq = count()
+        self._user_next = {}
+        self._room_next = {}
+        self._cond = Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="DanmakuDispatcher")
+        self._workers = workers
+        self._inflight = set()
+        self._closed = False
+        self._scheduler = Thread(target=self._run, name="DanmakuDispatcher", daemon=True)
+        self._scheduler.start()
+
+    def put(self, uid: int, room_id: int, content: str, delay: float = 0) -> None:
+        """Queue danmaku <content> of user <uid> to room <room_id>.
+        """
+        self._push(time.monotonic() + delay, uid, room_id, content, 0)
+
+    def _push(self, due: float, uid: int, room_id: int, content: str, attempt: int) -> None:
+        with self._cond:
+            if self._closed:
+                return
+            heapq.heappush(self._queue, (due, next(self._seq), uid, room_id, content, attempt))
+            self._cond.notify()
+
+    def _run(self) -> None:
+        with self._cond:
+            while not self._closed:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                due = self._queue[0][0]
+                if (wait := due - now) > 0:
+                    self._cond.wait(wait)
+                    continue
+                _, _, uid, room_id, content, attempt = heapq.heappop(self._queue)
+                ready = max(self._user_next.get(uid, 0), self._room_next.get(room_id, 0))
+                if ready > now:
+                    heapq.heappush(self._queue, (ready, next(self._seq), uid, room_id, content, attempt))
+                    continue
+                self._user_next[uid] = now + self.user_spacing
+                self._room_next[room_id] = now + self.room_spacing
+                future = self._executor.submit(self._dispatch, uid, room_id, content, attempt)
+                self._inflight.add(future)
+                future.add_done_callback(self._inflight.discard)
+
+    def _dispatch(self, uid: int, room_id: int, content: str, attempt: int) -> None:
+        try:
+            self._send(uid, room_id, content)
+            get_metrics().inc("danmaku_total", result="sent")
+        except:
+            print(traceback.format_exc())
+            if attempt >= self.max_retries:
+                print(f"[DanmakuDispatcher] drop danmaku of {uid} to room {room_id} "
+                      f"after {attempt + 1} attempts.")
+                get_metrics().inc("danmaku_total", result="dropped")
+                return
+            get_metrics().inc("danmaku_total", result="retried")
+            self._push(time.monotonic() + self.retry_delay * 2 ** attempt,
+                       uid, room_id, content, attempt + 1)
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def collect(self) -> list[tuple[str, dict[str, Any], float]]:
+        """Return gauges of queued danmaku of every user and of busy workers.
+        """
+        with self._cond:
+            queued = Counter(item[2] for item in self._queue)
+            inflight = len(self._inflight)
+        gauges = [("danmaku_queue_depth", {"uid": uid}, depth) for uid, depth in queued.items()]
+        gauges.append(("danmaku_queue_total", {}, sum(queued.values())))
+        gauges.append(("workers_busy", {"pool": "DanmakuDispatcher"}, inflight))
+        gauges.append(("workers_max", {"pool": "DanmakuDispatcher"}, self._workers))
+        return gauges
+
+    def close(self, timeout: Optional[float] = 0) -> bool:
+        """Drop queued danmaku and wait at most <timeout> seconds for the ones being
+        sent, None to wait until they are sent. Return whether every send finished.
+        """
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._cond.notify_all()
+            inflight = list(self._inflight)
+        _, pending = wait_all(inflight, timeout)
+        self._executor.shutdown(wait=False)
+        return not pending
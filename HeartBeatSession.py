@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import time
+from threading import Lock
+from typing import Any, Iterable, Iterator, Optional
+
+from Common import Timer
+
+
+class HeartBeatSession:
+    """State of the heartbeats of one user in one room.
+
+    === Public Attributes ===
+    uid: the uid of the user.
+    room_id: real room id of the room.
+    closed: whether the heartbeats of this session have been stopped.
+    seq: number of X heartbeat sent.
+    started: unix time this session was opened.
+    web_interval: interval until the next webHeartBeat.
+    buvid: device id sent with X heartbeat, or None before E heartbeat.
+    uuid: device uuid sent with X heartbeat, or None before E heartbeat.
+    ets: unix time of the last E or X heartbeat.
+    interval: interval until the next X heartbeat.
+    secret_key: key issued by the last E or X heartbeat, or None before E heartbeat.
+    secret_rule: rules issued by the last E or X heartbeat.
+    timers: the timers of the heartbeat workers of this session, not exported.
+    """
+    __slots__ = ("uid", "room_id", "closed", "seq", "started", "web_interval",
+                 "buvid", "uuid", "ets", "interval", "secret_key", "secret_rule", "timers")
+
+    uid: int
+    room_id: int
+    closed: bool
+    seq: int
+    started: float
+    web_interval: int
+    buvid: Optional[str]
+    uuid: Optional[str]
+    ets: int
+    interval: int
+    secret_key: Optional[str]
+    secret_rule: list[int]
+    timers: list[Timer]
+
+    EXPORTED = ("uid", "room_id", "closed", "seq", "started", "web_interval",
+                "buvid", "uuid", "ets", "interval", "secret_key", "secret_rule")
+
+    def __init__(self, uid: int, room_id: int) -> None:
+        self.uid = uid
+        self.room_id = room_id
+        self.closed = False
+        self.seq = 0
+        self.started = time.time()
+        self.web_interval = 60
+        self.buvid = self.uuid = self.secret_key = None
+        self.ets = 0
+        self.interval = 60
+        self.secret_rule = []
+        self.timers = []
+
+    @property
+    def handshaken(self) -> bool:
+        """Return whether E heartbeat has been sent, so X heartbeat can continue.
+        """
+        return self.secret_key is not None
+
+    def to_dict(self) -> dict[str, Any]:
+        return {name: getattr(self, name) for name in self.EXPORTED}
+
+    @classmethod
+    def from_dict(cls, record: dict[str, Any]) -> HeartBeatSession:
+        session = cls(record["uid"], record["room_id"])
+        for name in cls.EXPORTED:
+            if name in record:
+                setattr(session, name, record[name])
+        return session
+
+
+class SessionRegistry:
+    """Registry of every heartbeat session, keyed by (uid, room_id).
+
+    Sessions are also indexed by room, so closing a room is proportional to the
+    number of users in it. Every lookup is O(1).
+
+    === Private Attributes ===
+    _sessions: a dictionary which key is (uid, room_id) and value is its session.
+    _rooms: a dictionary which key is room_id and value is a dictionary which key is uid
+        and value is its session.
+    _lock: lock guarding the state above.
+    """
+    _sessions: dict[tuple[int, int], HeartBeatSession]
+    _rooms: dict[int, dict[int, HeartBeatSession]]
+    _lock: Lock
+
+    def __init__(self) -> None:
+        self._sessions = {}
+        self._rooms = {}
+        self._lock = Lock()
+
+    def _insert(self, session: HeartBeatSession) -> None:
+        self._sessions[(session.uid, session.room_id)] = session
+        self._rooms.setdefault(session.room_id, {})[session.uid] = session
+
+    def open(self, uid: int, room_id: int) -> Optional[HeartBeatSession]:
+        """Open a new session of <uid> in <room_id>, replacing a closed one.
+        Return None if a session of that pair is already running.
+        """
+        with self._lock:
+            session = self._sessions.get((uid, room_id))
+            if session is not None and not session.closed:
+                return None
+            session = HeartBeatSession(uid, room_id)
+            self._insert(session)
+            return session
+
+    def get(self, uid: int, room_id: int) -> Optional[HeartBeatSession]:
+        return self._sessions.get((uid, room_id))
+
+    def in_room(self, room_id: int) -> list[HeartBeatSession]:
+        with self._lock:
+            return list(self._rooms.get(room_id, {}).values())
+
+    def close(self, uid: int, room_id: int) -> None:
+        if (session := self._sessions.get((uid, room_id))) is not None:
+            session.closed = True
+
+    def close_room(self, room_id: int) -> None:
+        """Close the session of every user in <room_id>.
+        """
+        for session in self.in_room(room_id):
+            session.closed = True
+
+    def discard(self, session: HeartBeatSession) -> None:
+        """Remove <session> if it is still the session of its pair, so a session
+        opened again for the same pair is kept.
+        """
+        with self._lock:
+            if self._sessions.get((session.uid, session.room_id)) is not session:
+                return
+            del self._sessions[(session.uid, session.room_id)]
+            room = self._rooms[session.room_id]
+            del room[session.uid]
+            if not room:
+                del self._rooms[session.room_id]
+
+    def running(self) -> list[HeartBeatSession]:
+        with self._lock:
+            return [session for session in self._sessions.values() if not session.closed]
+
+    def snapshot(self, running_only: bool = True) -> list[dict[str, Any]]:
+        """Return every session, or only the running ones, as plain dictionaries.
+        """
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return [session.to_dict() for session in sessions
+                if not running_only or not session.closed]
+
+    def restore(self, records: Iterable[dict[str, Any]]) -> list[HeartBeatSession]:
+        """Load sessions from <records> returned by <snapshot>, replacing sessions
+        of the same pair. Return the restored sessions.
+        """
+        restored = [HeartBeatSession.from_dict(record) for record in records]
+        with self._lock:
+            for session in restored:
+                self._insert(session)
+        return restored
+
+    def __contains__(self, key: tuple[int, int]) -> bool:
+        return key in self._sessions
+
+    def __iter__(self) -> Iterator[HeartBeatSession]:
+        return iter(list(self._sessions.values()))
+
+    def __len__(self) -> int:
+        return len(self._sessions)
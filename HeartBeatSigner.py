@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import hashlib
+import hmac
+from functools import lru_cache
+from typing import Callable
+
+
+class HeartBeatSigner:
+    """Signer of X heartbeat built once for a (secret_key, secret_rule) pair.
+
+    Every rule of <secret_rule> is compiled into HMAC templates whose inner and
+    outer states are already keyed, so signing only copies a template and
+    feeds the data instead of rebuilding HMAC objects for every step.
+
+    === Public Attributes ===
+    key: secret_key returned by E or X heartbeat.
+    rules: secret_rule returned by E or X heartbeat.
+
+    === Private Attributes ===
+    _steps: flat list of callables, each returning a fresh keyed HMAC of one step.
+    """
+    __slots__ = ("key", "rules", "_steps")
+
+    key: str
+    rules: tuple[int, ...]
+    _steps: list[Callable]
+
+    _DIGESTS = {
+        0: (hashlib.md5, hashlib.md5),
+        1: (hashlib.sha1,),
+        2: (hashlib.sha256,),
+        3: (hashlib.sha224,),
+        4: (hashlib.sha512,),
+        5: (hashlib.sha384,),
+    }
+
+    def __init__(self, key: str, rules: tuple[int, ...]) -> None:
+        self.key = key
+        self.rules = rules
+        key_bytes = key.encode(encoding="utf-8")
+        templates = {}
+        self._steps = []
+        for rule in rules:
+            for digest in self._DIGESTS.get(rule, ()):
+                if digest not in templates:
+                    templates[digest] = hmac.new(key=key_bytes, digestmod=digest)
+                self._steps.append(templates[digest].copy)
+
+    def sign(self, parsed_data: str) -> str:
+        data = parsed_data.encode(encoding="utf-8")
+        for step in self._steps:
+            mac = step()
+            mac.update(data)
+            data = mac.hexdigest().encode(encoding="utf-8")
+        return data.decode(encoding="utf-8")
+
+
+@lru_cache(maxsize=4096)
+def _cached_signer(key: str, rules: tuple[int, ...]) -> HeartBeatSigner:
+    return HeartBeatSigner(key, rules)
+
+
+def get_signer(key: str, rules: list[int]) -> HeartBeatSigner:
+    """Return the signer of (<key>, <rules>), shared by every user receiving the same secret.
+    """
+    return _cached_signer(key, tuple(rules))
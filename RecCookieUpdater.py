@@ -1,36 +1,166 @@
+import atexit
 import json
 import os
-import random
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
+from BiliUser import AccountSelector
+from BiliUser.BiliCookie import sessdata_expires
+from BrowserPool import BrowserPool
+from Common import get_pool
 
 URI = "/api/config/global"
+_browser_pool = None
+_selector = AccountSelector()
+_sessdata = {}
+_assignment = {}
+UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
+
+
+class AccountError(Exception):
+    """Raised when the cookie of an account is rejected by bilibili.
+    """
 
 
 def get_config(host):
-    return requests.get(host + URI).json()
+    return get_pool().get(host + URI).json()
 
 
-def fetch_cookie(f_path):
+def load_accounts(f_path):
+    """Read cookies.json and sync the account health table with it.
+    Return a dictionary which key is uid and value is its entry.
+    """
     with open(os.path.realpath(f_path), "r", encoding="utf-8") as f:
-        content = f.read()
+        content = json.loads(f.read())
+    accounts = {entry['UID']: entry for entry in content.values()}
+    for uid in list(_sessdata):
+        if uid not in accounts:
+            del _sessdata[uid]
+            _selector.remove(uid)
+    for uid, entry in accounts.items():
+        if _sessdata.get(uid) != entry['SESSDATA']:
+            _sessdata[uid] = entry['SESSDATA']
+            _selector.add(uid, expires=sessdata_expires(entry['SESSDATA']))
+    return accounts
+
+
+def assign_accounts(hosts, accounts):
+    """Give every host its own healthy account.
+    A host keeps its account while the account stays healthy, so its config is
+    only updated when the cookie of that account is refreshed. Other hosts get
+    the healthiest least recently used account not taken yet, accounts are only
+    shared when there are more hosts than healthy accounts.
+    """
+    assignment = {host: _assignment[host] for host in hosts
+                  if _assignment.get(host) in accounts and _selector.is_healthy(_assignment[host])}
+    used = set(assignment.values())
+    for host in hosts:
+        if host in assignment:
+            continue
+        if (uid := _selector.select(exclude=used)) is None and (uid := _selector.select()) is None:
+            raise ValueError("cookies.json contains no healthy account")
+        assignment[host] = uid
+        used.add(uid)
+    _assignment.update(assignment)
+    return {host: accounts[assignment[host]] for host in hosts}
+
+
+def fetch_cookie(content, use_selenium=False):
+    if use_selenium:
+        cookie = fetch_cookie_selenium(content)
+    else:
+        cookie = fetch_cookie_http(content)
+    check_login(content, cookie)
+    return cookie
+
+
+def check_login(content, cookie):
+    """Raise AccountError if <cookie> of account <content> is not logged in.
+    """
+    headers = {"cookie": cookie, "user-agent": UA}
+    nav = get_pool().get_json("https://api.bilibili.com/x/web-interface/nav", headers=headers)
+    if nav["code"] == -101 or not nav.get("data", {}).get("isLogin", True):
+        raise AccountError(f"account {content['UID']} is not logged in, {nav}")
+
+
+def parse_cookie(value):
+    cookie_dict = {}
+    for item in value.split(";"):
+        key, sep, val = item.strip().partition("=")
+        if sep:
+            cookie_dict[key] = val
+    return cookie_dict
+
+
+def is_current(cur_config, content):
+    """Return whether the cookie in <cur_config> already logs in as <content>.
+    Visitor cookies such as buvid3 differ on every fetch and are not compared.
+    """
+    optional = cur_config.get("optionalCookie") or {}
+    if not optional.get("hasValue"):
+        return False
+    cookie_dict = parse_cookie(optional.get("value") or "")
+    return (cookie_dict.get("SESSDATA") == content['SESSDATA']
+            and cookie_dict.get("bili_jct") == content['bili_jct']
+            and cookie_dict.get("DedeUserID") == str(content['UID']))
+
+
+def fetch_cookie_http(content):
+    """Build the cookie string of account <content> without a browser.
+    Cookies the homepage sets for a new visitor (buvid3, b_nut) are taken from
+    its Set-Cookie headers, and buvid4 from the fingerprint API.
+    """
+    cookie_dict = {
+        "SESSDATA": content['SESSDATA'],
+        "bili_jct": content['bili_jct'],
+        "DedeUserID__ckMd5": content['DedeUserID__ckMd5'],
+        "DedeUserID": str(content['UID']),
+        "sid": content['sid'],
+    }
+    headers = {
+        "cookie": "; ".join([f"{key}={cookie_dict[key]}" for key in cookie_dict]),
+        "user-agent": UA,
+        "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    }
+    response = get_pool().get("https://www.bilibili.com/", headers=headers)
+    cookie_dict.update(response.cookies.get_dict())
+    headers["cookie"] = "; ".join([f"{key}={cookie_dict[key]}" for key in cookie_dict])
+    spi = get_pool().get_json("https://api.bilibili.com/x/frontend/finger/spi",
+                              headers=headers)
+    if spi["code"] == 0:
+        cookie_dict.setdefault("buvid3", spi["data"]["b_3"])
+        cookie_dict.setdefault("buvid4", spi["data"]["b_4"])
+    print("; ".join([f"{key}={cookie_dict[key]}" for key in cookie_dict]))
+    return "; ".join([f"{key}={cookie_dict[key]}" for key in cookie_dict])
+
 
-    content = json.loads(content)
-    content = content[random.choice(list(content.keys()))]
+def new_driver():
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
 
     opts = Options()
     opts.add_argument("--headless=new")
     opts.add_argument("--no-sandbox")
     opts.add_argument("--disable-dev-shm-usage")  # 避免容器共享内存问题
     opts.add_argument("--disable-blink-features=AutomationControlled")
-    opts.add_argument(
-        "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36")
+    opts.add_argument(f"user-agent={UA}")
     opts.add_experimental_option("excludeSwitches", ["enable-automation"])
     opts.add_experimental_option("useAutomationExtension", False)
-    driver = webdriver.Chrome(options=opts)
+    return webdriver.Chrome(options=opts)
+
+
+def get_browser_pool():
+    global _browser_pool
+    if _browser_pool is None:
+        _browser_pool = BrowserPool(new_driver)
+        atexit.register(_browser_pool.close)
+    return _browser_pool
+
+
+def fetch_cookie_selenium(content):
+    import requests
+
     cookies_list = [
         {
             "name": "SESSDATA",
@@ -73,41 +203,110 @@ def fetch_cookie(f_path):
             "sameSite": "None"
         }
     ]
-    driver.execute_cdp_cmd("Network.enable", {})
-
-    for cookie in cookies_list:
-        # 确保将 expiry ➜ expires
-        if 'expiry' in cookie:
-            cookie['expires'] = cookie['expiry']
-            del cookie['expiry']
-        driver.execute_cdp_cmd("Network.setCookie", cookie)
-
-    driver.execute_cdp_cmd("Network.disable", {})
-    driver.get("https://www.bilibili.com/")
-    session = requests.Session()
-    for c in driver.get_cookies():
-        session.cookies.set(c['name'], c['value'], domain=c['domain'])
-    cookie_dict = session.cookies.get_dict()
-    print("; ".join([f"{key}={cookie_dict[key]}" for key in cookie_dict]))
-    # driver.get("https://api.bilibili.com/x/web-interface/nav")
-    # print(driver.page_source)
-    driver.quit()
-    return "; ".join([f"{key}={cookie_dict[key]}" for key in cookie_dict])
+    with get_browser_pool().acquire() as driver:
+        driver.execute_cdp_cmd("Network.enable", {})
+
+        for cookie in cookies_list:
+            # 确保将 expiry ➜ expires
+            if 'expiry' in cookie:
+                cookie['expires'] = cookie['expiry']
+                del cookie['expiry']
+            driver.execute_cdp_cmd("Network.setCookie", cookie)
 
+        driver.execute_cdp_cmd("Network.disable", {})
+        driver.get("https://www.bilibili.com/")
+        session = requests.Session()
+        for c in driver.get_cookies():
+            session.cookies.set(c['name'], c['value'], domain=c['domain'])
+        cookie_dict = session.cookies.get_dict()
+        print("; ".join([f"{key}={cookie_dict[key]}" for key in cookie_dict]))
+        # driver.get("https://api.bilibili.com/x/web-interface/nav")
+        # print(driver.page_source)
+        return "; ".join([f"{key}={cookie_dict[key]}" for key in cookie_dict])
 
-def update_config(host, f_path):
+
+def update_config(host, content, use_selenium=False):
+    """Put the cookie of account <content> into the recorder at <host>.
+    Return "unchanged" if the recorder already uses it, "updated" otherwise.
+    """
     cur_config = get_config(host)
+    if is_current(cur_config, content):
+        return "unchanged"
+    try:
+        cookie = fetch_cookie(content, use_selenium)
+    except AccountError:
+        # Only a rejected account counts against it, not network or recorder errors.
+        _selector.report(content['UID'], False)
+        raise
+    _selector.report(content['UID'], True)
     cur_config["optionalCookie"]["hasValue"] = True
-    cur_config["optionalCookie"]["value"] = fetch_cookie(f_path)
+    cur_config["optionalCookie"]["value"] = cookie
     headers = {
         "Accept": "*/*",
         "Content-Type": "application/json",
     }
     cur_config = json.dumps(
         cur_config, ensure_ascii=False, separators=(",", ":"))
-    assert requests.post(host + URI, data=cur_config,
-                         headers=headers).status_code, 200
-    print("Update success")
+    response = get_pool().post(host + URI, data=cur_config, headers=headers)
+    response.raise_for_status()
+    return "updated"
+
+
+def _update_host(host, content, use_selenium):
+    start = time.perf_counter()
+    try:
+        status = update_config(host, content, use_selenium)
+    except Exception as e:
+        status = f"failed: {e!r}"
+    return host, content['UID'], status, time.perf_counter() - start
+
+
+def update_all(hosts, f_path, use_selenium=False, workers=16):
+    """Update every recorder in <hosts> concurrently and print a report.
+    Return a list of (host, uid, status, latency in seconds).
+    """
+    assignment = assign_accounts(hosts, load_accounts(f_path))
+    with ThreadPoolExecutor(max_workers=min(workers, len(hosts))) as executor:
+        report = list(executor.map(lambda host: _update_host(host, assignment[host], use_selenium),
+                                   hosts))
+    width = max(len(host) for host in hosts)
+    for host, uid, status, latency in report:
+        print(f"{host:<{width}}  uid={uid:<12} {latency * 1000:8.1f} ms  {status}")
+    updated = sum(1 for item in report if item[2] == "updated")
+    failed = sum(1 for item in report if item[2].startswith("failed"))
+    print(f"{len(report)} hosts: {updated} updated, "
+          f"{len(report) - updated - failed} unchanged, {failed} failed")
+    return report
+
+
+def read_hosts(path):
+    """Read hosts from <path>, one per line. Blank lines and lines starting
+    with # are ignored.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def parse_args(argv):
+    """Return (hosts, use_selenium) given on the command line <argv>.
+    Raise ValueError if an option misses its value.
+    """
+    hosts = []
+    use_selenium = False
+    i = 0
+    while i < len(argv):
+        if argv[i] == "--selenium":
+            use_selenium = True
+        elif argv[i] == "--hosts-file":
+            if i + 1 == len(argv):
+                raise ValueError("--hosts-file needs a file")
+            i += 1
+            hosts.extend(read_hosts(argv[i]))
+        else:
+            hosts.append(argv[i])
+        i += 1
+    return list(dict.fromkeys(host.rstrip("/") for host in hosts)), use_selenium
 
 
 def main():
@@ -119,20 +318,28 @@ def main():
         f_path = os.path.join(os.path.abspath(__compiled__.containing_dir),
                               "cookies.json")
         if len(sys.argv) < 2:
-            print("Usage: .\RecCookieupdater.exe host ...")
+            print("Usage: .\RecCookieupdater.exe host [host ...] [--hosts-file file] [--selenium]")
             input()
             return
     except NameError:
         f_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                               "cookies.json")
         if len(sys.argv) < 2:
-            print("Usage: python3 RecCookieupdater.py host ...")
+            print("Usage: python3 RecCookieupdater.py host [host ...] [--hosts-file file] [--selenium]")
             return
 
-    host = sys.argv[1]
+    try:
+        hosts, use_selenium = parse_args(sys.argv[1:])
+    except ValueError as e:
+        print(e)
+        print(f"Usage: {sys.argv[0]} host [host ...] [--hosts-file file] [--selenium]")
+        return
+    if not hosts:
+        print("No host given")
+        return
     scheduler = BlockingScheduler()
-    scheduler.add_job(update_config, args=(host, f_path),
-                      misfire_grace_time=3600, max_instances=10,
+    scheduler.add_job(update_all, args=(hosts, f_path, use_selenium),
+                      misfire_grace_time=3600, max_instances=1, coalesce=True,
                       trigger=IntervalTrigger(hours=1),
                       next_run_time=datetime.now())
     scheduler.start()
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import traceback
+from threading import Lock
+from typing import Callable, Optional
+
+from Common import Timer, get_pool, get_wheel
+
+Listener = Callable[[frozenset, frozenset], None]
+
+
+class RoomDiscovery:
+    """A single poller of the fishing room list shared by every user.
+
+    The list is fetched once per interval no matter how many users listen, and
+    each listener is called with (added rooms, removed rooms) when it changes.
+    A new listener first receives every known room as added. The interval
+    grows by <backoff> while the list stays the same or the request fails, up
+    to <max_interval>, and goes back to <interval> as soon as it changes.
+
+    === Public Attributes ===
+    url: url of the fishing list.
+    interval: poll interval while the list changes.
+    max_interval: longest poll interval.
+    backoff: factor applied to the interval after a poll without change.
+
+    === Private Attributes ===
+    _rooms: rooms found by the last successful poll.
+    _listeners: callables notified with (added, removed).
+    _delay: current poll interval.
+    _etag: ETag of the last response, sent back as If-None-Match.
+    _timer: the timer polling the list, or None while nobody listens.
+    _lock: lock guarding the state above.
+    """
+    url: str
+    interval: float
+    max_interval: float
+    backoff: float
+
+    _rooms: frozenset
+    _listeners: list[Listener]
+    _delay: float
+    _etag: Optional[str]
+    _timer: Optional[Timer]
+    _lock: Lock
+
+    def __init__(self, interval: float = 10, max_interval: float = 60, backoff: float = 1.5,
+                 url: str = "https://api.live.bilibili.com/xlive/virtual-interface/v1/app/detail?app_id=1659814658645") -> None:
+        self.url = url
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._rooms = frozenset()
+        self._listeners = []
+        self._delay = interval
+        self._etag = None
+        self._timer = None
+        self._lock = Lock()
+
+    @property
+    def rooms(self) -> frozenset:
+        return self._rooms
+
+    def subscribe(self, listener: Listener) -> None:
+        """Call <listener> with (added, removed) every time the room list changes.
+        Polling starts with the first listener.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+            rooms = self._rooms
+            if self._timer is None:
+                self._delay = self.interval
+                self._timer = get_wheel().call_every(self.interval, self._poll, delay=0,
+                                                     name="RoomDiscovery")
+        if rooms:
+            self._call(listener, rooms, frozenset())
+
+    def unsubscribe(self, listener: Listener) -> None:
+        """Stop notifying <listener>. Polling stops with the last listener.
+        """
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+            if not self._listeners and self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _fetch(self) -> Optional[frozenset]:
+        """Return rooms currently in the list, or None if it did not change.
+        """
+        headers = {
+            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36"
+        }
+        if self._etag is not None:
+            headers["if-none-match"] = self._etag
+        response = get_pool().get(self.url, headers=headers)
+        if response.status_code == 304:
+            return None
+        self._etag = response.headers.get("etag")
+        fishing_list = response.json()["data"]["is_using_anchors"]
+        return frozenset(map(lambda x: x["room_id"], fishing_list))
+
+    def poll(self) -> tuple[frozenset, frozenset]:
+        """Fetch the list once, notify listeners and return (added, removed).
+        """
+        rooms = self._fetch()
+        with self._lock:
+            if rooms is None or rooms == self._rooms:
+                return frozenset(), frozenset()
+            added, removed = rooms - self._rooms, self._rooms - rooms
+            self._rooms = rooms
+            listeners = list(self._listeners)
+        for listener in listeners:
+            self._call(listener, added, removed)
+        return added, removed
+
+    def _poll(self) -> float:
+        """Poll the list and return the delay until the next poll.
+        This method runs on the timer wheel.
+        """
+        try:
+            added, removed = self.poll()
+            changed = bool(added or removed)
+        except:
+            print(traceback.format_exc())
+            changed = False
+        with self._lock:
+            if changed:
+                self._delay = self.interval
+            else:
+                self._delay = min(self.max_interval, self._delay * self.backoff)
+            return self._delay
+
+    @staticmethod
+    def _call(listener: Listener, added: frozenset, removed: frozenset) -> None:
+        try:
+            listener(added, removed)
+        except:
+            print(traceback.format_exc())
+
+
+_discovery: Optional[RoomDiscovery] = None
+_discovery_lock = Lock()
+
+
+def get_discovery() -> RoomDiscovery:
+    """Return the process-wide RoomDiscovery instance, creating it on first use.
+    """
+    global _discovery
+    if _discovery is None:
+        with _discovery_lock:
+            if _discovery is None:
+                _discovery = RoomDiscovery()
+    return _discovery
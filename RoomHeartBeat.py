@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from threading import Event, Lock
+from typing import Any, Callable, Optional, Union
+
+from BiliUser import BiliUser
+from Common import Timer, get_pool, get_wheel
+from HeartBeatSession import HeartBeatSession
+from WebHeartBeat import WebHeartBeat
+
+
+class _RoomTable:
+    """Compact per-room table of the users watching a room.
+
+    Users are stored in a column, <index> maps uid to its row so that lookup,
+    insertion and removal are all O(1). The heartbeat state of every user is
+    kept in its session.
+
+    === Public Attributes ===
+    room_id: real room id of this room.
+    uids: column of uid of every user in this room.
+    index: a dictionary which key is uid and value is its row.
+    web_interval: interval until the next webHeartBeat burst.
+    timers: the timers of feed heartBeat and webHeartBeat bursts.
+    bursts: a dictionary which key is the kind of a burst and value is the sends of
+        its last run.
+    """
+    __slots__ = ("room_id", "uids", "index", "web_interval", "timers", "bursts")
+
+    room_id: int
+    uids: list[int]
+    index: dict[int, int]
+    web_interval: int
+    timers: list[Timer]
+    bursts: dict[str, list[Future]]
+
+    def __init__(self, room_id: int) -> None:
+        self.room_id = room_id
+        self.uids = []
+        self.index = {}
+        self.web_interval = 60
+        self.timers = []
+        self.bursts = {}
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def add(self, uid: int) -> None:
+        if uid in self.index:
+            return
+        self.index[uid] = len(self.uids)
+        self.uids.append(uid)
+
+    def remove(self, uid: int) -> None:
+        """Remove <uid> by moving the last row into its place.
+        """
+        row = self.index.pop(uid)
+        last_uid = self.uids.pop()
+        if row < len(self.uids):
+            self.uids[row] = last_uid
+            self.index[last_uid] = row
+
+
+class RoomHeartBeat(WebHeartBeat):
+    """A heartbeat manager which groups every user watching the same room.
+
+    Feed heartBeat and webHeartBeat of all users in a room are sent together in
+    one aligned burst per room, paced to <burst_rate> requests per second over
+    the pooled connections, so a room costs two timers no matter how many users
+    watch it. Bursts are sent by their own workers, the timers only start them.
+    X heartbeat stays per user since its interval and secret are
+    issued for each session.
+
+    === Public Attributes ===
+    burst_rate: max number of requests sent per second inside a burst.
+
+    === Private Attributes ===
+    _tables: a dictionary which key is room_id and value is its _RoomTable.
+    _burst_executor: a ThreadPoolExecutor instance used to send requests of a burst.
+    _lock: lock guarding <_tables>.
+    _pace_lock: lock guarding <_next_send>.
+    _next_send: the earliest monotonic time the next request of a burst can be sent.
+    """
+    burst_rate: float
+
+    _tables: dict[int, _RoomTable]
+    _burst_executor: ThreadPoolExecutor
+    _lock: Lock
+    _pace_lock: Lock
+    _next_send: float
+
+    def __init__(self, *args: tuple[int], burst_workers: int = 8, burst_rate: float = 20) -> None:
+        super().__init__(*args)
+        self.burst_rate = burst_rate
+        self._tables = {}
+        self._burst_executor = ThreadPoolExecutor(max_workers=burst_workers,
+                                                  thread_name_prefix="RoomHeartBeat")
+        self._lock = Lock()
+        self._pace_lock = Lock()
+        self._next_send = 0
+
+    def _start_heartbeat(self, user: BiliUser, room_id: int, session: HeartBeatSession) -> None:
+        """Add <user> into the room table of <room_id> and start its X heartbeat.
+        """
+        wheel = get_wheel()
+        with self._lock:
+            table = self._tables.get(room_id)
+            new_room = table is None
+            if new_room:
+                table = self._tables[room_id] = _RoomTable(room_id)
+            table.add(user.uid)
+        session.timers = [
+            wheel.call_every(60, self._X_heartbeat, user, room_id, session, delay=self._X_delay(session),
+                             name=f"XHeartBeat_{user.uid}_{room_id}"),
+        ]
+        print(f"[{user.uid}][{room_id}]", "X heartbeat start")
+        if new_room:
+            table.timers = [
+                wheel.call_every(40, self._room_heartbeat, table, delay=0,
+                                 name=f"heartBeat_{room_id}"),
+                wheel.call_every(60, self._room_web_heartbeat, table,
+                                 name=f"webHeartBeat_{room_id}"),
+            ]
+            print(f"[{room_id}]", "room heartBeat start")
+
+    def _is_running(self, user: BiliUser, room_id: int,
+                    session: Optional[HeartBeatSession] = None) -> bool:
+        table = self._tables.get(room_id)
+        return table is not None and user.uid in table.index and \
+            super()._is_running(user, room_id, session)
+
+    def _members(self, table: _RoomTable) -> list[BiliUser]:
+        """Drop finished users from <table> and return the users still running.
+        The table is removed once it is empty.
+        """
+        with self._lock:
+            finished = [uid for uid in table.uids
+                        if uid not in self.users or
+                        not WebHeartBeat._is_running(self, self.users[uid], table.room_id)]
+            for uid in finished:
+                table.remove(uid)
+            if not table and self._tables.get(table.room_id) is table:
+                del self._tables[table.room_id]
+            return [self.users[uid] for uid in table.uids]
+
+    def collect(self) -> list[tuple[str, dict[str, Any], float]]:
+        with self._lock:
+            rooms = len(self._tables)
+        return super().collect() + [("heartbeat_rooms", {"kind": type(self).__name__}, rooms)]
+
+    def _stop_timers(self) -> list[Timer]:
+        timers = super()._stop_timers()
+        with self._lock:
+            for table in self._tables.values():
+                for timer in table.timers:
+                    timer.cancel()
+                timers.extend(table.timers)
+        return timers
+
+    def _drain(self, deadline: float) -> bool:
+        drained = super()._drain(deadline)
+        with self._lock:
+            sends = [future for table in self._tables.values()
+                     for futures in table.bursts.values() for future in futures]
+        return not wait(sends, max(0.0, deadline - time.monotonic())).not_done and drained
+
+    def _pace(self) -> None:
+        """Block until the next request of a burst is allowed by <self.burst_rate>.
+        """
+        with self._pace_lock:
+            now = time.monotonic()
+            send_at = max(now, self._next_send)
+            self._next_send = send_at + 1 / self.burst_rate
+        if send_at > now:
+            self._stopping.wait(send_at - now)
+
+    def _burst(self, table: _RoomTable, kind: str, func: Callable, users: list[BiliUser], *args,
+               done: Optional[Callable[[list[Any]], Any]] = None) -> None:
+        """Call <func> for every user in <users> on the burst workers without waiting
+        for them, then call <done> with their results. The result of a failed call is
+        None and only stops the session of its user, the rest of the room keeps running.
+        The burst is skipped if the last <kind> burst of <table> is still being sent.
+        """
+        if any(not future.done() for future in table.bursts.get(kind, ())):
+            print(f"[{table.room_id}]", f"{kind} burst still running, skipped.")
+            return
+
+        def _send(user: BiliUser) -> Any:
+            while (delay := self._reserve(user)) > 0:
+                if self._stopping.wait(delay):
+                    return None
+            self._pace()
+            if self._stopping.is_set():
+                return None
+            try:
+                with get_pool().prepaid():
+                    return func(user, table.room_id, *args)
+            except:
+                self.sessions.close(user.uid, table.room_id)
+                print(traceback.format_exc())
+                return None
+
+        futures = table.bursts[kind] = [self._burst_executor.submit(_send, user) for user in users]
+        if done is None:
+            return
+        remaining, lock = [len(futures)], Lock()
+
+        def _on_sent(_: Future) -> None:
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            done([None if future.cancelled() else future.result() for future in futures])
+
+        for future in futures:
+            future.add_done_callback(_on_sent)
+
+    def _room_heartbeat(self, table: _RoomTable) -> bool:
+        """Send heartBeat of every user in <table>.
+        This method runs on the timer wheel every 40s until the room is empty.
+        """
+        users = self._members(table)
+        if not users:
+            print(f"[{table.room_id}]", "room heartBeat end")
+            return False
+        self._burst(table, "heartBeat", self._send_heartbeat, users)
+        return True
+
+    def _room_web_heartbeat(self, table: _RoomTable) -> Union[int, bool]:
+        """Send webHeartBeat of every user in <table>.
+        This method runs on the timer wheel until the room is empty and returns the delay until next run,
+        which is updated by the burst once every user has been sent.
+        """
+        users = self._members(table)
+        if not users:
+            print(f"[{table.room_id}]", "room webHeartBeat end")
+            return False
+
+        def _update_interval(intervals: list[Optional[int]]) -> None:
+            if intervals := [interval for interval in intervals if interval is not None]:
+                table.web_interval = min(intervals)
+
+        self._burst(table, "webHeartBeat", self._send_web_heartbeat, users, table.web_interval,
+                    done=_update_interval)
+        return table.web_interval
+
+
+if __name__ == '__main__':
+    w = RoomHeartBeat()
+    w.add_user(178856569)
+    w.set_cookies_by_uid(178856569,
+                         sessdata="",
+                         csrf="",
+                         uid_ckmd5="",
+                         sid="",
+                         refresh_token="")
+    w.add_heartbeat(178856569, 30321760)
+    Event().wait()
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import time
+from concurrent.futures import Future
+from threading import Lock
+from typing import Any, Optional
+
+from Common import get_pool
+
+
+class RoomInfoCache:
+    """A cache of room base info shared by every heartbeat worker.
+
+    Entries expire after <ttl> seconds. Concurrent lookups of the same room are
+    coalesced, so only one get_info request is in flight per room and the other
+    callers wait for its result.
+
+    === Public Attributes ===
+    ttl: number of seconds a cached entry stays valid.
+
+    === Private Attributes ===
+    _entries: a dictionary which key is room_id and value is (expire time, base info).
+    _inflight: a dictionary which key is room_id and value is the pending lookup.
+    _lock: lock guarding <_entries> and <_inflight>.
+    """
+    ttl: float
+
+    _entries: dict[int, tuple[float, dict[str, Any]]]
+    _inflight: dict[int, Future]
+    _lock: Lock
+
+    def __init__(self, ttl: float = 600) -> None:
+        self.ttl = ttl
+        self._entries = {}
+        self._inflight = {}
+        self._lock = Lock()
+
+    def get(self, room_id: int, headers: Optional[dict[str, str]] = None) -> dict[str, Any]:
+        """Return base info of <room_id>, which contains <uid>, <area_id> and <parent_area_id>.
+        """
+        with self._lock:
+            entry = self._entries.get(room_id)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+            future = self._inflight.get(room_id)
+            leader = future is None
+            if leader:
+                future = self._inflight[room_id] = Future()
+        if not leader:
+            return future.result()
+        try:
+            info = self._fetch(room_id, headers)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            with self._lock:
+                self._entries[room_id] = (time.monotonic() + self.ttl, info)
+            future.set_result(info)
+            return info
+        finally:
+            with self._lock:
+                self._inflight.pop(room_id, None)
+
+    @staticmethod
+    def _fetch(room_id: int, headers: Optional[dict[str, str]]) -> dict[str, Any]:
+        info_url = f"https://api.live.bilibili.com/room/v1/Room/get_info?room_id={room_id}"
+        response = get_pool().get_json(info_url, headers=headers)
+        assert response["code"] == 0, f"Error getting room info, {response}"
+        return response["data"]
+
+    def invalidate(self, room_id: int) -> None:
+        with self._lock:
+            self._entries.pop(room_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_cache: Optional[RoomInfoCache] = None
+_cache_lock = Lock()
+
+
+def get_room_info_cache() -> RoomInfoCache:
+    """Return the process-wide RoomInfoCache instance, creating it on first use.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = RoomInfoCache()
+    return _cache
@@ -1,15 +1,15 @@
 from __future__ import annotations
 
-import requests
 import time
-from concurrent.futures import ThreadPoolExecutor
+import traceback
 from datetime import datetime
 from functools import partial
-from queue import Queue
-
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.interval import IntervalTrigger
+from threading import Event
+from typing import Any, Callable
 
+from Common import ExpiryIndex, Timer, get_metrics, get_pool, get_wheel
+from DanmakuDispatcher import DanmakuDispatcher
+from RoomDiscovery import get_discovery
 from WebHeartBeat import WebHeartBeat
 
 
@@ -21,80 +21,136 @@ class DanmakuSender:
     rooms: a dictionary which key is uid and value is a set of rooms.
 
     === Private Attributes ===
-    _executor: a thread pool executor used to send danmaku.
     _heartbeat: instance of WebHeartBeat.
-    _danmu_queue: a queue used to store room id.
-    _scheduler: a BackgroundScheduler instance used to resend danmaku after living.
+    _dispatcher: the dispatcher sending danmaku of every user.
+    _expiry: index of (uid, room_id) pairs removed after living, swept by <_expire>.
+    _listeners: a dictionary which key is uid and value is its room discovery listener.
+    _expire_timer: the timer running <_expire>.
+    _metrics_key: name of this sender in metrics, unique per instance.
     """
     uids: set[int]
     rooms: dict[int, set[int]]
-    _executor: ThreadPoolExecutor
     _heartbeat: WebHeartBeat
-    _danmu_queue: dict[int, Queue]
-    _scheduler: BackgroundScheduler
+    _dispatcher: DanmakuDispatcher
+    _expiry: ExpiryIndex[tuple[int, int]]
+    _listeners: dict[int, Callable]
+    _expire_timer: Timer
+    _metrics_key: str
 
     def __init__(self, *args: tuple[int]) -> None:
         self.uids = set(args)
         self.rooms = {uid: set() for uid in args}
         self._heartbeat = WebHeartBeat()
-        self._heartbeat.on_del_room = partial(
-            self._heartbeat.on_del_room, self.close)
-        self._danmu_queue = {uid: Queue() for uid in args}
-        self._executor = ThreadPoolExecutor()
-        self._scheduler = BackgroundScheduler()
-        self._scheduler.start()
-        for uid in args:
-            self._executor.submit(self.fishing, uid)
+        self._heartbeat.del_room_callback = self.close
+        self._dispatcher = DanmakuDispatcher(self._heartbeat.send_danmaku)
+        self._expiry = ExpiryIndex()
+        self._listeners = {}
+        self._expire_timer = get_wheel().call_every(self._expiry.resolution, self._expire,
+                                                    name="RemoveFishing")
+        self._metrics_key = f"DanmakuSender-{id(self):x}"
+        get_metrics().register(self._metrics_key, self.collect, instance=self._metrics_key)
 
     def add_user(self, *uid: tuple[int]) -> None:
         [self.uids.add(u) for u in uid]
         self._heartbeat.add_user(*uid)
         for i in uid:
             self.rooms[i] = set()
-            self._danmu_queue[i] = Queue()
 
     def set_cookies(self, uid: int, *args, **kwargs) -> None:
         if uid not in self.uids:
             raise ValueError("You should add user first.")
         self._heartbeat.set_cookies_by_uid(uid, *args, **kwargs)
 
+    def resume(self, path: str = "sessions.json", interval: float = 60) -> int:
+        """Checkpoint heartbeat sessions to <path> every <interval> seconds and on
+        shutdown, and start again the sessions saved there by the last run.
+        Rooms of resumed sessions are fished until their 2 hours are over, without
+        sending danmaku again. Call it after adding users and before <self.open>.
+        Return the number of started sessions.
+        """
+        self._heartbeat.enable_checkpoint(path, interval)
+        started = self._heartbeat.resume(path)
+        for session in self._heartbeat.sessions.running():
+            if session.uid not in self.uids or session.room_id in self.rooms[session.uid]:
+                continue
+            self.rooms[session.uid].add(session.room_id)
+            self._expiry.set((session.uid, session.room_id),
+                             max(0.0, 2 * 60 * 60 - (time.time() - session.started)))
+        return started
+
     def open(self, uid: int) -> None:
-        if uid not in self.uids:
+        if uid not in self.uids or uid in self._listeners:
             return
-        self._executor.submit(self.fishing, uid)
-        while True:
-            room_ids = self.get_fishing_list()
-            differences = list(
-                filter(lambda x: x not in self.rooms[uid], room_ids))
-            self._heartbeat.add_heartbeat(uid, *differences)
-            for room_id in differences:
-                self.rooms[uid].add(room_id)
-                self.put_danmaku(uid, room_id)
-            time.sleep(10)
+        self._listeners[uid] = partial(self._update_rooms, uid)
+        get_discovery().subscribe(self._listeners[uid])
+
+    def _update_rooms(self, uid: int, added: frozenset, removed: frozenset) -> None:
+        """Start fishing in newly opened rooms and forget closed ones.
+        This method is called by the shared room discovery when the list changes.
+        """
+        self.close(uid, *removed)
+        self._add_rooms(uid, *added)
+
+    def _add_rooms(self, uid: int, *room_ids) -> None:
+        differences = list(
+            filter(lambda x: x not in self.rooms[uid], room_ids))
+        self._heartbeat.add_heartbeat(uid, *differences)
+        for room_id in differences:
+            self.rooms[uid].add(room_id)
+            self.put_danmaku(uid, room_id)
 
     def put_danmaku(self, uid: int, room_id: int) -> None:
-        self._danmu_queue[uid].put(room_id)
-        self._scheduler.add_job(
-            # func=self._danmu_queue[uid].put,
-            func=self.close,
-            trigger=IntervalTrigger(hours=2),
-            args=(uid, room_id),
-            id=f"RemoveFishing_{uid}_{room_id}",
-            coalesce=True,
-            # next_run_time=datetime.now(),
-            replace_existing=True,
-        )
+        self._dispatcher.put(uid, room_id, "摸鱼")
+        self._expiry.set((uid, room_id), 2 * 60 * 60)
+
+    def _expire(self) -> None:
+        """Close every room which has been fished for 2 hours.
+        This method runs on the timer wheel every <self._expiry.resolution> seconds.
+        """
+        expired = {}
+        for uid, room_id in self._expiry.pop_expired():
+            expired.setdefault(uid, []).append(room_id)
+        for uid, room_ids in expired.items():
+            self.close(uid, *room_ids)
 
     def close(self, uid: int, *room_ids) -> None:
         if uid not in self.uids:
             return
+        closed = set()
         for room_id in room_ids:
             if room_id not in self.rooms[uid]:
                 continue
             self.rooms[uid].remove(room_id)
-            self._scheduler.remove_job(
-                job_id=f"RemoveFishing_{uid}_{room_id}"
-            )
+            closed.add(room_id)
+            self._expiry.discard((uid, room_id))
+        # Rooms still fishing are picked up again, as the next poll used to do.
+        if uid in self._listeners and (still_open := get_discovery().rooms & closed):
+            get_wheel().call_later(get_discovery().interval, self._add_rooms, uid,
+                                   *still_open, name=f"FishingList_{uid}")
+
+    def collect(self) -> list[tuple[str, dict[str, Any], float]]:
+        """Return gauges of the danmaku queue and of the rooms every user is fishing in.
+        """
+        gauges = self._dispatcher.collect()
+        gauges.extend(("fishing_rooms", {"uid": uid}, len(rooms))
+                      for uid, rooms in list(self.rooms.items()))
+        gauges.append(("fishing_expiring", {}, len(self._expiry)))
+        return gauges
+
+    def shutdown(self, timeout: float = 10) -> bool:
+        """Stop fishing, wait at most <timeout> seconds for danmaku and heartbeats
+        being sent and drop the queued ones. Return whether everything finished in time.
+        """
+        deadline = time.monotonic() + timeout
+        for listener in self._listeners.values():
+            get_discovery().unsubscribe(listener)
+        self._listeners.clear()
+        self._expire_timer.cancel()
+        get_metrics().unregister(self._metrics_key)
+        if (limiter := get_pool().limiter) is not None:
+            limiter.wake()
+        sent = self._dispatcher.close(timeout)
+        return self._heartbeat.shutdown(max(0.0, deadline - time.monotonic())) and sent
 
     @staticmethod
     def get_fishing_list() -> list[int]:
@@ -102,17 +158,11 @@ class DanmakuSender:
         headers = {
             "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36"
         }
-        response = requests.get(url, headers=headers).json()
+        response = get_pool().get_json(url, headers=headers)
         fishing_list = response["data"]["is_using_anchors"]
         fishing_list = list(map(lambda x: x["room_id"], fishing_list))
         return fishing_list
 
-    def fishing(self, uid) -> None:
-        while True:
-            room_id = self._danmu_queue[uid].get()
-            self._heartbeat.send_danmaku(uid, room_id, "摸鱼")
-            time.sleep(3)
-
 
 if __name__ == '__main__':
     sender = DanmakuSender()
@@ -124,4 +174,13 @@ if __name__ == '__main__':
                        uid_ckmd5="",
                        sid="",
                        refresh_token="")
+    sender.resume()
     sender.open(uid)
+    try:
+        get_metrics().serve()
+    except:
+        print(traceback.format_exc())
+    try:
+        Event().wait()
+    except KeyboardInterrupt:
+        sender.shutdown()
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from threading import Lock
+from typing import Any, Iterable
+
+
+class SessionCheckpoint:
+    """A file keeping heartbeat sessions across restarts.
+
+    Sessions are written as one JSON document, replaced atomically so a crash
+    while saving never leaves a truncated file. On load, a session keeps its X
+    heartbeat sequence only if its secret key is still valid, that is its last
+    E or X heartbeat is at most its interval plus <grace> seconds old.
+
+    === Public Attributes ===
+    path: path of the checkpoint file.
+    grace: seconds a session may be late on its next X heartbeat and still resume.
+
+    === Private Attributes ===
+    _lock: lock serializing writers of the file.
+    """
+    path: str
+    grace: float
+
+    _lock: Lock
+
+    def __init__(self, path: str, grace: float = 120) -> None:
+        self.path = path
+        self.grace = grace
+        self._lock = Lock()
+
+    def save(self, records: Iterable[dict[str, Any]]) -> int:
+        """Replace the checkpoint with <records> and return their number.
+        """
+        records = list(records)
+        content = json.dumps({"saved": time.time(), "sessions": records},
+                             ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        return len(records)
+
+    def is_valid(self, record: dict[str, Any], now: float) -> bool:
+        """Return whether the server issued key of <record> can still be used.
+        """
+        if record.get("secret_key") is None or not record.get("buvid"):
+            return False
+        return now - record.get("ets", 0) <= record.get("interval", 60) + self.grace
+
+    def load(self) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
+        """Return (sessions which can resume their X sequence, sessions which need
+        a new E heartbeat). Closed sessions are left out.
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                content = json.loads(f.read())
+        except FileNotFoundError:
+            return [], []
+        except ValueError:
+            print(f"[SessionCheckpoint] {self.path} is corrupted, ignored.")
+            return [], []
+        now = time.time()
+        warm, cold = [], []
+        for record in content.get("sessions", []):
+            if record.get("closed"):
+                continue
+            (warm if self.is_valid(record, now) else cold).append(record)
+        return warm, cold
@@ -1,18 +1,23 @@
 from __future__ import annotations
 
+import atexit
 import hashlib
-import hmac
 import json
 import random
-import requests
 import time
 import traceback
 from base64 import b64encode
-from concurrent.futures import ThreadPoolExecutor
-from typing import Any, Callable, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Event, Lock
+from typing import Any, Callable, Iterable, Optional, Union
 from uuid import uuid1
 
 from BiliUser import BiliUser
+from Common import RateLimiter, Timer, get_metrics, get_pool, get_wheel
+from HeartBeatSession import HeartBeatSession, SessionRegistry
+from HeartBeatSigner import get_signer
+from RoomInfoCache import get_room_info_cache
+from SessionCheckpoint import SessionCheckpoint
 
 
 class WebHeartBeat:
@@ -22,255 +27,472 @@ class WebHeartBeat:
     users: 
         a dictionary of BiliUser instances for users need to keep alive, 
         which key is uid and value is BiliUser instance.
-    closed:
-        a dictionary which key is room_id and value is the status of heartbeat worker.
-    num: 
-        number of sent heartbeat
+    sessions:
+        registry of the heartbeat session of every (uid, room_id) pair.
+    del_room_callback:
+        called with (uid, room_id) after a failed heartbeat closed that room, or None.
 
     === Private Attributes ===
-    _executor: 
-        internal ThreadPoolExecutor instance used to send heartbeat requests.
+    _header_cache:
+        a dictionary which key is (uid, room_id) and value is (cookie version, heartbeat headers).
+    _header_templates:
+        a dictionary which key is uid and value is (cookie version, danmaku headers without referer).
+    _pending_danmaku:
+        a dictionary which key is (uid, room_id, content) and value is the send in flight.
+    _danmaku_lock:
+        lock guarding <_pending_danmaku>.
+    _checkpoint:
+        the checkpoint running sessions are saved to, or None if disabled.
+    _checkpoint_timer:
+        the timer saving <_checkpoint>, or None if disabled.
+    _stopping:
+        event set when <self.shutdown> is called, waking workers which wait.
+    _metrics_key:
+        name of this manager in metrics, unique per instance.
     """
     users: dict[int, BiliUser]
-    closed: dict[int, bool]
-    num: dict[int, int]
-    _executor: ThreadPoolExecutor
+    sessions: SessionRegistry
+    del_room_callback: Optional[Callable[[int, int], Any]]
+    _header_cache: dict[tuple[int, int], tuple[int, dict[str, str]]]
+    _header_templates: dict[int, tuple[int, dict[str, str]]]
+    _pending_danmaku: dict[tuple[int, int, str], Future]
+    _danmaku_lock: Lock
+    _checkpoint: Optional[SessionCheckpoint]
+    _checkpoint_timer: Optional[Timer]
+    _stopping: Event
+    _metrics_key: str
 
     def __init__(self, *args: tuple[int]) -> None:
         self.users = {uid: BiliUser(uid) for uid in args}
-        self.closed = {}
-        self.num = {}
-        self._executor = ThreadPoolExecutor()
+        self.sessions = SessionRegistry()
+        self.del_room_callback = None
+        self._header_cache = {}
+        self._header_templates = {}
+        self._pending_danmaku = {}
+        self._danmaku_lock = Lock()
+        self._checkpoint = None
+        self._checkpoint_timer = None
+        self._stopping = Event()
+        self._metrics_key = f"{type(self).__name__}-{id(self):x}"
+        get_metrics().register(self._metrics_key, self.collect, instance=self._metrics_key)
 
     def add_user(self, *uid: tuple[int]) -> None:
         for user_id in uid:
             self.users[user_id] = BiliUser(user_id)
 
     def del_user(self, *uid: tuple[int]) -> None:
+        """Stop refreshing the cookie of every user in <uid> and stop their heartbeats.
+        """
         for user_id in uid:
             self.users[user_id].stop()
+            for session in self.sessions:
+                if session.uid == user_id:
+                    self._stop_session(session)
+            self._header_templates.pop(user_id, None)
+
+    def _stop_session(self, session: HeartBeatSession) -> None:
+        session.closed = True
+        for timer in session.timers:
+            timer.cancel()
+        self.sessions.discard(session)
+        self._header_cache.pop((session.uid, session.room_id), None)
+
+    def _end(self, session: HeartBeatSession, worker: str) -> bool:
+        """Close <session> when its <worker> ends and remove it from the registry,
+        so the pair can be started again. Return False to stop the worker.
+        """
+        print(f"[{session.uid}][{session.room_id}]", f"{worker} end")
+        session.closed = True
+        self.sessions.discard(session)
+        self._header_cache.pop((session.uid, session.room_id), None)
+        return False
+
+    def _stop_timers(self) -> list[Timer]:
+        """Close every session, cancel every heartbeat timer and return them.
+        """
+        timers = []
+        for session in self.sessions:
+            self._stop_session(session)
+            timers.extend(session.timers)
+        if self._checkpoint_timer is not None:
+            self._checkpoint_timer.cancel()
+            timers.append(self._checkpoint_timer)
+        return timers
+
+    def _drain(self, deadline: float) -> bool:
+        """Stop every heartbeat worker and wait until <deadline> for the ones sending.
+        Return whether they all finished.
+        """
+        return get_wheel().wait(self._stop_timers(), max(0.0, deadline - time.monotonic()))
+
+    def collect(self) -> list[tuple[str, dict[str, Any], float]]:
+        """Return gauges of running, handshaken and closed sessions.
+        """
+        kind = type(self).__name__
+        running = handshaken = closed = 0
+        for session in self.sessions:
+            if session.closed:
+                closed += 1
+                continue
+            running += 1
+            handshaken += session.handshaken
+        return [("heartbeat_sessions", {"kind": kind, "state": "running"}, running),
+                ("heartbeat_sessions", {"kind": kind, "state": "handshaken"}, handshaken),
+                ("heartbeat_sessions", {"kind": kind, "state": "closed"}, closed),
+                ("heartbeat_users", {"kind": kind}, len(self.users))]
+
+    def shutdown(self, timeout: float = 10) -> bool:
+        """Stop every heartbeat, wait at most <timeout> seconds for requests in
+        flight and save the running sessions if checkpoint is enabled, so they can
+        be resumed. Return whether every request finished in time.
+        """
+        deadline = time.monotonic() + timeout
+        running = self.sessions.running()
+        self._stopping.set()
+        if (limiter := get_pool().limiter) is not None:
+            limiter.wake()
+        get_metrics().unregister(self._metrics_key)
+        drained = self._drain(deadline)
+        if self._checkpoint is not None:
+            self._checkpoint.save(dict(session.to_dict(), closed=False) for session in running)
+        print(f"[WebHeartBeat] shutdown {'finished' if drained else 'timed out'}, "
+              f"{len(running)} sessions stopped.")
+        return drained
 
     def on_del_room(self, callback: Optional[Callable], *args) -> Any:
         for room_id in args:
-            self.closed[room_id] = True
+            self.sessions.close_room(room_id)
         if callback is not None:
             return callback(*args)
 
+    def _close_room(self, uid: int, room_id: int) -> None:
+        """Close the sessions of every user in <room_id> after a heartbeat of <uid>
+        there failed, and call <self.del_room_callback> if it is set.
+        """
+        self.sessions.close_room(room_id)
+        if self.del_room_callback is not None:
+            self.del_room_callback(uid, room_id)
+
     def set_cookies_by_uid(self, uid: int, *args, **kwargs) -> None:
         if uid not in self.users:
             raise ValueError(f"UID {uid} does not exist in heartbeat manager.")
         self.users[uid].set_cookies(*args, **kwargs)
 
     def add_heartbeat(self, uid: int, *room_ids) -> None:
-        """Add <self._web_heartbeat>, <self._X_heartbeat> and <self._heartbeat> into thread pool.
+        """Start <self._web_heartbeat>, <self._X_heartbeat> and <self._heartbeat> for every room.
         Room id variable <room_id> must be real room id, not short id.
         """
         user = self.users[uid]
         for room_id in room_ids:
-            if room_id in self.closed and not self.closed[room_id]:
+            if (session := self.sessions.open(uid, room_id)) is None:
                 continue
-            self.closed[room_id] = False
-            self.num[uid] = 0
-            self._executor.submit(self._web_heartbeat, user, room_id)
-            print(f"[{uid}][{room_id}]", "webHeartBeat start")
-            self._executor.submit(self._X_heartbeat, user, room_id)
-            print(f"[{uid}][{room_id}]", "X heartbeat start")
-            self._executor.submit(self._heartbeat, user, room_id)
-            print(f"[{uid}][{room_id}]", "heartBeat start")
+            self._start_heartbeat(user, room_id, session)
+
+    def enable_checkpoint(self, path: str = "sessions.json", interval: float = 60) -> None:
+        """Save running sessions to <path> every <interval> seconds and at exit,
+        so <self.resume> can continue them after a restart.
+        """
+        if self._checkpoint_timer is not None:
+            self._checkpoint_timer.cancel()
+        else:
+            atexit.register(self.save_checkpoint)
+        self._checkpoint = SessionCheckpoint(path)
+        self._checkpoint_timer = get_wheel().call_every(interval, self._save_checkpoint,
+                                                        name="SessionCheckpoint")
+
+    def save_checkpoint(self) -> int:
+        """Save running sessions now and return their number.
+        """
+        if self._checkpoint is None or self._stopping.is_set():
+            return 0
+        return self._checkpoint.save(self.sessions.snapshot())
+
+    def _save_checkpoint(self) -> None:
+        """This method runs on the timer wheel every checkpoint interval.
+        """
+        try:
+            self.save_checkpoint()
+        except:
+            print(traceback.format_exc())
+
+    def resume(self, path: str = "sessions.json", spread: float = 30) -> int:
+        """Start again the sessions saved in <path> of users known to this manager.
+        Sessions whose secret key is still valid continue their X heartbeat sequence
+        without E heartbeat once their next one is due, the others start over and
+        keep the time they were first started. Starts are spread evenly over
+        <spread> seconds. Return the number of started sessions.
+        """
+        checkpoint = self._checkpoint if self._checkpoint is not None and \
+            self._checkpoint.path == path else SessionCheckpoint(path)
+        warm, cold = checkpoint.load()
+        sessions = self.sessions.restore(
+            record for record in warm
+            if record["uid"] in self.users and not self._is_running(self.users[record["uid"]], record["room_id"]))
+        resumed = len(sessions)
+        for record in cold:
+            if record["uid"] in self.users and \
+                    (session := self.sessions.open(record["uid"], record["room_id"])) is not None:
+                session.started = record.get("started", session.started)
+                sessions.append(session)
+        wheel = get_wheel()
+        for i, session in enumerate(sessions):
+            wheel.call_later(spread * i / len(sessions), self._start_heartbeat,
+                             self.users[session.uid], session.room_id, session,
+                             name=f"Resume_{session.uid}_{session.room_id}")
+        print(f"[WebHeartBeat] resume {resumed} sessions, restart {len(sessions) - resumed} sessions.")
+        return len(sessions)
+
+    def _start_heartbeat(self, user: BiliUser, room_id: int, session: HeartBeatSession) -> None:
+        """Register the three heartbeat workers of <user> in <room_id> with the timer wheel.
+        """
+        wheel = get_wheel()
+        session.timers = [
+            wheel.call_every(session.web_interval, self._web_heartbeat, user, room_id, session,
+                             name=f"webHeartBeat_{user.uid}_{room_id}"),
+            wheel.call_every(60, self._X_heartbeat, user, room_id, session, delay=self._X_delay(session),
+                             name=f"XHeartBeat_{user.uid}_{room_id}"),
+            wheel.call_every(40, self._heartbeat, user, room_id, session, delay=0,
+                             name=f"heartBeat_{user.uid}_{room_id}"),
+        ]
+        print(f"[{user.uid}][{room_id}]", "webHeartBeat start")
+        print(f"[{user.uid}][{room_id}]", "X heartbeat start")
+        print(f"[{user.uid}][{room_id}]", "heartBeat start")
+
+    @staticmethod
+    def _X_delay(session: HeartBeatSession) -> float:
+        """Return seconds until the next X heartbeat of <session> is due, 0 before
+        E heartbeat, so a resumed session keeps the interval of its last one.
+        """
+        if not session.handshaken:
+            return 0.0
+        return max(0.0, session.ets + session.interval - time.time())
+
+    @staticmethod
+    def _reserve(user: BiliUser, endpoint: str = "heartbeat") -> float:
+        """Take a token of <user> for <endpoint> and return 0 if one is free, otherwise
+        return seconds until one is. Workers on the timer wheel return that delay
+        instead of sleeping, so a throttled limiter never holds a wheel worker.
+        """
+        limiter = get_pool().limiter
+        return 0.0 if limiter is None else limiter.try_acquire(endpoint, user.uid)
+
+    def _is_running(self, user: BiliUser, room_id: int,
+                    session: Optional[HeartBeatSession] = None) -> bool:
+        """Return whether the heartbeats of <user> in <room_id> should continue.
+        If <session> is given, it must still be the session of that pair, so workers
+        of a finished session stop when the pair is started again.
+        """
+        current = self.sessions.get(user.uid, room_id)
+        return current is not None and (session is None or current is session) and \
+            not current.closed and current.seq <= 15
+
+    def _headers(self, user: BiliUser, room_id: int) -> dict[str, str]:
+        """Return headers of heartbeat requests of <user> in <room_id>.
+        The dictionary is shared between calls and rebuilt only when the cookie
+        version changes, so it must not be modified.
+        """
+        snapshot = user.cookie.snapshot
+        cached = self._header_cache.get((user.uid, room_id))
+        if cached is None or cached[0] != snapshot.version:
+            cached = self._header_cache[(user.uid, room_id)] = (snapshot.version, {
+                "cookie": snapshot.cookie_string,
+                "origin": "https://live.bilibili.com",
+                "referer": f"https://live.bilibili.com/{room_id}",
+                "user-agent": user.cookie.ua,
+            })
+        return cached[1]
 
     # https://github.com/SocialSisterYi/bilibili-API-collect/issues/343
-    def _web_heartbeat(self, user: BiliUser, room_id: int) -> None:
+    def _web_heartbeat(self, user: BiliUser, room_id: int, session: HeartBeatSession) -> Union[int, bool]:
         """Send webHeartBeat.
-        This method should keep executing.
+        This method runs on the timer wheel until the room is closed and returns the delay until next run.
         """
-        interval = 60
-        url = "https://live-trace.bilibili.com/xlive/rdata-interface/v1/heartbeat/webHeartBeat"
-        headers = {
-            "cookie": user.cookie.cookie_string,
-            "origin": "https://live.bilibili.com",
-            "referer": f"https://live.bilibili.com/{room_id}",
-            "user-agent": user.cookie.ua,
-        }
-        while not self.closed[room_id] and self.num[user.uid] <= 15:
-            time.sleep(interval)
-            # {interval}|{room_id}|1|0
-            hb_data = b64encode(f"{interval}|{room_id}|1|0".encode(
-                encoding="utf-8")).decode(encoding="utf-8")
-            params = {
-                "hb": hb_data,
-                "pf": "web",
-            }
-            headers.update({
-                "cookie": user.cookie.cookie_string
-            })
+        if self._is_running(user, room_id, session):
+            if (wait := self._reserve(user)) > 0:
+                return wait
             try:
-                response = requests.get(
-                    url, params=params, headers=headers).json()
-                # print(response)
-                assert response["code"] == 0, f"Error sending webHeartBeat, {response}"
-                interval = response["data"]["next_interval"]
+                with get_pool().prepaid():
+                    session.web_interval = self._send_web_heartbeat(user, room_id, session.web_interval)
             except:
-                self.on_del_room(user.uid, room_id)
+                self._close_room(user.uid, room_id)
                 print(traceback.format_exc())
-        print(f"[{user.uid}][{room_id}]", "webHeartBeat end")
+        if not self._is_running(user, room_id, session):
+            return self._end(session, "webHeartBeat")
+        return session.web_interval
+
+    def _send_web_heartbeat(self, user: BiliUser, room_id: int, interval: int) -> int:
+        """Send a single webHeartBeat and return the interval until the next one.
+        """
+        url = "https://live-trace.bilibili.com/xlive/rdata-interface/v1/heartbeat/webHeartBeat"
+        # {interval}|{room_id}|1|0
+        hb_data = b64encode(f"{interval}|{room_id}|1|0".encode(
+            encoding="utf-8")).decode(encoding="utf-8")
+        params = {
+            "hb": hb_data,
+            "pf": "web",
+        }
+        response = get_pool().get_json(
+            url, params=params, headers=self._headers(user, room_id), account=user.uid)
+        # print(response)
+        assert response["code"] == 0, f"Error sending webHeartBeat, {response}"
+        return response["data"]["next_interval"]
 
-    def _heartbeat(self, user: BiliUser, room_id: int) -> None:
+    def _heartbeat(self, user: BiliUser, room_id: int, session: HeartBeatSession) -> Union[float, bool]:
         """Send heartBeat.
         This method should execute immeditely and once after every 40s.
         """
-        url = "https://api.live.bilibili.com/relation/v1/Feed/heartBeat"
-        headers = {
-            "cookie": user.cookie.cookie_string,
-            "origin": "https://live.bilibili.com",
-            "referer": f"https://live.bilibili.com/{room_id}",
-            "user-agent": user.cookie.ua,
-        }
-        while not self.closed[room_id] and self.num[user.uid] <= 15:
-            headers.update({
-                "cookie": user.cookie.cookie_string
-            })
+        if self._is_running(user, room_id, session):
+            if (wait := self._reserve(user)) > 0:
+                return wait
             try:
-                response = requests.get(url, headers=headers).json()
-                # print(response)
-                assert response["code"] == 0 and response["msg"] == "success", \
-                    f"Error sending heartBeat, {response}"
+                with get_pool().prepaid():
+                    self._send_heartbeat(user, room_id)
             except:
-                self.on_del_room(user.uid, room_id)
+                self._close_room(user.uid, room_id)
                 print(traceback.format_exc())
-            time.sleep(40)
-        print(f"[{user.uid}][{room_id}]", "heartBeat end")
+        if not self._is_running(user, room_id, session):
+            return self._end(session, "heartBeat")
+        return True
 
-    def _X_heartbeat(self, user: BiliUser, room_id: int) -> None:
+    def _send_heartbeat(self, user: BiliUser, room_id: int) -> None:
+        """Send a single heartBeat.
+        """
+        url = "https://api.live.bilibili.com/relation/v1/Feed/heartBeat"
+        response = get_pool().get_json(url, headers=self._headers(user, room_id), account=user.uid)
+        # print(response)
+        assert response["code"] == 0 and response["msg"] == "success", \
+            f"Error sending heartBeat, {response}"
+
+    def _X_heartbeat(self, user: BiliUser, room_id: int, session: HeartBeatSession) -> Union[int, bool]:
         """Send X heartbeat.
-        This method should keep executing like <self._web_heartbeat>.
+        The first run sends E heartbeat, and every following run sends X heartbeat
+        like <self._web_heartbeat>. <session> keeps the device and secret between runs.
         """
-        url = "https://live-trace.bilibili.com/xlive/data-interface/v1/x25Kn/X"
-        info_url = f"https://api.live.bilibili.com/room/v1/Room/get_info?room_id={room_id}"
-        buvid = self._device_hash()
-        b_uuid = str(uuid1())
-        device = f"[\"{buvid}\",\"{b_uuid}\"]"
-        headers = {
-            "cookie": user.cookie.cookie_string,
-            "origin": "https://live.bilibili.com",
-            "referer": f"https://live.bilibili.com/{room_id}",
-            "user-agent": user.cookie.ua,
-        }
-        base_info = requests.get(info_url, headers=headers).json()["data"]
-        ruid, area_id, parent_area = base_info["uid"], base_info["area_id"], base_info["parent_area_id"]
-        ids = f"[{parent_area},{area_id},{self.num[user.uid]},{room_id}]"
-        ets = int(time.time())
-        interval, secret_key, secret_rule = self._E_heartbeat(user=user,
-                                                              room_id=room_id,
-                                                              ids=ids,
-                                                              device=device,
-                                                              ruid=ruid)
-        time.sleep(interval)
-        self.num[user.uid] += 1
-        while not self.closed[room_id] and self.num[user.uid] <= 15:
-            headers.update({
-                "cookie": user.cookie.cookie_string,
-            })
-            base_info = requests.get(info_url, headers=headers).json()["data"]
-            area_id, parent_area = base_info["area_id"], base_info["parent_area_id"]
-            ids = f"[{parent_area},{area_id},{self.num[user.uid]},{room_id}]"
-            ts = int(time.time() * 1000)
-            parsed_data = json.dumps({
-                "platform": "web",
-                "parent_id": parent_area,
-                "area_id": area_id,
-                "seq_id": self.num[user.uid],
-                "room_id": room_id,
-                "buvid": buvid,
-                "uuid": b_uuid,
-                "ets": ets,
-                "time": interval,
-                "ts": ts
-            }, ensure_ascii=False, separators=(",", ":"))
-            data = {
-                "s": self._gen_s(parsed_data=parsed_data,
-                                 secret_rules=secret_rule,
-                                 key=secret_key),
-                "id": ids,
-                "device": device,
-                "ruid": ruid,
-                "ets": ets,
-                "benchmark": secret_key,
-                "time": interval,
-                "ts": ts,
-                "ua": user.cookie.ua,
-                "csrf_token": user.cookie.csrf,
-                "csrf": user.cookie.csrf,
-                "visit_id": "",
-            }
+        if self._is_running(user, room_id, session):
+            if (wait := self._reserve(user)) > 0:
+                return wait
             try:
-                response = requests.post(
-                    url, headers=headers, data=data).json()
-                assert response["code"] == 0, f"Error sending X heartbeat, {response}"
+                base_info = self._get_room_info(user, room_id)
+                if not session.handshaken:
+                    self._handshake(user, room_id, session, base_info)
+                else:
+                    with get_pool().prepaid():
+                        session.interval, session.secret_key, session.secret_rule = \
+                            self._send_X_heartbeat(user, room_id, base_info, session)
+                    session.ets = int(time.time())
+                    session.seq += 1
             except:
-                self.on_del_room(user.uid, room_id)
+                self._close_room(user.uid, room_id)
                 print(traceback.format_exc())
-            else:
-                interval, secret_key, secret_rule = response["data"]["heartbeat_interval"], \
-                    response["data"]["secret_key"], response["data"]["secret_rule"]
-                ets = int(time.time())
-                self.num[user.uid] += 1
-                time.sleep(interval)
-        print(f"[{user.uid}][{room_id}]", "X heartbeat end")
+        if not self._is_running(user, room_id, session):
+            return self._end(session, "X heartbeat")
+        return session.interval
+
+    def _get_room_info(self, user: BiliUser, room_id: int) -> dict[str, Any]:
+        """Return base info of <room_id>, which contains <uid>, <area_id> and <parent_area_id>.
+        The info is shared by every user in <room_id> and refreshed once per cache TTL.
+        """
+        return get_room_info_cache().get(room_id, self._headers(user, room_id))
+
+    def _handshake(self, user: BiliUser, room_id: int, session: HeartBeatSession,
+                   base_info: dict[str, Any]) -> None:
+        """Send E heartbeat of <session> with a new device, which starts its X heartbeat.
+        If it fails, the room is closed by <self._E_heartbeat>.
+        """
+        session.buvid, session.uuid = self._device_hash(), str(uuid1())
+        session.ets = int(time.time())
+        with get_pool().prepaid():
+            handshake = self._E_heartbeat(user=user,
+                                          room_id=room_id,
+                                          ids=self._X_ids(room_id, session.seq, base_info),
+                                          device=f"[\"{session.buvid}\",\"{session.uuid}\"]",
+                                          ruid=base_info["uid"])
+        if handshake is not None:
+            session.interval, session.secret_key, session.secret_rule = handshake
+            session.seq += 1
+
+    @staticmethod
+    def _X_ids(room_id: int, seq: int, base_info: dict[str, Any]) -> str:
+        return f"[{base_info['parent_area_id']},{base_info['area_id']},{seq},{room_id}]"
+
+    def _refetch_area(self, user: BiliUser, room_id: int,
+                      base_info: dict[str, Any]) -> Optional[dict[str, Any]]:
+        """Fetch base info of <room_id> again and return it if its area is no longer
+        the one in <base_info>, otherwise return None.
+        """
+        get_room_info_cache().invalidate(room_id)
+        info = self._get_room_info(user, room_id)
+        if (info["area_id"], info["parent_area_id"]) == (base_info["area_id"], base_info["parent_area_id"]):
+            return None
+        return info
+
+    def _send_X_heartbeat(self, user: BiliUser, room_id: int, base_info: dict[str, Any],
+                          session: HeartBeatSession) -> tuple[int, str, list[int]]:
+        """Send a single X heartbeat of <session> and return the new <interval>,
+        <secret_key> and <secret_rule>. If it is rejected because the area of the room
+        changed since <base_info> was cached, it is sent once more with the new area.
+        Throttled requests are not retried, and the area is fetched and the request
+        sent again only if tokens of <user> are free for both.
+        """
+        response = self._post_X_heartbeat(user, room_id, base_info, session)
+        if response["code"] != 0 and response["code"] not in RateLimiter.THROTTLE_CODES and \
+                self._reserve(user, "room_info") == 0 and \
+                (base_info := self._refetch_area(user, room_id, base_info)) is not None and \
+                self._reserve(user) == 0:
+            response = self._post_X_heartbeat(user, room_id, base_info, session)
+        assert response["code"] == 0, f"Error sending X heartbeat, {response}"
+        return response["data"]["heartbeat_interval"], response["data"]["secret_key"], \
+            response["data"]["secret_rule"]
+
+    def _post_X_heartbeat(self, user: BiliUser, room_id: int, base_info: dict[str, Any],
+                          session: HeartBeatSession) -> dict[str, Any]:
+        url = "https://live-trace.bilibili.com/xlive/data-interface/v1/x25Kn/X"
+        buvid, b_uuid, ets, interval = session.buvid, session.uuid, session.ets, session.interval
+        secret_key, secret_rule = session.secret_key, session.secret_rule
+        area_id, parent_area = base_info["area_id"], base_info["parent_area_id"]
+        ts = int(time.time() * 1000)
+        parsed_data = json.dumps({
+            "platform": "web",
+            "parent_id": parent_area,
+            "area_id": area_id,
+            "seq_id": session.seq,
+            "room_id": room_id,
+            "buvid": buvid,
+            "uuid": b_uuid,
+            "ets": ets,
+            "time": interval,
+            "ts": ts
+        }, ensure_ascii=False, separators=(",", ":"))
+        data = {
+            "s": self._gen_s(parsed_data=parsed_data,
+                             secret_rules=secret_rule,
+                             key=secret_key),
+            "id": self._X_ids(room_id, session.seq, base_info),
+            "device": f"[\"{buvid}\",\"{b_uuid}\"]",
+            "ruid": base_info["uid"],
+            "ets": ets,
+            "benchmark": secret_key,
+            "time": interval,
+            "ts": ts,
+            "ua": user.cookie.ua,
+            "csrf_token": user.cookie.csrf,
+            "csrf": user.cookie.csrf,
+            "visit_id": "",
+        }
+        return get_pool().post_json(
+            url, headers=self._headers(user, room_id), data=data, account=user.uid)
 
     @staticmethod
     def _gen_s(parsed_data: str, secret_rules: list[int], key: str) -> str:
-        for rule in secret_rules:
-            match rule:
-                case 0:
-                    parsed_data = hmac.new(key=key.encode(encoding="utf-8"),
-                                           msg=parsed_data.encode(
-                                               encoding="utf-8"),
-                                           digestmod=hashlib.md5).hexdigest()
-                    parsed_data = hmac.new(key=key.encode(encoding="utf-8"),
-                                           msg=parsed_data.encode(
-                                               encoding="utf-8"),
-                                           digestmod=hashlib.md5).hexdigest()
-                case 1:
-                    parsed_data = hmac.new(key=key.encode(encoding="utf-8"),
-                                           msg=parsed_data.encode(
-                                               encoding="utf-8"),
-                                           digestmod=hashlib.sha1).hexdigest()
-                case 2:
-                    parsed_data = hmac.new(key=key.encode(encoding="utf-8"),
-                                           msg=parsed_data.encode(
-                                               encoding="utf-8"),
-                                           digestmod=hashlib.sha256).hexdigest()
-                case 3:
-                    parsed_data = hmac.new(key=key.encode(encoding="utf-8"),
-                                           msg=parsed_data.encode(
-                                               encoding="utf-8"),
-                                           digestmod=hashlib.sha224).hexdigest()
-                case 4:
-                    parsed_data = hmac.new(key=key.encode(encoding="utf-8"),
-                                           msg=parsed_data.encode(
-                                               encoding="utf-8"),
-                                           digestmod=hashlib.sha512).hexdigest()
-                case 5:
-                    parsed_data = hmac.new(key=key.encode(encoding="utf-8"),
-                                           msg=parsed_data.encode(
-                                               encoding="utf-8"),
-                                           digestmod=hashlib.sha384).hexdigest()
-                case _:
-                    pass
-        return parsed_data
+        return get_signer(key, secret_rules).sign(parsed_data)
 
     def _E_heartbeat(self, user: BiliUser, room_id: int, ids: str, device: str,
-                     ruid: int) -> tuple[int, str, list[int]]:
+                     ruid: int) -> Optional[tuple[int, str, list[int]]]:
         """Send E heartbeat.
         This method should execute only once, which is the first heartbeat request.
         """
         url = "https://live-trace.bilibili.com/xlive/data-interface/v1/x25Kn/E"
-        headers = {
-            "cookie": user.cookie.cookie_string,
-            "origin": "https://live.bilibili.com",
-            "referer": f"https://live.bilibili.com/{room_id}",
-            "user-agent": user.cookie.ua,
-        }
+        headers = self._headers(user, room_id)
         ts = str(int(time.time() * 1000))
         data = {
             "id": ids,
@@ -285,23 +507,34 @@ class WebHeartBeat:
             "visit_id": "",
         }
         try:
-            response = requests.post(url, headers=headers, data=data).json()
+            response = get_pool().post_json(url, headers=headers, data=data, account=user.uid)
             assert response["code"] == 0, f"Error sending E heartbeat, {response}"
             return response["data"]["heartbeat_interval"], response["data"]["secret_key"], \
                 response["data"]["secret_rule"]
         except:
             print(traceback.format_exc())
-            self.on_del_room(user.uid, room_id)
+            self._close_room(user.uid, room_id)
 
-    def send_danmaku(self, uid: int, room_id: int, content: str) -> None:
-        url = "https://api.live.bilibili.com/msg/send"
+    def _danmaku_headers(self, uid: int, room_id: int) -> dict[str, str]:
+        """Return headers of a danmaku of <uid> to <room_id>.
+        Headers of every user are built once and rebuilt when its cookie version changes.
+        """
         cookie = self.users[uid].cookie
-        headers = {
-            "cookie": cookie.cookie_string,
-            "origin": "https://live.bilibili.com",
-            "referer": f"https://live.bilibili.com/{room_id}",
-            "user-agent": cookie.ua,
-        }
+        snapshot = cookie.snapshot
+        template = self._header_templates.get(uid)
+        if template is None or template[0] != snapshot.version:
+            template = self._header_templates[uid] = (snapshot.version, {
+                "cookie": snapshot.cookie_string,
+                "origin": "https://live.bilibili.com",
+                "user-agent": cookie.ua,
+            })
+        headers = template[1].copy()
+        headers["referer"] = f"https://live.bilibili.com/{room_id}"
+        return headers
+
+    def _post_danmaku(self, uid: int, room_id: int, content: str) -> dict[str, Any]:
+        url = "https://api.live.bilibili.com/msg/send"
+        csrf = self.users[uid].cookie.csrf
         data = {
             "bubble": 0,
             "msg": content,
@@ -312,13 +545,62 @@ class WebHeartBeat:
             "fontsize": 25,
             "rnd": int(time.time()),
             "roomid": room_id,
-            "csrf": cookie.csrf,
-            "csrf_token": cookie.csrf,
+            "csrf": csrf,
+            "csrf_token": csrf,
         }
-        response = requests.post(url, headers=headers, data=data).json()
+        return get_pool().post_json(url, headers=self._danmaku_headers(uid, room_id),
+                                    data=data, account=uid)
+
+    def send_danmaku(self, uid: int, room_id: int, content: str) -> None:
+        response = self._post_danmaku(uid, room_id, content)
         assert response["code"] == 0, f"Error sending danmaku, {response}"
         print(f"[{uid}]", f"Send {content} to room {room_id}.")
 
+    def _send_danmaku_job(self, job: tuple[int, int, str]) -> dict[str, Any]:
+        uid, room_id, content = job
+        result = {"uid": uid, "room_id": room_id, "content": content}
+        try:
+            response = self._post_danmaku(uid, room_id, content)
+        except Exception as e:
+            result.update(ok=False, code=None, message=repr(e))
+        else:
+            result.update(ok=response.get("code") == 0, code=response.get("code"),
+                          message=response.get("message", ""))
+        return result
+
+    def send_danmaku_bulk(self, jobs: Iterable[tuple[int, int, str]],
+                          workers: int = 16) -> list[dict[str, Any]]:
+        """Send every (uid, room_id, content) of <jobs> concurrently.
+        Identical jobs, including ones already being sent by another call, are sent
+        once. Requests wait on the shared rate limiter of the http pool.
+        Return a result for every job in order, a dictionary with <uid>, <room_id>,
+        <content>, <ok>, <code> and <message>.
+        """
+        jobs = [(uid, room_id, content) for uid, room_id, content in jobs]
+        futures, owned = {}, []
+        with self._danmaku_lock:
+            for job in dict.fromkeys(jobs):
+                if job[0] not in self.users:
+                    futures[job] = Future()
+                    futures[job].set_result({"uid": job[0], "room_id": job[1], "content": job[2],
+                                             "ok": False, "code": None, "message": "unknown uid"})
+                    continue
+                if (future := self._pending_danmaku.get(job)) is None:
+                    future = self._pending_danmaku[job] = Future()
+                    owned.append(job)
+                futures[job] = future
+        if owned:
+            with ThreadPoolExecutor(max_workers=min(workers, len(owned)),
+                                    thread_name_prefix="DanmakuBulk") as executor:
+                for job, result in zip(owned, executor.map(self._send_danmaku_job, owned)):
+                    with self._danmaku_lock:
+                        self._pending_danmaku.pop(job, None)
+                    futures[job].set_result(result)
+        results = [futures[job].result() for job in jobs]
+        sent = sum(1 for result in results if result["ok"])
+        print(f"[WebHeartBeat] bulk danmaku: {sent}/{len(results)} sent.")
+        return results
+
     @staticmethod
     def _device_hash() -> str:
         hash_str = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789!@#$%^&*()+-".split()
@@ -336,3 +618,4 @@ if __name__ == '__main__':
                          sid="",
                          refresh_token="")
     w.add_heartbeat(178856569, 30321760)
+    Event().wait()
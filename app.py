@@ -1,8 +1,15 @@
+import traceback
+
 from BiliUser import CookieKeepAlive
+from Common import get_metrics
 
 
 if __name__ == '__main__':
     cookie = CookieKeepAlive()
+    try:
+        get_metrics().serve()
+    except:
+        print(traceback.format_exc())
     cookie.start()
     try:
         # Wait for thread to complete, but allow KeyboardInterrupt
@@ -10,3 +17,4 @@ if __name__ == '__main__':
             cookie.join(timeout=1)
     except KeyboardInterrupt:
         print("\nMain thread caught Ctrl+C! Exiting gracefully...")
+        cookie.shutdown()
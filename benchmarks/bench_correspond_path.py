@@ -0,0 +1,47 @@
+"""Benchmark of correspond path generation used by cookie refresh.
+
+Compares parsing the RSA key for every call with the cached cipher.
+Run from the repository root: python benchmarks/bench_correspond_path.py
+"""
+from __future__ import annotations
+
+import binascii
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+
+from BiliUser.BiliCookie import _PUBLIC_KEY, BiliCookie
+
+
+def correspond_path_reference(ts: int) -> str:
+    """The implementation BiliCookie._get_correspond_path used before caching.
+    """
+    pub_key = RSA.importKey(_PUBLIC_KEY.strip())
+    cipher = PKCS1_OAEP.new(pub_key, SHA256)
+    encrypted = cipher.encrypt(f"refresh_{ts}".encode(encoding="utf-8"))
+    return binascii.b2a_hex(encrypted).decode(encoding="utf-8")
+
+
+def main(number: int = 2000) -> None:
+    ts = int(time.time() * 1000)
+    cases = {
+        "reference": lambda: correspond_path_reference(ts),
+        "cached cipher": lambda: BiliCookie._get_correspond_path(ts),
+    }
+    baseline = None
+    for name, func in cases.items():
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        per_call = seconds / number * 1e6
+        baseline = baseline or per_call
+        print(f"{name:<16} {per_call:8.2f} us/call  x{baseline / per_call:.2f}")
+
+
+if __name__ == '__main__':
+    main()
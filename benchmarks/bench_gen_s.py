@@ -0,0 +1,62 @@
+"""Micro-benchmark of X heartbeat signing.
+
+Compares the original per-call HMAC implementation with HeartBeatSigner.
+Run from the repository root: python benchmarks/bench_gen_s.py
+"""
+from __future__ import annotations
+
+import hashlib
+import hmac
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from HeartBeatSigner import HeartBeatSigner, get_signer
+
+
+def gen_s_reference(parsed_data: str, secret_rules: list[int], key: str) -> str:
+    """The implementation WebHeartBeat._gen_s used before HeartBeatSigner.
+    """
+    digests = {1: hashlib.sha1, 2: hashlib.sha256, 3: hashlib.sha224,
+               4: hashlib.sha512, 5: hashlib.sha384}
+    for rule in secret_rules:
+        if rule == 0:
+            for _ in range(2):
+                parsed_data = hmac.new(key=key.encode(encoding="utf-8"),
+                                       msg=parsed_data.encode(encoding="utf-8"),
+                                       digestmod=hashlib.md5).hexdigest()
+        elif rule in digests:
+            parsed_data = hmac.new(key=key.encode(encoding="utf-8"),
+                                   msg=parsed_data.encode(encoding="utf-8"),
+                                   digestmod=digests[rule]).hexdigest()
+    return parsed_data
+
+
+def main(number: int = 20000) -> None:
+    key = "seacasdgyijfhofiuxoannn"
+    rules = [2, 5, 1, 4, 3, 0]
+    parsed_data = json.dumps({
+        "platform": "web", "parent_id": 9, "area_id": 371, "seq_id": 3,
+        "room_id": 30321760, "buvid": "0" * 32, "uuid": "0" * 36,
+        "ets": 1700000000, "time": 60, "ts": 1700000000000,
+    }, ensure_ascii=False, separators=(",", ":"))
+    assert gen_s_reference(parsed_data, rules, key) == get_signer(key, rules).sign(parsed_data)
+
+    cases = {
+        "reference": lambda: gen_s_reference(parsed_data, rules, key),
+        "signer (cold)": lambda: HeartBeatSigner(key, tuple(rules)).sign(parsed_data),
+        "signer (cached)": lambda: get_signer(key, rules).sign(parsed_data),
+    }
+    baseline = None
+    for name, func in cases.items():
+        seconds = min(timeit.repeat(func, number=number, repeat=5))
+        per_call = seconds / number * 1e6
+        baseline = baseline or per_call
+        print(f"{name:<16} {per_call:8.2f} us/call  x{baseline / per_call:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Startup time report of the entry points.
+
+Imports every entry point in a fresh interpreter with -X importtime and
+prints its total import time and the slowest modules it pulls in.
+Run from the repository root: python benchmarks/bench_startup.py [module ...]
+"""
+from __future__ import annotations
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = ("app", "SendDanmaku", "RecCookieUpdater")
+
+
+def import_times(module: str) -> list[tuple[str, int, int]]:
+    """Return (module, self us, cumulative us) of <module> and every module it imports.
+    Modules imported by the interpreter startup itself are left out.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  ") and name.strip() != module:
+            # Another top-level import, drop it with whatever it pulled in.
+            times = []
+            continue
+        times.append((name.strip(), int(self_us), int(cumulative)))
+    return times
+
+
+def report(module: str, top: int = 8, repeat: int = 5) -> None:
+    runs = [import_times(module) for _ in range(repeat)]
+    totals = sorted(next(c for name, _, c in times if name == module) for times in runs)
+    print(f"{module}: median {totals[len(totals) // 2] / 1000:.1f} ms "
+          f"(min {totals[0] / 1000:.1f} ms) over {repeat} runs")
+    slowest = sorted(runs[0], key=lambda item: item[2], reverse=True)
+    for name, self_us, cumulative in [item for item in slowest if item[0] != module][:top]:
+        print(f"    {cumulative / 1000:8.1f} ms  {self_us / 1000:6.1f} ms self  {name}")
+
+
+def main() -> None:
+    for module in sys.argv[1:] or ENTRY_POINTS:
+        report(module)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Local fake of the BililiveRecorder config API for RecCookieUpdater.
+
+Starts <n> HTTP servers on localhost which answer GET and POST of
+/api/config/global like a recorder does, optionally after a delay, then runs
+RecCookieUpdater.update_all against them twice. The second run should report
+every host as unchanged and POST nothing.
+
+The servers are also the fixture of tests/test_rec_cookie_updater.py.
+Run from the repository root:
+    python tests/fake_recorder.py [n] [delay_ms] [cookies.json]
+
+Without a cookies.json, fake accounts are generated and cookies are built
+locally instead of being fetched from bilibili.com and checked.
+"""
+from __future__ import annotations
+
+import json
+import os
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import RecCookieUpdater
+
+
+class FakeRecorder(ThreadingHTTPServer):
+    """A recorder config endpoint keeping its config in memory.
+
+    === Public Attributes ===
+    config: the current global config.
+    delay: seconds to wait before answering.
+    gets: number of GET requests served.
+    posts: number of POST requests served.
+    lock: lock guarding the attributes above.
+    """
+    daemon_threads = True
+
+    config: dict
+    delay: float
+    gets: int
+    posts: int
+    lock: Lock
+
+    def __init__(self, port: int = 0, delay: float = 0.0) -> None:
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.config = {"optionalCookie": {"hasValue": False, "value": None}}
+        self.delay = delay
+        self.gets = 0
+        self.posts = 0
+        self.lock = Lock()
+
+    @property
+    def host(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> FakeRecorder:
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: FakeRecorder
+
+    def _reply(self, code: int, body: bytes = b"") -> None:
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        time.sleep(self.server.delay)
+        if self.path != RecCookieUpdater.URI:
+            return self._reply(404)
+        with self.server.lock:
+            self.server.gets += 1
+            body = json.dumps(self.server.config).encode()
+        self._reply(200, body)
+
+    def do_POST(self) -> None:
+        time.sleep(self.server.delay)
+        if self.path != RecCookieUpdater.URI:
+            return self._reply(404)
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.posts += 1
+            self.server.config = json.loads(data)
+            body = json.dumps(self.server.config).encode()
+        self._reply(200, body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def fake_accounts(path: str, count: int) -> None:
+    accounts = {str(uid): {"UID": uid, "SESSDATA": f"sess{uid}", "bili_jct": f"jct{uid}",
+                           "DedeUserID__ckMd5": f"md5{uid}", "sid": f"sid{uid}"}
+                for uid in range(1, count + 1)}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(accounts, f)
+
+
+def local_cookie(content) -> str:
+    return (f"SESSDATA={content['SESSDATA']}; bili_jct={content['bili_jct']}; "
+            f"DedeUserID={content['UID']}; buvid3=fake-{time.time_ns()}")
+
+
+def main(n: int = 32, delay_ms: float = 50, f_path: str = "") -> None:
+    recorders = [FakeRecorder(delay=delay_ms / 1000).start() for _ in range(n)]
+    hosts = [recorder.host for recorder in recorders]
+    if not f_path:
+        f_path = os.path.join(tempfile.mkdtemp(), "cookies.json")
+        fake_accounts(f_path, max(1, n // 2))
+        RecCookieUpdater.fetch_cookie_http = local_cookie
+        RecCookieUpdater.check_login = lambda content, cookie: None
+    try:
+        for run in ("first", "second"):
+            print(f"--- {run} run")
+            start = time.perf_counter()
+            RecCookieUpdater.update_all(hosts, f_path)
+            print(f"total {(time.perf_counter() - start) * 1000:.1f} ms, "
+                  f"{sum(r.posts for r in recorders)} POSTs so far")
+    finally:
+        for recorder in recorders:
+            recorder.shutdown()
+            recorder.server_close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(int(args[0]) if len(args) > 0 else 32,
+         float(args[1]) if len(args) > 1 else 50,
+         args[2] if len(args) > 2 else "")
@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from BiliUser import AccountSelector
+
+
+class CooldownTest(unittest.TestCase):
+    def setUp(self):
+        self.selector = AccountSelector(max_errors=3, cooldown=0.1)
+        for uid in (1, 2):
+            self.selector.add(uid)
+
+    def fail(self, uid, times=3):
+        for _ in range(times):
+            self.selector.report(uid, False)
+
+    def test_failed_account_returns_after_cooldown(self):
+        self.fail(1)
+        self.assertFalse(self.selector.is_healthy(1))
+        self.assertEqual([self.selector.select() for _ in range(3)], [2, 2, 2])
+
+        time.sleep(0.15)
+        self.assertTrue(self.selector.is_healthy(1))
+        self.assertEqual(self.selector.select(exclude={2}), 1)
+
+    def test_one_more_failure_cools_down_again(self):
+        self.fail(1)
+        time.sleep(0.15)
+        self.fail(1, times=1)
+        self.assertFalse(self.selector.is_healthy(1))
+        self.assertIsNone(self.selector.select(exclude={2}))
+
+    def test_success_before_cooldown_ends(self):
+        self.fail(1)
+        self.selector.report(1, True)
+        self.assertTrue(self.selector.is_healthy(1))
+        self.fail(1, times=2)
+        time.sleep(0.15)
+        self.assertTrue(self.selector.is_healthy(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
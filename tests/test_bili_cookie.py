@@ -0,0 +1,79 @@
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from BiliUser import BiliCookie
+
+
+class FakeResponse:
+    """A streamed response whose body is cut into chunks of <size> bytes.
+    """
+    def __init__(self, body, size):
+        self.body = body
+        self.size = size
+        self.read = 0
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.body), self.size):
+            self.read = start + self.size
+            yield self.body[start:start + self.size]
+
+
+class RefreshCsrfTest(unittest.TestCase):
+    CSRF = "b9f3c1a4e2d8f7a6c5b4e3d2f1a0b9c8"
+    HEAD = b"<html><head><title>correspond</title></head><body>" + b"x" * 5000
+    DIV = b'<div id="1-name">' + CSRF.encode() + b"</div>"
+    TAIL = b'<div id="2-name">other</div>' + b"y" * 10000 + b"</body></html>"
+
+    def test_chunk_sizes(self):
+        body = self.HEAD + self.DIV + self.TAIL
+        for size in (1, 7, 64, 255, 256, 257, 4096):
+            with self.subTest(size=size):
+                csrf, read = BiliCookie._extract_refresh_csrf(FakeResponse(body, size))
+                self.assertEqual(csrf, self.CSRF)
+                self.assertTrue(body.startswith(read))
+
+    def test_split_at_each_byte(self):
+        body = self.HEAD + self.DIV + self.TAIL
+        for cut in range(len(self.HEAD) - 1, len(self.HEAD) + len(self.DIV) + 1):
+            with self.subTest(cut=cut):
+                response = SplitResponse(body, cut)
+                csrf, read = BiliCookie._extract_refresh_csrf(response)
+                self.assertEqual(csrf, self.CSRF)
+                self.assertTrue(body.startswith(read))
+
+    def test_stops_reading_after_match(self):
+        response = FakeResponse(self.HEAD + self.DIV + self.TAIL, 1024)
+        csrf, read = BiliCookie._extract_refresh_csrf(response)
+        self.assertEqual(csrf, self.CSRF)
+        self.assertLess(response.read, len(response.body))
+        self.assertEqual(len(read), response.read)
+
+    def test_missing_div(self):
+        body = self.HEAD + self.TAIL
+        csrf, read = BiliCookie._extract_refresh_csrf(FakeResponse(body, 4096))
+        self.assertIsNone(csrf)
+        self.assertEqual(read, body)
+
+    def test_escaped_text(self):
+        body = self.HEAD + b'<DIV class="x" id=1-name>a&amp;b</DIV>' + self.TAIL
+        self.assertEqual(BiliCookie._extract_refresh_csrf(FakeResponse(body, 100))[0], "a&b")
+
+
+class SplitResponse:
+    """A streamed response cut into two chunks at <cut>.
+    """
+    def __init__(self, body, cut):
+        self.body = body
+        self.cut = cut
+
+    def iter_content(self, chunk_size=1):
+        yield self.body[:self.cut]
+        yield self.body[self.cut:]
+
+
+if __name__ == "__main__":
+    unittest.main()
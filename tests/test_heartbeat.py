@@ -0,0 +1,203 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+from concurrent.futures import wait
+from contextlib import contextmanager
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import AsyncHeartBeat
+import RoomHeartBeat
+import RoomInfoCache
+import WebHeartBeat
+
+
+class FakePool:
+    """An http pool answering every request from <responses>, which key is the
+    last part of the url path and value is the json returned, an exception raised,
+    or a list of them answered in order.
+    """
+    limiter = None
+
+    def __init__(self, responses, latency=0):
+        self.responses = responses
+        self.latency = latency
+        self.requests = []
+
+    def _answer(self, url):
+        name = url.split("?")[0].rsplit("/", 1)[-1]
+        self.requests.append(name)
+        time.sleep(self.latency)
+        response = self.responses[name]
+        if isinstance(response, list):
+            response = response.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def get_json(self, url, account=None, **kwargs):
+        return self._answer(url)
+
+    def post_json(self, url, account=None, **kwargs):
+        return self._answer(url)
+
+    @contextmanager
+    def prepaid(self):
+        yield
+
+
+class HeartBeatTestCase(unittest.TestCase):
+    UID = 1
+
+    def use_pool(self, pool):
+        for module in (WebHeartBeat, AsyncHeartBeat, RoomHeartBeat, RoomInfoCache):
+            patcher = mock.patch.object(module, "get_pool", lambda: pool)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class HeartBeatFailureTest(HeartBeatTestCase):
+    def test_failed_heartbeat_closes_the_room(self):
+        self.use_pool(FakePool({"heartBeat": {"code": -101, "msg": "not logged in"}}))
+        manager = WebHeartBeat.WebHeartBeat(self.UID)
+        self.addCleanup(manager.shutdown, 0)
+        closed = []
+        manager.del_room_callback = lambda uid, room_id: closed.append((uid, room_id))
+        other = manager.sessions.open(self.UID + 1, 100)
+        session = manager.sessions.open(self.UID, 100)
+
+        self.assertIs(manager._heartbeat(manager.users[self.UID], 100, session), False)
+        self.assertEqual(closed, [(self.UID, 100)])
+        self.assertTrue(session.closed)
+        self.assertTrue(other.closed)
+        self.assertNotIn((self.UID, 100), manager.sessions)
+        self.assertEqual(manager._header_cache, {})
+
+    def test_closed_session_skips_handshake(self):
+        pool = FakePool({})
+        self.use_pool(pool)
+        manager = WebHeartBeat.WebHeartBeat(self.UID)
+        self.addCleanup(manager.shutdown, 0)
+        session = manager.sessions.open(self.UID, 102)
+        manager.sessions.close(self.UID, 102)
+
+        self.assertIs(manager._X_heartbeat(manager.users[self.UID], 102, session), False)
+        self.assertEqual(pool.requests, [])
+        self.assertEqual(len(manager.sessions), 0)
+
+    def test_failed_handshake_ends_session(self):
+        pool = FakePool({"get_info": {"code": 0, "data": {"uid": 2, "area_id": 3, "parent_area_id": 4}},
+                         "E": {"code": -101, "message": "not logged in"}})
+        self.use_pool(pool)
+        manager = WebHeartBeat.WebHeartBeat(self.UID)
+        self.addCleanup(manager.shutdown, 0)
+        session = manager.sessions.open(self.UID, 103)
+
+        self.assertIs(manager._X_heartbeat(manager.users[self.UID], 103, session), False)
+        self.assertEqual(pool.requests, ["get_info", "E"])
+        self.assertFalse(session.handshaken)
+        self.assertEqual(len(manager.sessions), 0)
+
+    def test_failed_room_info_ends_async_session(self):
+        self.use_pool(FakePool({"get_info": {"code": 1, "message": "room not found"}}))
+        manager = AsyncHeartBeat.AsyncHeartBeat(self.UID)
+        self.addCleanup(manager.shutdown, 1)
+        closed = []
+        manager.del_room_callback = lambda uid, room_id: closed.append((uid, room_id))
+        session = manager.sessions.open(self.UID, 101)
+
+        task = manager._X_heartbeat_task(manager.users[self.UID], 101, session)
+        asyncio.run_coroutine_threadsafe(task, manager._loop).result(5)
+        self.assertEqual(closed, [(self.UID, 101)])
+        self.assertTrue(session.closed)
+        self.assertEqual(len(manager.sessions), 0)
+
+
+class XHeartBeatRetryTest(HeartBeatTestCase):
+    OK = {"code": 0, "data": {"heartbeat_interval": 60, "secret_key": "k", "secret_rule": [0, 1]}}
+
+    @staticmethod
+    def room_info(area_id):
+        return {"code": 0, "data": {"uid": 2, "area_id": area_id, "parent_area_id": 1}}
+
+    def send(self, pool, room_id):
+        self.use_pool(pool)
+        manager = WebHeartBeat.WebHeartBeat(self.UID)
+        self.addCleanup(manager.shutdown, 0)
+        session = manager.sessions.open(self.UID, room_id)
+        session.buvid, session.uuid, session.secret_key, session.secret_rule = "b", "u", "k", [0, 1]
+        return manager._X_heartbeat(manager.users[self.UID], room_id, session), session
+
+    def test_retried_after_area_changed(self):
+        pool = FakePool({"get_info": [self.room_info(3), self.room_info(4)],
+                         "X": [{"code": 1012002, "message": "area changed"}, self.OK]})
+        result, session = self.send(pool, 300)
+        self.assertEqual(result, 60)
+        self.assertEqual(pool.requests, ["get_info", "X", "get_info", "X"])
+        self.assertEqual(session.seq, 1)
+
+    def test_throttled_is_not_retried(self):
+        pool = FakePool({"get_info": self.room_info(3), "X": {"code": -412, "message": "throttled"}})
+        result, session = self.send(pool, 301)
+        self.assertIs(result, False)
+        self.assertEqual(pool.requests, ["get_info", "X"])
+
+
+class ResumeTest(HeartBeatTestCase):
+    def test_resumed_sessions_keep_their_schedule(self):
+        self.use_pool(FakePool({}))
+        now = time.time()
+        path = os.path.join(tempfile.mkdtemp(), "sessions.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"saved": now, "sessions": [
+                {"uid": self.UID, "room_id": 400, "started": now - 3600, "seq": 5, "buvid": "b",
+                 "uuid": "u", "ets": now - 10, "interval": 60, "secret_key": "k", "secret_rule": [0]},
+                {"uid": self.UID, "room_id": 401, "started": now - 1800, "seq": 3},
+            ]}, f)
+        manager = WebHeartBeat.WebHeartBeat(self.UID)
+        self.addCleanup(manager.shutdown, 0)
+        with mock.patch.object(manager, "_start_heartbeat"):
+            self.assertEqual(manager.resume(path, spread=0), 2)
+
+        warm, cold = manager.sessions.get(self.UID, 400), manager.sessions.get(self.UID, 401)
+        self.assertEqual((warm.seq, warm.started), (5, now - 3600))
+        self.assertAlmostEqual(manager._X_delay(warm), 50, delta=1)
+        self.assertEqual((cold.seq, cold.started), (0, now - 1800))
+        self.assertEqual(manager._X_delay(cold), 0)
+
+
+class RoomBurstTest(HeartBeatTestCase):
+    USERS = 10
+
+    def test_burst_does_not_block_the_timer(self):
+        pool = FakePool({"heartBeat": {"code": 0, "msg": "success"},
+                         "webHeartBeat": {"code": 0, "data": {"next_interval": 30}}}, latency=0.2)
+        self.use_pool(pool)
+        uids = range(self.UID, self.UID + self.USERS)
+        manager = RoomHeartBeat.RoomHeartBeat(*uids, burst_workers=4, burst_rate=1000)
+        self.addCleanup(manager.shutdown, 5)
+        table = manager._tables[200] = RoomHeartBeat._RoomTable(200)
+        for uid in uids:
+            manager.sessions.open(uid, 200)
+            table.add(uid)
+
+        started = time.monotonic()
+        self.assertEqual(manager._room_web_heartbeat(table), 60)
+        self.assertIs(manager._room_heartbeat(table), True)
+        self.assertLess(time.monotonic() - started, 0.1)
+
+        wait(table.bursts["webHeartBeat"] + table.bursts["heartBeat"], 5)
+        time.sleep(0.05)
+        self.assertEqual(pool.requests.count("heartBeat"), self.USERS)
+        self.assertEqual(pool.requests.count("webHeartBeat"), self.USERS)
+        self.assertEqual(table.web_interval, 30)
+
+
+if __name__ == "__main__":
+    unittest.main()
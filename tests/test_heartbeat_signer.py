@@ -0,0 +1,58 @@
+import hashlib
+import hmac
+import json
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from HeartBeatSigner import HeartBeatSigner, get_signer
+
+
+def gen_s_reference(parsed_data, secret_rules, key):
+    """WebHeartBeat._gen_s before HeartBeatSigner, one new HMAC per step.
+    """
+    digests = {1: hashlib.sha1, 2: hashlib.sha256, 3: hashlib.sha224,
+               4: hashlib.sha512, 5: hashlib.sha384}
+    for rule in secret_rules:
+        if rule == 0:
+            for _ in range(2):
+                parsed_data = hmac.new(key=key.encode(encoding="utf-8"),
+                                       msg=parsed_data.encode(encoding="utf-8"),
+                                       digestmod=hashlib.md5).hexdigest()
+        elif rule in digests:
+            parsed_data = hmac.new(key=key.encode(encoding="utf-8"),
+                                   msg=parsed_data.encode(encoding="utf-8"),
+                                   digestmod=digests[rule]).hexdigest()
+    return parsed_data
+
+
+class SignerTest(unittest.TestCase):
+    KEY = "seacasdgyijfhofiuxoannn"
+    DATA = json.dumps({
+        "platform": "web", "parent_id": 9, "area_id": 371, "seq_id": 3,
+        "room_id": 30321760, "buvid": "0" * 32, "uuid": "0" * 36,
+        "ets": 1700000000, "time": 60, "ts": 1700000000000,
+    }, ensure_ascii=False, separators=(",", ":"))
+
+    def test_matches_reference(self):
+        for rules in ([2, 5, 1, 4, 3, 0], [0], [0, 0, 3], [5, 5], [4, 9, 1], []):
+            with self.subTest(rules=rules):
+                self.assertEqual(HeartBeatSigner(self.KEY, tuple(rules)).sign(self.DATA),
+                                 gen_s_reference(self.DATA, rules, self.KEY))
+
+    def test_non_ascii(self):
+        key, data = "钥匙", '{"room":"直播间"}'
+        self.assertEqual(get_signer(key, [1, 0]).sign(data), gen_s_reference(data, [1, 0], key))
+
+    def test_signer_is_reusable(self):
+        signer = get_signer(self.KEY, [2, 0])
+        self.assertIs(get_signer(self.KEY, [2, 0]), signer)
+        self.assertEqual(signer.sign(self.DATA), signer.sign(self.DATA))
+        self.assertEqual(signer.sign("other"), gen_s_reference("other", [2, 0], self.KEY))
+
+
+if __name__ == "__main__":
+    unittest.main()
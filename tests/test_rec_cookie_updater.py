@@ -0,0 +1,66 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import RecCookieUpdater
+from BiliUser import AccountSelector
+from fake_recorder import FakeRecorder, fake_accounts, local_cookie
+
+
+class UpdateAllTest(unittest.TestCase):
+    HOSTS = 4
+
+    def setUp(self):
+        self.recorders = [FakeRecorder().start() for _ in range(self.HOSTS)]
+        self.hosts = [recorder.host for recorder in self.recorders]
+        self.f_path = os.path.join(tempfile.mkdtemp(), "cookies.json")
+        fake_accounts(self.f_path, self.HOSTS * 2)
+        for name, value in (("fetch_cookie_http", local_cookie), ("check_login", mock.Mock()),
+                            ("_selector", AccountSelector()), ("_sessdata", {}), ("_assignment", {})):
+            patcher = mock.patch.object(RecCookieUpdater, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for recorder in self.recorders:
+            recorder.shutdown()
+            recorder.server_close()
+
+    def test_second_run_is_unchanged(self):
+        first = RecCookieUpdater.update_all(self.hosts, self.f_path)
+        self.assertEqual([status for _, _, status, _ in first], ["updated"] * self.HOSTS)
+        self.assertEqual([recorder.posts for recorder in self.recorders], [1] * self.HOSTS)
+
+        second = RecCookieUpdater.update_all(self.hosts, self.f_path)
+        self.assertEqual([status for _, _, status, _ in second], ["unchanged"] * self.HOSTS)
+        self.assertEqual([recorder.posts for recorder in self.recorders], [1] * self.HOSTS)
+
+    def test_hosts_get_distinct_accounts(self):
+        report = RecCookieUpdater.update_all(self.hosts, self.f_path)
+        uids = [uid for _, uid, _, _ in report]
+        self.assertEqual(len(set(uids)), self.HOSTS)
+        for recorder, uid in zip(self.recorders, uids):
+            cookie = recorder.config["optionalCookie"]["value"]
+            self.assertIn(f"DedeUserID={uid};", cookie)
+
+
+class ParseArgsTest(unittest.TestCase):
+    def test_hosts_file(self):
+        path = os.path.join(tempfile.mkdtemp(), "hosts.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("# recorders\nhttp://a:2356/\n\nhttp://b:2356\n")
+        self.assertEqual(RecCookieUpdater.parse_args(["http://a:2356", "--hosts-file", path, "--selenium"]),
+                         (["http://a:2356", "http://b:2356"], True))
+
+    def test_hosts_file_without_path(self):
+        with self.assertRaises(ValueError):
+            RecCookieUpdater.parse_args(["http://a:2356", "--hosts-file"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from Common import TimerWheel
+
+
+class RaisingCallbackTest(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(tick=0.01, workers=2)
+        self.addCleanup(self.wheel.stop)
+
+    def wait_until(self, predicate, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not predicate() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return predicate()
+
+    def test_cancelled_after_max_failures(self):
+        runs = []
+
+        def _fail():
+            runs.append(time.monotonic())
+            raise RuntimeError("boom")
+
+        timer = self.wheel.call_every(0.02, _fail, delay=0)
+        self.assertTrue(self.wait_until(lambda: timer.cancelled))
+        time.sleep(0.5)
+        self.assertEqual(len(runs), TimerWheel.MAX_FAILURES)
+        gaps = [b - a for a, b in zip(runs, runs[1:])]
+        self.assertGreater(gaps[-1], gaps[0])
+
+    def test_success_resets_failures(self):
+        runs = []
+
+        def _flaky():
+            runs.append(None)
+            if len(runs) % 2:
+                raise RuntimeError("boom")
+            return len(runs) < 2 * TimerWheel.MAX_FAILURES
+
+        timer = self.wheel.call_every(0.01, _flaky, delay=0)
+        self.assertTrue(self.wait_until(lambda: timer.cancelled))
+        self.assertEqual(len(runs), 2 * TimerWheel.MAX_FAILURES)
+
+
+if __name__ == "__main__":
+    unittest.main()